@@ -0,0 +1,466 @@
+import os, sys
+from config import (OTHER_WORDS_COUNT, ACTIVATE_THIS_PATH, SEARCH_PAGE_SIZE, SEARCH_INLINE_LIMIT, LEADERBOARD_SIZE,
+                    TRANSFER_MAX_FILE_SIZE)
+if sys.platform != 'win32' and os.path.exists(ACTIVATE_THIS_PATH):
+    with open(ACTIVATE_THIS_PATH) as f:
+         exec(f.read(), {'__file__': ACTIVATE_THIS_PATH})
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Бот на asyncio: все обработчики выполняются в одном цикле событий, запросы к БД, переводчику
+# и Telegram не занимают поток на время ожидания. Запуск: python async_main.py
+
+import asyncio
+import random
+import time
+
+from telebot import asyncio_filters
+from telebot.async_telebot import AsyncTeleBot
+
+from card_deck.card_deck import card_deck
+from db import async_db, transfer
+from db.answer_buffer import answer_buffer
+from db.bulk_import import import_words
+from dialog.dialog import (Command, MyStates, show_hint, show_target, answer_latency, keyboard, card_markup,
+                           prepare_card, search_page, parse_search_callback, inline_results, stats_text,
+                           leaderboard_text, SEARCH_CALLBACK, START_MARKUP, SERVICE_MARKUP, NEXT_MARKUP, CANCEL_MARKUP, YES_CANCEL_MARKUP, REMOVE_MARKUP)
+from http_client import async_http_client
+from metrics import metrics
+from random_word.async_random_word import get_random_word
+from random_word.pool import random_word_pool
+from state_storage.state_storage import AsyncSQLiteStateStorage
+from yandex_translate.async_translate import translate_cached
+
+TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
+
+if TELEGRAM_TOKEN is None:
+    raise ValueError('TELEGRAM_TOKEN не установлен в переменных окружения.')
+
+print('Start async telegram bot...')
+
+state_storage = AsyncSQLiteStateStorage()
+bot = AsyncTeleBot(TELEGRAM_TOKEN, state_storage=state_storage)
+
+
+async def main_dialog(message):
+    """
+    Функция построения основного диалога игры
+    :param message:
+    :return:
+    """
+    cid = message.chat.id
+    # Карточка из заранее собранной колоды пользователя
+    card = card_deck.pop(cid)
+    if card is None:
+        # Перемешиваем направление перевода en-ru или ru-en: lang - язык вариантов ответа
+        lang = random.choice(['ru', 'en'])
+        # Пользователь, пара слов и неправильные варианты ответа за один запрос к БД
+        async with async_db.get_connection() as conn:
+            card = await async_db.build_card(conn, cid, lang, OTHER_WORDS_COUNT, answer_buffer.pending)
+
+        # Если пользователь не найден отправляем на /start
+        if card is None or card['user_name'] is None:
+            await bot.send_message(message.chat.id, 'Мы не нашли вас в базе данных. Нажмите /start',
+                                   reply_markup=START_MARKUP)
+            return True
+        card = prepare_card(card, lang)
+
+    # Состояние сохраняем до отправки: следующее сообщение пользователя может прийти раньше ответа Telegram
+    await bot.set_state(message.from_user.id, MyStates.check_answer, message.chat.id)
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        data['word_id'] = card['word_id']
+        data['target_word'] = card['target_word']
+        data['translate_word'] = card['translate_word']
+        # Вместо объектов кнопок храним только порядок вариантов ответа и номера ошибочно выбранных
+        data['answers'] = card['answers']
+        data['wrong'] = []
+        data['shown_at'] = time.time()
+    await bot.send_message(message.chat.id, card['greeting'], reply_markup=card['markup'], parse_mode='HTML')
+
+
+@bot.message_handler(commands=['start'])
+@metrics.handler
+async def start_command(message):
+    """
+    Стартовый диалог. Запрашивает имя пользователя, если пользователя нет в БД
+    :param message:
+    :return:
+    """
+    cid = message.chat.id
+    async with async_db.get_connection() as conn:
+        # Запрашиваем имя пользователя из БД
+        user_name = await async_db.find_user(conn, cid)
+    if user_name is None:
+        # Если пользователя нет в БД устанавливаем стэйт на добавление имени пользователя
+        await bot.set_state(message.from_user.id, MyStates.waitng_for_name, cid)
+        await bot.send_message(cid, "Привет, давай знакомиться. Как тебя зовут?",
+                               reply_markup=REMOVE_MARKUP)
+    else:
+        # Приветствуем пользователя и запускаем основной диалог
+        await bot.send_message(cid, f"Привет, {user_name[0]}!")
+        await main_dialog(message)
+
+
+@bot.message_handler(content_types=["text"], state=MyStates.waitng_for_name)
+@metrics.handler
+async def create_user(message):
+    """
+    Функция записывает нового пользователя в БД
+    :param message:
+    :return:
+    """
+    user_name = message.text
+    async with async_db.get_connection() as conn:
+        await async_db.add_user(conn, message.chat.id, user_name)
+    await start_command(message)
+
+# Хэндлер для кнопки Дальше или Отмена
+@bot.message_handler(func=lambda message: message.text == Command.NEXT or message.text == Command.CANCEL)
+@metrics.handler
+async def next_cards(message):
+    await main_dialog(message)
+
+
+async def import_list(message, text):
+    """
+    Функция добавляет в словарь пользователя список слов и сообщает результат
+    :param message:
+    :param text: текст списка или CSV файла
+    :return:
+    """
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    try:
+        # Массовый импорт переводит слова пачками и пишет в БД синхронно - выполняем его в отдельном потоке
+        added, failed = await asyncio.to_thread(import_words, message.chat.id, text)
+    except ValueError as e:
+        await bot.reply_to(message, str(e), reply_markup=NEXT_MARKUP)
+        return
+    msg = f'Добавлено слов в словарь - {added}'
+    if failed:
+        msg = show_hint(msg, 'Не удалось перевести: ' + ', '.join(failed[:50]))
+    await bot.reply_to(message, msg, reply_markup=NEXT_MARKUP)
+
+
+# Хэндлер для массового добавления слов: список можно передать сразу после команды
+@bot.message_handler(commands=['add_list'])
+@metrics.handler
+async def add_list(message):
+    text = message.text.partition(' ')[2]
+    if text.strip():
+        await import_list(message, text)
+    else:
+        await bot.set_state(message.from_user.id, MyStates.waiting_for_list, message.chat.id)
+        await bot.send_message(message.chat.id, 'Отправьте список слов (по одному в строке) или файл .txt/.csv.',
+                               reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для списка слов, отправленного текстом
+@bot.message_handler(content_types=['text'], state=MyStates.waiting_for_list)
+@metrics.handler
+async def add_list_text(message):
+    await import_list(message, message.text)
+
+
+# Хэндлер для списка слов, отправленного файлом
+@bot.message_handler(content_types=['document'], state=MyStates.waiting_for_list)
+@metrics.handler
+async def add_list_file(message):
+    file_info = await bot.get_file(message.document.file_id)
+    text = (await bot.download_file(file_info.file_path)).decode('utf-8-sig', errors='replace')
+    await import_list(message, text)
+
+
+async def find_words(user_id, text, page):
+    """
+    Функция ищет слова в словаре пользователя и готовит страницу результатов
+    :param user_id: номер пользователя в telegram
+    :param text: запрос, пустая строка - весь словарь
+    :param page: номер страницы, с 0
+    :return: кортеж (текст сообщения, str JSON inline клавиатуры листания или None)
+    """
+    async with async_db.get_connection() as conn:
+        words, total = await async_db.search_words(conn, user_id, text, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+    return search_page(text, words, total, page, SEARCH_PAGE_SIZE)
+
+
+# Хэндлер для поиска по словарю: запрос можно передать сразу после команды
+@bot.message_handler(commands=['search'])
+@metrics.handler
+async def search(message):
+    text = message.text.partition(' ')[2].strip()
+    if text:
+        msg, markup = await find_words(message.chat.id, text, 0)
+        await bot.send_message(message.chat.id, msg, reply_markup=markup)
+    else:
+        await bot.set_state(message.from_user.id, MyStates.waiting_for_search, message.chat.id)
+        await bot.send_message(message.chat.id, 'Введите слово или его начало. Чтобы посмотреть весь словарь, '
+                                                'отправьте *', reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для запроса поиска, отправленного отдельным сообщением
+@bot.message_handler(content_types=['text'], state=MyStates.waiting_for_search)
+@metrics.handler
+async def search_text(message):
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    text = '' if message.text.strip() == '*' else message.text
+    msg, markup = await find_words(message.chat.id, text, 0)
+    await bot.send_message(message.chat.id, msg, reply_markup=markup or NEXT_MARKUP)
+
+
+# Хэндлер для кнопок листания результатов поиска: страница заменяет текст того же сообщения
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith(SEARCH_CALLBACK))
+@metrics.handler
+async def search_page_button(call):
+    text, page = parse_search_callback(call.data)
+    cid = call.message.chat.id
+    msg, markup = await find_words(cid, text, page)
+    await bot.edit_message_text(msg, cid, call.message.message_id, reply_markup=markup)
+    await bot.answer_callback_query(call.id)
+
+
+# Хэндлер для inline запросов @бот <запрос>: поиск по словарю пользователя, следующие страницы
+# Telegram запрашивает сам со смещением next_offset
+@bot.inline_handler(func=lambda query: True)
+@metrics.handler
+async def inline_search(query):
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    async with async_db.get_connection() as conn:
+        words, total = await async_db.search_words(conn, query.from_user.id, query.query, SEARCH_INLINE_LIMIT,
+                                                   offset)
+    next_offset = str(offset + len(words)) if words and offset + len(words) < total else ''
+    await bot.answer_inline_query(query.id, inline_results(words), cache_time=0, is_personal=True,
+                                  next_offset=next_offset)
+
+
+# Хэндлер для статистики пользователя: ответы, которые еще не записаны в БД, учитываются из буфера
+@bot.message_handler(commands=['stats'])
+@metrics.handler
+async def stats(message):
+    cid = message.chat.id
+    async with async_db.get_connection() as conn:
+        user_stats = await async_db.find_stats(conn, cid)
+    if user_stats is None:
+        await bot.send_message(cid, 'Мы не нашли вас в базе данных. Нажмите /start', reply_markup=START_MARKUP)
+    else:
+        await bot.send_message(cid, stats_text(user_stats, answer_buffer.pending(cid)))
+
+
+# Хэндлер для таблицы лидеров
+@bot.message_handler(commands=['top'])
+@metrics.handler
+async def leaderboard(message):
+    async with async_db.get_connection() as conn:
+        rows = await async_db.find_leaderboard(conn, LEADERBOARD_SIZE)
+    await bot.send_message(message.chat.id, leaderboard_text(rows, message.chat.id))
+
+
+# Хэндлер для выгрузки словаря: формат можно передать после команды (/export jsonl)
+@bot.message_handler(commands=['export'])
+@metrics.handler
+async def export_dictionary(message):
+    fmt = message.text.partition(' ')[2].strip().lower() or 'csv'
+    if fmt not in transfer.FORMATS:
+        await bot.reply_to(message, 'Формат выгрузки: ' + ', '.join(transfer.FORMATS))
+        return
+    # Выгрузка читает БД синхронно - выполняем ее в отдельном потоке
+    f, count = await asyncio.to_thread(transfer.export_to_tempfile, message.chat.id, fmt)
+    with f:
+        await bot.send_document(message.chat.id, f, visible_file_name=f'words.{fmt}',
+                                caption=f'Слов в выгрузке - {count}. Загрузить словарь обратно: /import')
+
+
+# Хэндлер для загрузки словаря из файла выгрузки
+@bot.message_handler(commands=['import'])
+@metrics.handler
+async def import_dictionary(message):
+    await bot.set_state(message.from_user.id, MyStates.waiting_for_import, message.chat.id)
+    await bot.send_message(message.chat.id, 'Отправьте файл, полученный командой /export (.csv или .jsonl).',
+                           reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для файла выгрузки словаря
+@bot.message_handler(content_types=['document'], state=MyStates.waiting_for_import)
+@metrics.handler
+async def import_dictionary_file(message):
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    file_info = await bot.get_file(message.document.file_id)
+    # Telegram отдает файл целиком в память, поэтому файл без известного размера не скачиваем
+    file_size = message.document.file_size or file_info.file_size
+    if not file_size or file_size > TRANSFER_MAX_FILE_SIZE:
+        await bot.reply_to(message, f'Можно загрузить файл размером до {TRANSFER_MAX_FILE_SIZE // 2 ** 20} МБ.',
+                           reply_markup=NEXT_MARKUP)
+        return
+    data = await bot.download_file(file_info.file_path)
+    added, skipped = await asyncio.to_thread(transfer.import_bytes, message.chat.id, data,
+                                             transfer.detect_format(message.document.file_name))
+    msg = f'Добавлено слов в словарь - {added}'
+    if skipped:
+        msg = show_hint(msg, f'Пропущено строк с ошибками - {skipped}')
+    await bot.reply_to(message, msg, reply_markup=NEXT_MARKUP)
+
+
+# Хэндлер для кнопки добавить слово
+@bot.message_handler(func=lambda message: message.text == Command.ADD_WORD)
+@metrics.handler
+async def add_word(message):
+    cid = message.chat.id
+    await bot.set_state(message.from_user.id, MyStates.waitng_for_word, cid)
+    await bot.send_message(cid, "Введите слово.", reply_markup=REMOVE_MARKUP)
+
+
+# Хэндлер для кнопки добавить случайное слово
+@bot.message_handler(func=lambda message: message.text == Command.ADD_RAND_WORD)
+@metrics.handler
+async def add_rand_word(message):
+    cid = message.chat.id
+    markup = keyboard(await get_random_word(), Command.ADD_RAND_WORD, Command.CANCEL, one_time=True)
+    await bot.set_state(message.from_user.id, MyStates.waitng_for_word, cid)
+    await bot.send_message(cid, "Введите слово.", reply_markup=markup)
+
+
+# Хэндлер для обработки стейта по добавлению слова в БД
+@bot.message_handler(content_types=["text"], state=MyStates.waitng_for_word)
+@metrics.handler
+async def translate_word(message):
+    word = message.text
+    # Получаем словарь с переводом введенного слова
+    translate_dict = await translate_cached(word)
+
+    # Если что то пошло не так с переводом
+    if not translate_dict:
+        text = 'Не могу перевести слово.' if translate_dict is False else 'Переводчик недоступен, попробуйте позже.'
+        await bot.reply_to(message, text, reply_markup=NEXT_MARKUP)
+    else:
+        word_lang_code = translate_dict['translations'][0]['detectedLanguageCode']
+        translated_word = translate_dict['translations'][0]['text']
+
+        if word_lang_code == 'ru':
+            ru_word = word
+            en_word = translated_word
+        else:
+            ru_word = translated_word
+            en_word = word
+
+        # Устанавливаем стэйт для сохранения пары слов в БД
+        await bot.set_state(message.from_user.id, MyStates.save_word, message.chat.id)
+        async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+            data['ru_word'] = ru_word
+            data['en_word'] = en_word
+        await bot.reply_to(message, f'Добавить пару {ru_word}-{en_word} в словарь?', reply_markup=YES_CANCEL_MARKUP)
+
+
+# Хэндлер для сохранения слов в БД
+@bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.save_word)
+@metrics.handler
+async def save_word(message):
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        ru_word = data.get('ru_word')
+        en_word = data.get('en_word')
+    if ru_word and en_word and message.chat.id and message.text == Command.YES:
+
+        # Сохраняем слово в БД
+        async with async_db.get_connection() as conn:
+            row_count = await async_db.add_words(conn, message.chat.id, ru_word, en_word)
+
+        if row_count:
+            msg = f'{row_count} cлово добавлено.'
+        else:
+            msg = 'Не удалось добавить слово'
+
+        await bot.reply_to(message, msg, reply_markup=NEXT_MARKUP)
+    else:
+        await bot.reply_to(message, 'Что-то пошло не так', reply_markup=NEXT_MARKUP)
+    await bot.delete_state(message.from_user.id, message.chat.id)
+
+# Хэндлер для кнопки удалить слово
+@bot.message_handler(func=lambda message: message.text == Command.DELETE_WORD)
+@metrics.handler
+async def delete_question(message):
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        translate_word = data.get('translate_word') if 'word_id' in data else None
+    # Если есть что удалять
+    if translate_word:
+        await bot.set_state(message.from_user.id, MyStates.delete_word, message.chat.id)
+        await bot.send_message(message.chat.id, f'Удалить слово {translate_word} из словаря?',
+                               reply_markup=YES_CANCEL_MARKUP)
+
+
+# Хэндлер для удаления слова из БД
+@bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.delete_word)
+@metrics.handler
+async def delete_word(message):
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        word_id = data.get('word_id')
+
+    # Если определено слово для удаления
+    if word_id and message.text == Command.YES:
+        async with async_db.get_connection() as conn:
+            count = await async_db.del_word(conn, message.chat.id, word_id)
+        await bot.reply_to(message, f'Удалено слов из словаря - {count}', reply_markup=NEXT_MARKUP)
+    else:
+        await bot.reply_to(message, 'Что-то пошло не так', reply_markup=NEXT_MARKUP)
+    await bot.delete_state(message.from_user.id, message.chat.id)
+
+@bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.check_answer)
+@metrics.handler
+async def message_reply(message):
+    text = message.text
+    async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+        if 'target_word' not in data or 'word_id' not in data:
+            data = None
+        elif text == data['target_word']:
+            # Добавляем 1 к счетчику правильных ответов слова (запись в БД - пачкой в фоне)
+            answer_buffer.add(message.chat.id, data['word_id'], True, answer_latency(data, message))
+            markup = SERVICE_MARKUP
+            hint = show_hint("Отлично!❤", show_target(data))
+        else:
+            # Добавляем 1 к счетчику неправильных ответов слова (запись в БД - пачкой в фоне)
+            answer_buffer.add(message.chat.id, data['word_id'], False, answer_latency(data, message))
+            answers = data.get('answers', [])
+            if text in answers and answers.index(text) not in data['wrong']:
+                data['wrong'].append(answers.index(text))
+            hint = show_hint("Допущена ошибка!",
+                             f"Попробуй ещё раз вспомнить слово {data['translate_word']}")
+            markup = card_markup(answers, data['wrong'])
+    # Ответ отправляем после сохранения данных, чтобы не держать их во время запроса к Telegram
+    if data is None:
+        await main_dialog(message)
+    else:
+        await bot.reply_to(message, hint, reply_markup=markup)
+
+
+# Хэндлер с любым текстом
+@bot.message_handler(content_types=["text"])
+@metrics.handler
+async def random_text(message):
+    await main_dialog(message)
+
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+
+async def run():
+    """
+    Функция запускает бота: открывает пул соединений с БД и обрабатывает обновления до остановки
+    :return: None
+    """
+    await async_db.get_pool()
+    try:
+        await bot.infinity_polling(skip_pending=True)
+    finally:
+        await bot.close_session()
+        await async_http_client.close_session()
+        await async_db.close_pool()
+
+
+# Запись ответов в БД, пополнение пула случайных слов и сборка колод карточек остаются фоновыми потоками:
+# они не задерживают обработчики
+if __name__ == '__main__':
+    answer_buffer.start()
+    random_word_pool.start()
+    card_deck.start()
+    metrics.start_server()
+    asyncio.run(run())
+    card_deck.stop()
+    random_word_pool.stop()
+    answer_buffer.stop()
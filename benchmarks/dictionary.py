@@ -0,0 +1,105 @@
+"""
+Офлайн словарь: время сборки из TSV, размер файла, задержка поиска (слово есть / слова нет)
+в сравнении со словарем Python и память процесса. Словарь собирается из синтетического TSV.
+Запуск из корня проекта: python -m benchmarks.dictionary [--words N]
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+import timeit
+
+from dictionary.dictionary import Dictionary, build, normalize, read_tsv
+
+# Количество поисков в одном замере
+NUMBER = 100000
+# Количество замеров, берется лучший
+REPEAT = 5
+
+
+def memory():
+    """
+    Функция читает память процесса из /proc/self/status: RssAnon - собственная память процесса,
+    RssFile - страницы файлов, в том числе отображенного словаря, общие для всех процессов
+    :return: dict показатель -> МБ или пустой словарь, если /proc недоступен
+    """
+    result = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'RssAnon', 'RssFile'):
+                    result[name] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return result
+
+
+def print_memory(label, before):
+    after = memory()
+    print(f'{label:32} ' + '  '.join(f'{name} {after[name] - before.get(name, 0):+8.1f} МБ' for name in after))
+
+
+def random_word(rnd, alphabet):
+    return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(3, 12)))
+
+
+def write_tsv(path, count, rnd):
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(count):
+            f.write(f"{random_word(rnd, string.ascii_lowercase)}\t{random_word(rnd, 'абвгдеёжзийклмнопрстуфхцчшщыэюя')}\n")
+
+
+def best(func, keys):
+    key = iter(keys * (NUMBER * REPEAT // len(keys) + 1))
+    return min(timeit.repeat(lambda: func(next(key)), number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--words', type=int, default=500000, help='количество пар в TSV')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tsv_path = os.path.join(tmp, 'dump.tsv')
+        dict_path = os.path.join(tmp, 'dictionary.dict')
+        write_tsv(tsv_path, args.words, rnd)
+
+        started = time.perf_counter()
+        count = build(read_tsv(tsv_path), dict_path)
+        print(f'Сборка: {count} записей за {time.perf_counter() - started:.2f} с, '
+              f'файл {os.path.getsize(dict_path) / 2 ** 20:.1f} МБ')
+
+        pairs = list(read_tsv(tsv_path))
+        hits = [normalize(key) for key, _ in rnd.sample(pairs, 10000)]
+        misses = [random_word(rnd, string.ascii_lowercase) + 'zz' for _ in range(10000)]
+
+        before = memory()
+        dictionary = Dictionary(dict_path)
+        print_memory('Открыт mmap словарь', before)
+        for key in hits:
+            assert dictionary.get(key) is not None
+        for key in misses:
+            assert dictionary.get(key) is None
+        mmap_results = (best(dictionary.get, hits), best(dictionary.get, misses))
+        print_memory('После поисков в mmap словаре', before)
+
+        before = memory()
+        loaded = {}
+        for key, value in pairs:
+            loaded.setdefault(normalize(key), value)
+        print_memory('Словарь Python в памяти', before)
+        dict_results = (best(loaded.get, hits), best(loaded.get, misses))
+
+        print(f"{'':12} {'слово есть':>12} {'слова нет':>12}")
+        print(f"{'mmap':12} {mmap_results[0]:9.2f} мкс {mmap_results[1]:9.2f} мкс")
+        print(f"{'dict':12} {dict_results[0]:9.2f} мкс {dict_results[1]:9.2f} мкс")
+        dictionary.close()
+
+
+if __name__ == '__main__':
+    main()
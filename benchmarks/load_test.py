@@ -0,0 +1,625 @@
+"""
+Нагрузочный тест бота: N одновременных пользователей проходят сценарий /start, карточки, ответы,
+добавление и удаление слов через настоящие обработчики main.py и локальную БД Postgres из .env.
+Telegram заменен локальным HTTP сервером: обновления в формате Telegram подаются в UpdateDispatcher,
+как в режиме вебхука, а все запросы бота к Bot API принимает заглушка. Яндекс переводчик
+и сервис случайных слов тоже заменены локальными заглушками.
+Отчет: p50/p95/p99 задержек обработчиков, функций db.db и действий пользователя (от отправки
+обновления до ответа бота), сообщений в секунду и запросов к БД на обновление. С --output отчет
+сохраняется в JSON, с --compare печатается сравнение с предыдущим отчетом.
+Запуск из корня проекта: python -m benchmarks.load_test --users 50 --rounds 20 --output run.json
+"""
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import inspect
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from telebot import apihelper, types
+
+from dialog.dialog import Command
+from outbox.outbox import TokenBucket
+from state_storage.state_storage import SQLiteStateStorage
+from webhook.webhook import UpdateDispatcher
+
+# Количество слов в словаре заглушек переводчика и сервиса случайных слов
+VOCABULARY = 5000
+# Префикс слов заглушек: по нему данные теста удаляются из БД
+WORD_PREFIX = 'loadtest'
+# Номер первого пользователя теста, пользователи получают номера подряд
+FIRST_USER_ID = 7_000_000_000
+# Сколько секунд пользователь ждет ответа бота
+REPLY_TIMEOUT = 30
+# Вероятности действий пользователя после ответа на карточку
+P_RIGHT = 0.7
+P_ADD_WORD = 0.15
+P_ADD_RAND_WORD = 0.05
+P_DELETE_WORD = 0.1
+# Функции db.db, которые не замеряются: управление соединениями и схемой
+NOT_MEASURED = ('create_db_connection', 'get_pool', 'close_pool', 'get_connection', 'create_tables')
+
+# Записанное обновление Telegram с текстовым сообщением, в него подставляются пользователь и текст
+UPDATE_TEMPLATE = {
+    'update_id': 0,
+    'message': {
+        'message_id': 0,
+        'from': {'id': 0, 'is_bot': False, 'first_name': 'Load', 'language_code': 'ru'},
+        'chat': {'id': 0, 'first_name': 'Load', 'type': 'private'},
+        'date': 0,
+        'text': '',
+    },
+}
+
+
+def percentile(values, q):
+    """
+    Функция вычисляет процентиль методом ближайшего ранга
+    :param values: отсортированный list значений
+    :param q: процентиль от 0 до 100
+    :return: значение процентиля
+    """
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Recorder:
+    """
+    Замеры длительности по группам ('handlers', 'db', ...) и именам
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(lambda: defaultdict(list))
+
+    def add(self, group, name, seconds):
+        with self._lock:
+            self.samples[group][name].append(seconds)
+
+    def timed(self, group, name, func):
+        """
+        Функция оборачивает func замером длительности каждого вызова
+        :return: обернутая функция
+        """
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(group, name, time.perf_counter() - started)
+        wrapper.__name__ = func.__name__
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def summary(self, group, scale=1000):
+        """
+        Функция сводит замеры группы
+        :param group: имя группы
+        :param scale: множитель единиц, по умолчанию секунды переводятся в миллисекунды
+        :return: словарь {имя: {count, mean, p50, p95, p99, max}}
+        """
+        result = {}
+        with self._lock:
+            items = [(name, sorted(values)) for name, values in self.samples[group].items()]
+        for name, values in sorted(items):
+            result[name] = {
+                'count': len(values),
+                'mean': round(sum(values) / len(values) * scale, 3),
+                'p50': round(percentile(values, 50) * scale, 3),
+                'p95': round(percentile(values, 95) * scale, 3),
+                'p99': round(percentile(values, 99) * scale, 3),
+                'max': round(values[-1] * scale, 3),
+            }
+        return result
+
+
+class TelegramSink:
+    """
+    Заглушка Bot API: принимает запросы бота и раскладывает отправленные сообщения по чатам
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._chats = defaultdict(deque)
+        self._message_ids = itertools.count(1)
+        self.methods = defaultdict(int)
+
+    def call(self, method, params):
+        """
+        Функция выполняет метод Bot API
+        :param method: имя метода ('sendMessage', 'getMe', ...)
+        :param params: словарь параметров запроса
+        :return: поле result ответа Telegram
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        now = time.perf_counter()
+        with self._cond:
+            self.methods[method] += 1
+        if method == 'getMe':
+            return {'id': 1000, 'is_bot': True, 'first_name': 'EnglishCard', 'username': 'load_test_bot'}
+        if method != 'sendMessage':
+            return True
+        chat_id = int(params['chat_id'])
+        markup = params.get('reply_markup')
+        message = {'text': params.get('text', ''), 'reply_markup': json.loads(markup) if markup else None, 'at': now}
+        with self._cond:
+            self._chats[chat_id].append(message)
+            self._cond.notify_all()
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': message['text']}
+
+    def wait(self, chat_id, predicate, timeout=REPLY_TIMEOUT):
+        """
+        Функция ждет сообщение бота в чат, подходящее под predicate, предыдущие сообщения пропускаются
+        :param chat_id: id чата
+        :param predicate: функция от словаря сообщения
+        :param timeout: сколько секунд ждать
+        :return: словарь сообщения с ключами text, reply_markup, at или None если не дождались
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while True:
+                messages = self._chats[chat_id]
+                while messages:
+                    message = messages.popleft()
+                    if predicate(message):
+                        return message
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
+    def sent(self):
+        with self._cond:
+            return self.methods['sendMessage']
+
+
+def is_cyrillic(text):
+    return any('\u0400' <= char <= '\u04ff' for char in text)
+
+
+def stub_translate(body):
+    """
+    Функция отвечает как Яндекс переводчик: перевод - слово с пометкой языка
+    :param body: словарь тела запроса translate/v2/translate
+    :return: словарь ответа
+    """
+    texts = body['texts'] if isinstance(body['texts'], list) else [body['texts']]
+    translations = []
+    for text in texts:
+        source = body.get('sourceLanguageCode') or ('ru' if is_cyrillic(text) else 'en')
+        translated = f'перевод-{text}' if body['targetLanguageCode'] == 'ru' else f'{WORD_PREFIX}-{text}'
+        translations.append({'text': translated, 'detectedLanguageCode': source})
+    return {'translations': translations}
+
+
+def make_stub_handler(sink, delay, vocabulary):
+    """
+    Функция создает обработчик HTTP запросов заглушек: Bot API, Яндекс переводчика и сервиса случайных слов
+    """
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def _reply(self, data):
+            body = json.dumps(data, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            parts = url.path.strip('/').split('/')
+            if parts[0].startswith('bot'):
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                self._reply({'ok': True, 'result': sink.call(parts[-1], params)})
+                return
+            if delay:
+                time.sleep(delay)
+            if parts[-1] == 'translate':
+                self._reply(stub_translate(json.loads(body)))
+            elif parts[-1] == 'detect':
+                self._reply({'languageCode': 'ru' if is_cyrillic(json.loads(body)['text']) else 'en'})
+            elif parts[-1] == 'word':
+                self._reply(random.sample(vocabulary, int(params.get('number', 1))))
+            else:
+                self.send_response(404)
+                self.end_headers()
+
+        do_GET = do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+class QueryCounter:
+    """
+    Счетчик запросов к БД: запросы потоков обработки обновлений считаются на обновление,
+    запросы фоновых потоков (буфер ответов, колоды, запас слов) - отдельно
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.foreground = 0
+        self.background = 0
+
+    def count(self):
+        if getattr(self._local, 'queries', None) is not None:
+            self._local.queries += 1
+            with self._lock:
+                self.foreground += 1
+        else:
+            with self._lock:
+                self.background += 1
+
+    def begin(self):
+        self._local.queries = 0
+
+    def end(self):
+        queries, self._local.queries = self._local.queries, None
+        return queries
+
+
+class VirtualUser:
+    """
+    Пользователь теста: отправляет обновление и ждет ответ бота, длительность каждого шага записывается в группу 'actions'
+    """
+
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = random.Random(user_id)
+        self.errors = 0
+
+    def step(self, name, text, predicate):
+        """
+        Функция отправляет текст боту и ждет подходящий ответ
+        :return: словарь сообщения бота или None если бот не ответил
+        """
+        started = time.perf_counter()
+        self.harness.inject(self.user_id, text)
+        message = self.harness.sink.wait(self.user_id, predicate)
+        if message is None:
+            self.errors += 1
+            return None
+        self.harness.recorder.add('actions', name, message['at'] - started)
+        return message
+
+    def answer_card(self):
+        data = self.harness.card_data(self.user_id)
+        target, answers = data.get('target_word'), data.get('answers', [])
+        if target is None:
+            return False
+        wrong = [answer for answer in answers if answer != target]
+        if wrong and self.rng.random() > P_RIGHT:
+            if self.step('answer_wrong', self.rng.choice(wrong), has_text('Допущена ошибка')) is None:
+                return False
+        return self.step('answer_right', target, has_text('Отлично')) is not None
+
+    def add_word(self, rand=False):
+        if rand:
+            # Случайное слово - первая кнопка клавиатуры
+            message = self.step('add_rand_word', Command.ADD_RAND_WORD, has_text('Введите слово'))
+            if message is None:
+                return False
+            word = message['reply_markup']['keyboard'][0][0]['text']
+        else:
+            if self.step('add_word', Command.ADD_WORD, has_text('Введите слово')) is None:
+                return False
+            word = self.rng.choice(self.harness.vocabulary)
+        if self.step('translate_word', word, has_text('Добавить пару')) is None:
+            return False
+        return self.step('save_word', Command.YES, has_text('добавлено', 'Не удалось добавить')) is not None
+
+    def delete_word(self):
+        if self.step('delete_question', Command.DELETE_WORD, has_text('Удалить слово')) is None:
+            return False
+        return self.step('delete_word', Command.YES, has_text('Удалено слов')) is not None
+
+    def run(self, rounds):
+        if self.step('start', '/start', has_text('Как тебя зовут')) is None:
+            return
+        if self.step('create_user', f'Load {self.user_id}', is_card) is None:
+            return
+        for _ in range(rounds):
+            if not self.answer_card():
+                return
+            action = self.rng.random()
+            if action < P_ADD_WORD:
+                done = self.add_word()
+            elif action < P_ADD_WORD + P_ADD_RAND_WORD:
+                done = self.add_word(rand=True)
+            elif action < P_ADD_WORD + P_ADD_RAND_WORD + P_DELETE_WORD:
+                done = self.delete_word()
+            else:
+                done = True
+            if not done or self.step('next', Command.NEXT, is_card) is None:
+                return
+
+
+def has_text(*parts):
+    return lambda message: any(part in message['text'] for part in parts)
+
+
+def is_card(message):
+    return message['text'].startswith('Выбери перевод слова')
+
+
+class Harness:
+    """
+    Окружение теста: заглушки, бот из main.py с замерами и пул обработки обновлений
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.recorder = Recorder()
+        self.queries = QueryCounter()
+        self.sink = TelegramSink(args.stub_delay)
+        rng = random.Random(args.seed)
+        self.vocabulary = [f'{WORD_PREFIX}{rng.randrange(10 ** 6):06d}' for _ in range(VOCABULARY)]
+        self._update_ids = itertools.count(1)
+        self._updates_lock = threading.Lock()
+        self.rejected = 0
+        self.queries_per_update = []
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(self.sink, args.stub_delay, self.vocabulary))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.server = server
+        stub_url = f'http://127.0.0.1:{server.server_port}'
+        # Адреса заглушек читаются при импорте модулей бота, поэтому main и db импортируются только здесь
+        os.environ['TELEGRAM_TOKEN'] = '1000:LOAD-TEST'
+        os.environ['YANDEX_TRANSLATE_URL'] = stub_url + '/translate/v2'
+        os.environ['RANDOM_WORD_URL'] = stub_url + '/word'
+        apihelper.API_URL = stub_url + '/bot{0}/{1}'
+        import main
+        self.main = main
+        self.state_dir = tempfile.TemporaryDirectory()
+        main.bot.current_states = SQLiteStateStorage(os.path.join(self.state_dir.name, 'states.sqlite3'))
+        self.dispatcher = UpdateDispatcher(main.bot, args.workers)
+        if args.outbox_workers:
+            main.outbox.workers = args.outbox_workers
+        if not args.telegram_limits:
+            self._lift_limits(main.outbox)
+        self._instrument()
+
+    @staticmethod
+    def _lift_limits(outbox):
+        # Заглушка не ограничивает скорость, поэтому ограничения Telegram в очереди отправки снимаются
+        outbox.chat_rate = outbox.chat_burst = outbox.group_rate = 1e9
+        outbox._global = TokenBucket(1e9, 1e9)
+
+    def _instrument(self):
+        import db.db
+
+        queries = self.queries
+
+        class CountingCursor(db.db.CountingCursor):
+            def execute(self, query, params=None):
+                queries.count()
+                return super().execute(query, params)
+
+            def executemany(self, query, params_list):
+                queries.count()
+                return super().executemany(query, params_list)
+
+        checkout = db.db._checkout
+
+        def counting_checkout(pool):
+            conn = checkout(pool)
+            conn.cursor_factory = CountingCursor
+            return conn
+        db.db._checkout = counting_checkout
+
+        # Функции db.db импортированы в модули бота по имени, поэтому заменяются везде, где встречаются
+        originals = {name: func for name, func in vars(db.db).items()
+                     if inspect.isfunction(func) and func.__module__ == 'db.db'
+                     and not name.startswith('_') and name not in NOT_MEASURED}
+        for name, func in originals.items():
+            wrapped = self.recorder.timed('db', name, func)
+            for module in list(sys.modules.values()):
+                if getattr(module, name, None) is func:
+                    setattr(module, name, wrapped)
+
+        bot = self.main.bot
+        for handler in bot.message_handlers:
+            handler['function'] = self.recorder.timed('handlers', handler['function'].__name__, handler['function'])
+
+        process = bot.process_new_updates
+
+        def process_new_updates(updates):
+            queries.begin()
+            started = time.perf_counter()
+            try:
+                process(updates)
+            finally:
+                self.recorder.add('update', 'process_new_updates', time.perf_counter() - started)
+                count = queries.end()
+                with self._updates_lock:
+                    self.queries_per_update.append(count)
+        bot.process_new_updates = process_new_updates
+
+    def inject(self, user_id, text):
+        """
+        Функция подает в пул обработки обновление с сообщением пользователя, как вебхук
+        """
+        update = json.loads(json.dumps(UPDATE_TEMPLATE))
+        update['update_id'] = next(self._update_ids)
+        message = update['message']
+        message['message_id'] = update['update_id']
+        message['from']['id'] = message['chat']['id'] = user_id
+        message['date'] = int(time.time())
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        update = types.Update.de_json(update)
+        # Заполненная очередь означает ответ 503 вебхука: Telegram повторит доставку
+        while not self.dispatcher.submit(update):
+            with self._updates_lock:
+                self.rejected += 1
+            time.sleep(0.05)
+
+    def card_data(self, user_id):
+        bot = self.main.bot
+        return bot.current_states.get_data(user_id, user_id, bot_id=bot.bot_id)
+
+    def cleanup(self):
+        """
+        Функция удаляет из БД пользователей и слова теста
+        """
+        from db.db import get_connection
+
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                for table in ('users', 'answers'):
+                    cur.execute(f'DELETE FROM {table} WHERE user_id BETWEEN %s AND %s',
+                                (self.args.first_user, self.args.first_user + self.args.users - 1))
+                cur.execute("DELETE FROM translations WHERE source_text LIKE %s", (WORD_PREFIX + '%',))
+                cur.execute("DELETE FROM random_words WHERE word LIKE %s", (WORD_PREFIX + '%',))
+                cur.execute("""
+                        DELETE FROM words w
+                         WHERE (w.en_word LIKE %s OR w.rus_word LIKE %s)
+                           AND NOT EXISTS (SELECT 1 FROM userwords uw WHERE uw.word_id = w.word_id)
+                        """, (WORD_PREFIX + '%', 'перевод-' + WORD_PREFIX + '%'))
+            conn.commit()
+
+    def run(self):
+        """
+        Функция прогоняет сценарий всеми пользователями одновременно и возвращает отчет
+        :return: словарь отчета
+        """
+        from card_deck.card_deck import card_deck
+        from db.answer_buffer import answer_buffer
+        from random_word.pool import random_word_pool
+
+        main, args = self.main, self.args
+        self.cleanup()
+        answer_buffer.start()
+        random_word_pool.start()
+        card_deck.start()
+        main.outbox.start()
+        self.dispatcher.start()
+
+        users = [VirtualUser(self, args.first_user + i) for i in range(args.users)]
+        threads = [threading.Thread(target=user.run, args=(args.rounds,), daemon=True) for user in users]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+
+        self.dispatcher.stop()
+        main.outbox.stop()
+        card_deck.stop()
+        random_word_pool.stop()
+        answer_buffer.stop()
+        report = self.report(duration, sum(user.errors for user in users))
+        if not args.keep_data:
+            self.cleanup()
+        self.server.shutdown()
+        return report
+
+    def report(self, duration, errors):
+        from card_deck.card_deck import card_deck
+
+        args, recorder = self.args, self.recorder
+        updates = len(self.queries_per_update)
+        messages = self.sink.sent()
+        per_update = sorted(self.queries_per_update) or [0]
+        return {
+            'config': {'users': args.users, 'rounds': args.rounds, 'workers': args.workers,
+                       'outbox_workers': self.main.outbox.workers, 'seed': args.seed,
+                       'stub_delay': args.stub_delay, 'telegram_limits': args.telegram_limits},
+            'duration': round(duration, 3),
+            'updates': updates,
+            'messages': messages,
+            'updates_per_second': round(updates / duration, 1),
+            'messages_per_second': round(messages / duration, 1),
+            'errors': errors,
+            'rejected_updates': self.rejected,
+            'db_queries': {
+                'foreground': self.queries.foreground,
+                'background': self.queries.background,
+                'per_update_mean': round(self.queries.foreground / max(updates, 1), 3),
+                'per_update_p95': percentile(per_update, 95),
+                'per_update_max': per_update[-1],
+                'per_message': round((self.queries.foreground + self.queries.background) / max(messages, 1), 3),
+            },
+            'update': recorder.summary('update'),
+            'handlers': recorder.summary('handlers'),
+            'db': recorder.summary('db'),
+            'actions': recorder.summary('actions'),
+            'outbox': self.main.outbox.metrics(),
+            'card_deck': card_deck.metrics(),
+        }
+
+
+def print_report(report, previous=None):
+    """
+    Функция печатает отчет, а если передан предыдущий отчет - изменение p50 и p95 относительно него
+    """
+    print(f"{report['config']['users']} пользователей, {report['updates']} обновлений за {report['duration']} с: "
+          f"{report['updates_per_second']} обновлений/с, {report['messages_per_second']} сообщений/с, "
+          f"ошибок {report['errors']}")
+    queries = report['db_queries']
+    print(f"Запросов к БД на обновление: в среднем {queries['per_update_mean']}, p95 {queries['per_update_p95']}, "
+          f"max {queries['per_update_max']}; фоновых запросов {queries['background']}, "
+          f"всего на сообщение {queries['per_message']}")
+    for group, title in (('update', 'Обновление'), ('handlers', 'Обработчики'), ('db', 'Функции db.db'),
+                         ('actions', 'Действия пользователя (до ответа бота)')):
+        print(f'\n{title}, мс')
+        print(f'  {"":36} {"count":>7} {"p50":>7} {"p95":>7} {"p99":>7} {"max":>7}')
+        for name, row in report[group].items():
+            line = f"  {name:36} {row['count']:7} {row['p50']:7.2f} {row['p95']:7.2f} {row['p99']:7.2f} {row['max']:7.2f}"
+            old = (previous or {}).get(group, {}).get(name)
+            if old:
+                line += f"   p50 {row['p50'] - old['p50']:+.2f} p95 {row['p95'] - old['p95']:+.2f}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест обработчиков бота на локальной БД')
+    parser.add_argument('--users', type=int, default=20, help='количество одновременных пользователей')
+    parser.add_argument('--rounds', type=int, default=20, help='количество карточек на пользователя')
+    parser.add_argument('--workers', type=int, default=8, help='количество обработчиков обновлений')
+    parser.add_argument('--outbox-workers', type=int, help='количество потоков отправки сообщений')
+    parser.add_argument('--seed', type=int, default=1, help='зерно словаря заглушек')
+    parser.add_argument('--first-user', type=int, default=FIRST_USER_ID, help='номер первого пользователя теста')
+    parser.add_argument('--stub-delay', type=float, default=0, help='задержка ответа заглушек, с')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='оставить ограничения скорости отправки Telegram в очереди сообщений')
+    parser.add_argument('--keep-data', action='store_true', help='не удалять данные теста из БД')
+    parser.add_argument('--output', help='файл для отчета в JSON')
+    parser.add_argument('--compare', help='отчет предыдущего запуска в JSON для сравнения')
+    args = parser.parse_args()
+
+    report = Harness(args).run()
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Сравнение построения и сериализации клавиатуры карточки: объектами telebot
+(ReplyKeyboardMarkup, KeyboardButton, to_json) и сборкой готового JSON из dialog.dialog.card_markup.
+Запуск из корня проекта: python -m benchmarks.markup
+"""
+import itertools
+import json
+import random
+import timeit
+
+from telebot import types
+
+from config import OTHER_WORDS_COUNT
+from dialog.dialog import Command, card_markup
+
+# Количество построений клавиатуры в одном замере
+NUMBER = 20000
+# Количество замеров, берется лучший
+REPEAT = 5
+# Количество различных слов, из которых составляются карточки
+VOCABULARY = 2000
+
+
+def old_card_markup(answers, wrong=()):
+    """
+    Функция строит клавиатуру карточки так, как это делалось до кэша клавиатур
+    :param answers: list вариантов ответа
+    :param wrong: номера неправильно выбранных вариантов
+    :return: str JSON клавиатуры
+    """
+    markup = types.ReplyKeyboardMarkup(row_width=2)
+    buttons = [types.KeyboardButton(word + '❌' if i in wrong else word) for i, word in enumerate(answers)]
+    buttons.extend([types.KeyboardButton(Command.NEXT), types.KeyboardButton(Command.ADD_WORD),
+                    types.KeyboardButton(Command.ADD_RAND_WORD), types.KeyboardButton(Command.DELETE_WORD)])
+    markup.add(*buttons)
+    return markup.to_json()
+
+
+def main():
+    words = [f'слово{i}' for i in range(VOCABULARY)]
+    cards = [random.sample(words, OTHER_WORDS_COUNT + 1) for _ in range(1000)]
+
+    # Результаты обоих способов должны совпадать
+    for answers in cards[:100]:
+        for wrong in ((), (0,), (1, 3)):
+            assert json.loads(old_card_markup(answers, wrong)) == json.loads(card_markup(answers, wrong))
+
+    for name, wrong in (('карточка', ()), ('повтор с ❌', (1, 3))):
+        results = {}
+        for label, build in (('telebot', old_card_markup), ('card_markup', card_markup)):
+            card = itertools.cycle(cards)
+            best = min(timeit.repeat(lambda: build(next(card), wrong), number=NUMBER, repeat=REPEAT))
+            results[label] = best / NUMBER * 1e6
+        print(f"{name:12} telebot {results['telebot']:7.2f} мкс  card_markup {results['card_markup']:6.2f} мкс  "
+              f"ускорение x{results['telebot'] / results['card_markup']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Сравнение выборки неправильных вариантов ответа через ORDER BY RANDOM()
+и через случайные пробы индекса (user_id, rand_key) на словарях разного размера.
+Запуск из корня проекта: python -m benchmarks.random_sampling
+Бенчмарк создает временных пользователей с отрицательными id и удаляет их по окончании.
+"""
+import time
+
+from db.db import get_connection, take_other_words
+
+# Размеры словаря пользователя
+SIZES = [10, 100, 1000, 10000, 100000]
+# Количество повторов запроса для каждого размера
+REPEATS = 50
+# Количество выбираемых слов
+COUNT = 5
+# Префикс синтетических слов бенчмарка
+PREFIX = 'bench_'
+
+OLD_QUERY = """
+    SELECT w.en_word
+      FROM words w
+      JOIN userwords uw
+        ON w.word_id = uw.word_id
+     WHERE uw.user_id = %s AND w.en_word <> %s
+     ORDER BY RANDOM() LIMIT %s
+    """
+
+
+def prepare(conn, size):
+    """
+    Функция создает пользователя с синтетическим словарем заданного размера
+    :param conn: объект connection
+    :param size: количество слов в словаре
+    :return: id пользователя
+    """
+    user_id = -size
+    with conn.cursor() as cur:
+        cur.execute("""
+                INSERT INTO words (rus_word, en_word)
+                SELECT %s || 'ru' || i, %s || 'en' || i
+                  FROM generate_series(1, %s) AS i
+                ON CONFLICT ON CONSTRAINT ru_en
+                DO NOTHING
+                """, (PREFIX, PREFIX, size))
+        cur.execute("""
+                INSERT INTO users (user_id, name)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id)
+                DO NOTHING
+                """, (user_id, PREFIX + str(size)))
+        cur.execute("""
+                INSERT INTO userwords (user_id, word_id)
+                SELECT %s, word_id
+                  FROM words
+                 WHERE en_word IN (SELECT %s || 'en' || i FROM generate_series(1, %s) AS i)
+                ON CONFLICT ON CONSTRAINT user_word
+                DO NOTHING
+                """, (user_id, PREFIX, size))
+        cur.execute('ANALYZE userwords')
+    conn.commit()
+    return user_id
+
+
+def cleanup(conn):
+    """
+    Функция удаляет пользователей и слова бенчмарка
+    :param conn: объект connection
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM users WHERE user_id < 0 AND name LIKE %s', (PREFIX + '%',))
+        cur.execute('DELETE FROM words WHERE en_word LIKE %s', (PREFIX + '%',))
+    conn.commit()
+
+
+def measure(func):
+    """
+    Функция замеряет среднее время выполнения func в миллисекундах
+    :param func: функция без параметров
+    :return: среднее время одного вызова, мс
+    """
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func()
+    return (time.perf_counter() - start) * 1000 / REPEATS
+
+
+def run():
+    with get_connection() as conn:
+        try:
+            print(f"{'слов':>8} {'RANDOM(), мс':>14} {'rand_key, мс':>14}")
+            for size in SIZES:
+                user_id = prepare(conn, size)
+                ex_word = PREFIX + 'en1'
+
+                def old():
+                    with conn.cursor() as cur:
+                        cur.execute(OLD_QUERY, (user_id, ex_word, COUNT))
+                        cur.fetchall()
+
+                def new():
+                    take_other_words(conn, user_id, ex_word, 'en', COUNT)
+
+                print(f'{size:>8} {measure(old):>14.3f} {measure(new):>14.3f}')
+                conn.rollback()
+        finally:
+            cleanup(conn)
+
+
+if __name__ == '__main__':
+    run()
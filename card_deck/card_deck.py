@@ -0,0 +1,211 @@
+from collections import deque
+import atexit
+import random
+import threading
+import time
+
+from config import CARD_DECK_DEPTH, CARD_DECK_IDLE, CARD_DECK_WORKERS, OTHER_WORDS_COUNT
+from db.answer_buffer import answer_buffer
+from db.db import get_connection, build_card
+from db.vocab_cache import vocab_cache
+from dialog.dialog import prepare_card
+from metrics import metrics
+
+
+class _Deck:
+    __slots__ = ('cards', 'version', 'used_at', 'refilling', 'answered')
+
+    def __init__(self):
+        self.cards = deque()
+        # Номер версии словаря: карточки, собранные до изменения словаря, в колоду не попадают
+        self.version = 0
+        self.used_at = time.monotonic()
+        # Количество идущих пополнений и слова, на которые пришел ответ во время пополнения:
+        # карточки с этими словами собраны по старому расписанию и в колоду не попадают
+        self.refilling = 0
+        self.answered = set()
+
+
+class CardDeck:
+    """
+    Колоды готовых карточек активных пользователей. Фоновые потоки держат для каждого пользователя
+    depth карточек, собранных заранее, поэтому "Дальше" только достает карточку из памяти.
+    Новое или удаленное слово сбрасывает колоду и запускает ее пересборку. Ответ меняет расписание только
+    одного слова, поэтому из колоды убираются лишь карточки с этим словом.
+    Колоды пользователей, которые не брали карточки дольше idle секунд, удаляются
+    """
+
+    def __init__(self, depth=CARD_DECK_DEPTH, idle=CARD_DECK_IDLE, workers=CARD_DECK_WORKERS):
+        self.depth = depth
+        self.idle = idle
+        self.workers = workers
+        self._decks = {}
+        # Пользователи, чьи колоды ждут пополнения
+        self._pending = deque()
+        self._pending_set = set()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        self._last_sweep = time.monotonic()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'dropped': 0, 'built': 0, 'evicted': 0}
+        vocab_cache.add_listener(self.invalidate)
+
+    def _schedule(self, user_id):
+        if user_id not in self._pending_set:
+            self._pending_set.add(user_id)
+            self._pending.append(user_id)
+            self._cond.notify()
+
+    def pop(self, user_id):
+        """
+        Функция достает следующую готовую карточку пользователя и запускает пополнение колоды
+        :param user_id: номер пользователя в telegram
+        :return: словарь из dialog.prepare_card или None если готовой карточки нет
+        """
+        with self._cond:
+            deck = self._decks.get(user_id)
+            if deck is None:
+                deck = self._decks[user_id] = _Deck()
+            deck.used_at = time.monotonic()
+            card = deck.cards.popleft() if deck.cards else None
+            self.stats['hits' if card is not None else 'misses'] += 1
+            if self.depth > 0:
+                self._schedule(user_id)
+            return card
+
+    def invalidate(self, user_id, word_id=None):
+        """
+        Функция обновляет колоду пользователя после изменения его словаря
+        :param user_id: номер пользователя в telegram
+        :param word_id: слово, на которое пришел ответ: убираются только карточки с ним.
+        None - колода сбрасывается целиком
+        :return: None
+        """
+        with self._cond:
+            deck = self._decks.get(user_id)
+            if deck is None:
+                return
+            if word_id is None:
+                deck.cards.clear()
+                deck.version += 1
+                self.stats['invalidations'] += 1
+            else:
+                if deck.refilling:
+                    deck.answered.add(word_id)
+                cards = [card for card in deck.cards if card['word_id'] != word_id]
+                if len(cards) == len(deck.cards):
+                    return
+                self.stats['dropped'] += len(deck.cards) - len(cards)
+                deck.cards = deque(cards)
+            self._schedule(user_id)
+
+    def _end_refill(self, deck):
+        deck.refilling -= 1
+        answered = deck.answered
+        if not deck.refilling:
+            deck.answered = set()
+        return answered
+
+    def refill(self, user_id):
+        """
+        Функция собирает недостающие карточки колоды пользователя
+        :param user_id: номер пользователя в telegram
+        :return: количество добавленных карточек
+        """
+        with self._cond:
+            deck = self._decks.get(user_id)
+            if deck is None:
+                return 0
+            need = self.depth - len(deck.cards)
+            version = deck.version
+            deck.refilling += 1
+        cards = []
+        try:
+            if need > 0:
+                with get_connection() as conn:
+                    for _ in range(need):
+                        # Направление перевода выбирается для каждой карточки случайно
+                        lang = random.choice(['ru', 'en'])
+                        card = build_card(conn, user_id, lang, OTHER_WORDS_COUNT, answer_buffer.pending)
+                        # Пользователя нет в БД: карточки для него не собираем
+                        if card is None or card['user_name'] is None:
+                            break
+                        cards.append(prepare_card(card, lang))
+        except BaseException:
+            with self._cond:
+                self._end_refill(deck)
+            raise
+        with self._cond:
+            answered = self._end_refill(deck)
+            if self._decks.get(user_id) is not deck or deck.version != version:
+                return 0
+            cards = [card for card in cards if card['word_id'] not in answered][:self.depth - len(deck.cards)]
+            deck.cards.extend(cards)
+            self.stats['built'] += len(cards)
+            return len(cards)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for user_id in [user_id for user_id, deck in self._decks.items() if now - deck.used_at > self.idle]:
+            del self._decks[user_id]
+            self.stats['evicted'] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait(self.idle)
+                    now = time.monotonic()
+                    if now - self._last_sweep > self.idle:
+                        self._sweep(now)
+                if self._stopped:
+                    return
+                user_id = self._pending.popleft()
+                self._pending_set.discard(user_id)
+            try:
+                self.refill(user_id)
+            except Exception as e:
+                print(f'Не удалось собрать карточки пользователя {user_id}: {e}')
+
+    def metrics(self):
+        """
+        Функция возвращает счетчики колод и долю карточек, выданных из готовых колод
+        :return: словарь
+        """
+        with self._cond:
+            stats = dict(self.stats)
+            stats['users'] = len(self._decks)
+            stats['cards'] = sum(len(deck.cards) for deck in self._decks.values())
+            stats['pending'] = len(self._pending)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        return stats
+
+    def start(self):
+        """
+        Функция запускает потоки сборки карточек
+        :return: None
+        """
+        if not self._threads:
+            self._stopped = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'card-deck-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Функция останавливает потоки сборки карточек
+        :return: None
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+card_deck = CardDeck()
+metrics.collect('card_deck', card_deck.metrics)
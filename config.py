@@ -1,3 +1,5 @@
+import os
+
 # Путь к файлу activate_this на хостинге
 ACTIVATE_THIS_PATH = '/home/a1145532/enrubot-env/bin/activate_this.py'
 
@@ -17,3 +19,136 @@ START_WORDS = [
 
 # Количество неправильных слов, выдаваемых пользователю
 OTHER_WORDS_COUNT = 5
+
+# Минимальное и максимальное количество соединений в пуле БД
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+
+# Сколько секунд ждать свободное соединение из пула
+POOL_TIMEOUT = 5
+
+# Через сколько секунд простоя соединение проверяется запросом перед выдачей из пула
+POOL_HEALTH_CHECK_IDLE = 60
+
+# Во сколько раз больше случайных проб словаря делать, чем нужно неправильных вариантов ответа
+# (часть проб попадает в одно и то же слово)
+SAMPLE_PROBES_FACTOR = 2
+
+# Ответы пользователей копятся в памяти и дописываются в журнал answers одной командой COPY:
+# когда накопится ANSWER_FLUSH_SIZE ответов или пройдет ANSWER_FLUSH_INTERVAL секунд.
+# ANSWER_FLUSH_INTERVAL - сколько секунд ответов можно потерять при аварийной остановке
+ANSWER_FLUSH_SIZE = 200
+ANSWER_FLUSH_INTERVAL = 5
+
+# Как часто (в секундах) журнал ответов сворачивается в счетчики и расписание userwords
+# и сколько событий журнала сворачивается за одну транзакцию
+ANSWER_COMPACT_INTERVAL = 60
+ANSWER_COMPACT_BATCH = 50000
+
+# Кэш переводов: сколько переводов держать в памяти
+# и сколько секунд хранить удачный и неудачный перевод
+TRANSLATE_CACHE_SIZE = 10000
+TRANSLATE_CACHE_TTL = 30 * 24 * 60 * 60
+TRANSLATE_NEGATIVE_TTL = 10 * 60
+
+# Максимальное суммарное количество символов в одном запросе к Яндекс переводчику
+TRANSLATE_BATCH_CHARS = 10000
+
+# Максимальное количество слов в одном списке для массового добавления
+BULK_IMPORT_MAX_WORDS = 5000
+
+# Пул случайных слов: при количестве слов меньше RANDOM_WORD_POOL_LOW пул
+# дополняется в фоне до RANDOM_WORD_POOL_HIGH, лишние слова сохраняются в БД
+RANDOM_WORD_POOL_LOW = 20
+RANDOM_WORD_POOL_HIGH = 100
+
+# Переводить случайные слова заранее, при пополнении пула
+RANDOM_WORD_PRETRANSLATE = True
+
+# Исходящие HTTP запросы: размер пула соединений на сервис,
+# таймауты (подключение, ответ) в секундах для каждого сервиса
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUTS = {
+    'yandex_translate': (3, 10),
+    'random_word': (3, 5),
+}
+
+# Количество повторов запроса и базовая задержка между ними в секундах
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.3
+
+# После скольких неудачных запросов подряд сервис считается недоступным
+# и через сколько секунд пробовать обратиться к нему снова
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# Кэш словарей пользователей в памяти: общий объем в байтах
+# и максимальный размер словаря, который имеет смысл держать в памяти
+VOCAB_CACHE_MAX_BYTES = 64 * 1024 * 1024
+VOCAB_CACHE_MAX_WORDS = 20000
+
+# Интервальное повторение (SM-2): через сколько секунд повторить слово после ошибки
+# и максимальный интервал между повторениями в днях
+SCHEDULER_RELEARN_DELAY = 10 * 60
+SCHEDULER_MAX_INTERVAL = 365
+
+# Файл SQLite для состояний диалогов, сколько секунд хранить состояние неактивного чата
+# и как часто удалять устаревшие состояния
+STATE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'states.sqlite3')
+STATE_TTL = 7 * 24 * 60 * 60
+STATE_PURGE_INTERVAL = 60 * 60
+
+# Режим вебхука: адрес на сервере, количество обработчиков, размер очереди каждого обработчика
+# и через сколько секунд Telegram должен повторить обновление, если очередь заполнена
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 100
+WEBHOOK_RETRY_AFTER = 1
+
+# Ограничения Telegram на отправку сообщений: всего в секунду и в один чат в секунду,
+# в чат допускается короткий всплеск до OUTBOX_CHAT_BURST сообщений
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+# В группы Telegram разрешает не больше 20 сообщений в минуту
+OUTBOX_GROUP_RATE = 20 / 60
+# Количество потоков отправки сообщений
+OUTBOX_WORKERS = 4
+# Как часто (в секундах) удалять из памяти счетчики неактивных чатов
+OUTBOX_SWEEP_INTERVAL = 60
+
+# Сколько сериализованных кнопок со словами хранить в памяти
+BUTTON_CACHE_SIZE = 50000
+
+# Сколько готовых карточек держать в памяти для каждого активного пользователя
+CARD_DECK_DEPTH = 3
+# Через сколько секунд без карточек колода пользователя удаляется из памяти
+CARD_DECK_IDLE = 600
+# Количество потоков, собирающих карточки
+CARD_DECK_WORKERS = 2
+
+# Границы корзин гистограмм времени обработчиков, запросов к БД и внешних сервисов, в секундах
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Границы корзин гистограммы количества запросов к БД на одно обновление
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+# Доля обновлений, для которых пишется трасса всех замеров (0 - трассы не пишутся), и файл трасс в JSON Lines
+TRACE_SAMPLE_RATE = 0
+TRACE_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces.jsonl')
+
+# Файл офлайн словаря (собирается python -m dictionary.dictionary dump.tsv). Если файла нет, словарь не используется
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionary.dict')
+
+# Поиск по словарю: слов на странице ответа на /search и в одном ответе на inline запрос
+SEARCH_PAGE_SIZE = 10
+SEARCH_INLINE_LIMIT = 20
+
+# Статистика: слово выучено после STATS_LEARNED_ANSWERS правильных ответов, дни серии занятий подряд
+# считаются в часовом поясе STATS_TIMEZONE, LEADERBOARD_SIZE - пользователей в таблице лидеров
+STATS_LEARNED_ANSWERS = 5
+STATS_TIMEZONE = 'Europe/Moscow'
+LEADERBOARD_SIZE = 10
+
+# Выгрузка и загрузка словаря (/export, /import): строк за одно чтение серверного курсора
+# и наибольший размер загружаемого файла (файлы больше Telegram ботам не отдает)
+TRANSFER_CHUNK_SIZE = 2000
+TRANSFER_MAX_FILE_SIZE = 20 * 1024 * 1024
@@ -0,0 +1,177 @@
+import atexit
+import threading
+import time
+
+from config import ANSWER_FLUSH_SIZE, ANSWER_FLUSH_INTERVAL, ANSWER_COMPACT_INTERVAL, ANSWER_COMPACT_BATCH
+from db.db import get_connection, log_answers, compact_answers, refresh_ranks
+from db.vocab_cache import vocab_cache
+from metrics import metrics
+
+
+def _merge(target, deltas):
+    for key, (right, wrong) in deltas.items():
+        delta = target.setdefault(key, [0, 0])
+        delta[0] += right
+        delta[1] += wrong
+
+
+class AnswerBuffer:
+    """
+    Буфер ответов пользователей. Ответы копятся в памяти и дописываются в журнал answers
+    пачкой через COPY фоновым потоком. Тот же поток периодически сворачивает журнал
+    в счетчики и расписание userwords и пересчитывает места в таблице лидеров
+    """
+
+    def __init__(self, flush_size=ANSWER_FLUSH_SIZE, flush_interval=ANSWER_FLUSH_INTERVAL,
+                 compact_interval=ANSWER_COMPACT_INTERVAL, compact_batch=ANSWER_COMPACT_BATCH):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.compact_batch = compact_batch
+        # Еще не записанные события: (user_id, word_id, правильный ли ответ, время ответа, секунд до ответа)
+        self._events = []
+        # Приращения счетчиков, еще не попавшие в userwords: (user_id, word_id) -> [правильных, неправильных].
+        # Ответы проходят путь _deltas -> _flushing (запись в журнал) -> _logged -> _compacting (свертка)
+        self._deltas = {}
+        self._flushing = {}
+        self._logged = {}
+        self._compacting = {}
+        self._last_compact = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, user_id, word_id, right, latency=None):
+        """
+        Функция запоминает ответ пользователя
+        :param user_id: номер пользователя в telegram
+        :param word_id: id слова
+        :param right: True если ответ правильный
+        :param latency: сколько секунд прошло от показа карточки до ответа или None
+        :return: None
+        """
+        # Кэш словарей учитывает ответ сразу, запись в БД его уже не меняет. Ответ попадает в буфер и в кэш
+        # под блокировкой кэша: загрузка словаря не может сохранить в кэш снимок с ответом из pending(),
+        # к которому затем еще раз добавится тот же ответ
+        with vocab_cache.lock:
+            with self._lock:
+                self._events.append((user_id, word_id, right, time.time(), latency))
+                delta = self._deltas.setdefault((user_id, word_id), [0, 0])
+                delta[0 if right else 1] += 1
+                full = len(self._events) >= self.flush_size
+            vocab_cache.add_answers(user_id, word_id, 1 if right else 0, 0 if right else 1)
+        if full:
+            self._wakeup.set()
+
+    def pending(self, user_id):
+        """
+        Функция возвращает ответы пользователя, еще не учтенные в счетчиках userwords
+        :param user_id: номер пользователя в telegram
+        :return: словарь {word_id: (правильных, неправильных)}
+        """
+        result = {}
+        with self._lock:
+            for deltas in (self._compacting, self._logged, self._flushing, self._deltas):
+                for (uid, word_id), (right, wrong) in deltas.items():
+                    if uid == user_id:
+                        old_right, old_wrong = result.get(word_id, (0, 0))
+                        result[word_id] = (old_right + right, old_wrong + wrong)
+        return result
+
+    def flush(self):
+        """
+        Функция дописывает накопленные ответы в журнал одной командой COPY.
+        При ошибке ответы возвращаются в буфер
+        :return: количество записанных ответов
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                self._flushing, self._deltas = self._deltas, {}
+            if not events:
+                return 0
+            try:
+                with get_connection() as conn:
+                    log_answers(conn, events)
+            except Exception:
+                with self._lock:
+                    self._events[:0] = events
+                    _merge(self._deltas, self._flushing)
+                    self._flushing = {}
+                raise
+            with self._lock:
+                _merge(self._logged, self._flushing)
+                self._flushing = {}
+            return len(events)
+
+    def compact(self):
+        """
+        Функция сворачивает журнал ответов в счетчики и расписание userwords пачками по compact_batch событий.
+        Если счетчики изменились, пересчитываются места в таблице лидеров
+        :return: количество свернутых событий
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._compacting, self._logged = self._logged, {}
+            total = 0
+            try:
+                with get_connection() as conn:
+                    while True:
+                        count = compact_answers(conn, self.compact_batch)
+                        total += count
+                        if count < self.compact_batch:
+                            break
+                    if total:
+                        refresh_ranks(conn)
+            except Exception:
+                with self._lock:
+                    _merge(self._logged, self._compacting)
+                    self._compacting = {}
+                raise
+            with self._lock:
+                self._compacting = {}
+            self._last_compact = time.monotonic()
+            return total
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Не удалось записать ответы в БД: {e}')
+            if time.monotonic() - self._last_compact >= self.compact_interval:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f'Не удалось свернуть журнал ответов: {e}')
+
+    def start(self):
+        """
+        Функция запускает фоновую запись буфера и запись остатка при завершении программы
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='answer-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Функция останавливает фоновый поток, записывает остаток буфера и сворачивает журнал
+        :return: None
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.compact()
+
+
+answer_buffer = AnswerBuffer()
+metrics.collect('answer_buffer', lambda: {'pending': len(answer_buffer._events), 'logged': len(answer_buffer._logged)})
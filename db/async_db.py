@@ -0,0 +1,388 @@
+from contextlib import asynccontextmanager
+import json
+import re
+
+import asyncpg
+
+from db.db import (HOST, PORT, DATABASE, DB_USER, DB_PASS, BUILD_CARD_SQL, DEL_WORD_SQL, search_query,
+                   stats_from_row)
+from db.stats import STATS_UPSERT, FIND_STATS_SQL, LEADERBOARD_SQL
+from db.vocab_cache import vocab_cache, UserVocabulary
+from metrics import metrics
+from config import VOCAB_CACHE_MAX_WORDS, SAMPLE_PROBES_FACTOR, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT
+
+# Асинхронный доступ к БД для бота на asyncio (async_main.py): те же функции, что в db.db, но корутины.
+# Схема БД создается синхронно при импорте пакета db, кэш словарей общий с db.db
+
+_pool = None
+
+
+class CountingConnection(asyncpg.Connection):
+    """
+    Соединение, которое учитывает каждый запрос в метриках. Используется пулом, только если метрики включены
+    """
+
+    async def execute(self, query, *args, **kwargs):
+        metrics.count_query()
+        return await super().execute(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        metrics.count_query()
+        return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        metrics.count_query()
+        return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        metrics.count_query()
+        return await super().fetchval(query, *args, **kwargs)
+
+
+async def _init_connection(conn):
+    # JSONB из translations отдаем словарем, как psycopg2
+    await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def get_pool():
+    """
+    Функция возвращает общий пул асинхронных соединений, создавая его при первом обращении
+    :return: объект asyncpg.Pool
+    """
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(host=HOST, port=PORT, database=DATABASE, user=DB_USER, password=DB_PASS,
+                                          min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                                          init=_init_connection,
+                                          connection_class=CountingConnection if metrics.enabled else asyncpg.Connection)
+    return _pool
+
+
+async def close_pool():
+    """
+    Функция закрывает все соединения пула
+    :return: None
+    """
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+@asynccontextmanager
+async def get_connection():
+    """
+    Асинхронный контекстный менеджер: выдает соединение из пула и возвращает его обратно.
+    Если свободных соединений нет дольше POOL_TIMEOUT секунд, выбрасывается asyncio.TimeoutError
+    """
+    pool = await get_pool()
+    async with pool.acquire(timeout=POOL_TIMEOUT) as conn:
+        yield conn
+
+
+def _numbered(sql, params):
+    """
+    Функция переводит запрос с именованными параметрами psycopg2 %(name)s в нумерованные $n asyncpg,
+    экранированный знак %% - в %
+    :param sql: текст запроса
+    :param params: словарь параметров
+    :return: кортеж (текст запроса, list значений параметров)
+    """
+    names = []
+
+    def replace(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    sql = re.sub(r'%\((\w+)\)s', replace, sql).replace('%%', '%')
+    return sql, [params[name] for name in names]
+
+
+def _rowcount(status):
+    # asyncpg возвращает статус команды вида 'INSERT 0 1' или 'DELETE 1'
+    return int(status.split()[-1])
+
+
+@metrics.timed(metrics.db_seconds)
+async def add_user(conn, user_id, user_name):
+    """
+    Функция добавляет пользователя в БД
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param user_name: имя пользователя для добавления
+    :return: количество строк в результате выполнения функции
+    """
+    status = await conn.execute("""
+            INSERT INTO users (user_id, name)
+            VALUES ($1, $2);
+            """, user_id, user_name)
+    return _rowcount(status)
+
+
+@metrics.timed(metrics.db_seconds)
+async def find_user(conn, user_id):
+    """
+    Функция ищет в БД пользователя по его id в telegram
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :return: Имя пользователя если он есть в БД или None если его нет
+    """
+    return await conn.fetchrow("""
+            SELECT name
+              FROM users
+             WHERE user_id = $1
+            """, user_id)
+
+
+@metrics.timed(metrics.db_seconds)
+async def add_words(conn, user_id, ru_word, en_word):
+    """
+    Функция сохраняет пару RU-EN слов в БД
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param ru_word: русское слово
+    :param en_word: перевод русского слова
+    :return: количество строк в результате выполнения функции
+    """
+    ru_word = ru_word.lower()
+    en_word = en_word.lower()
+    async with conn.transaction():
+        # Проверяем есть ли такая пара слов в нашей базе
+        word_id = await conn.fetchval("""
+                SELECT word_id FROM words
+                 WHERE rus_word = $1 AND en_word = $2
+                """, ru_word, en_word)
+
+        # Если такая пара есть в БД добавляем соответсвующую запись в таблицу userwords
+        if word_id is not None:
+            word_id = await conn.fetchval("""
+                    WITH added AS (
+                        INSERT INTO userwords (user_id, word_id)
+                        VALUES ($1, $2)
+                        ON CONFLICT ON CONSTRAINT user_word
+                        DO NOTHING
+                        RETURNING user_id, word_id
+                    ), stats AS (
+                        INSERT INTO user_stats AS s (user_id, words)
+                        SELECT user_id, 1
+                          FROM added
+                        """ + STATS_UPSERT + """
+                    )
+                    SELECT word_id
+                      FROM added
+                    """, user_id, word_id)
+        # Если нет, добавляем и пару и запись в userwords
+        else:
+            word_id = await conn.fetchval("""
+                    WITH insert_word AS(
+                        INSERT INTO words (rus_word, en_word)
+                        VALUES ($1, $2)
+                        ON CONFLICT ON CONSTRAINT ru_en
+                        DO NOTHING
+                        RETURNING word_id
+                    ), added AS (
+                        INSERT INTO userwords (user_id, word_id)
+                        VALUES ($3, (SELECT word_id FROM insert_word))
+                        RETURNING user_id, word_id
+                    ), stats AS (
+                        INSERT INTO user_stats AS s (user_id, words)
+                        SELECT user_id, 1
+                          FROM added
+                        """ + STATS_UPSERT + """
+                    )
+                    SELECT word_id
+                      FROM added
+                    """, ru_word, en_word, user_id)
+    if word_id is None:
+        return 0
+    vocab_cache.add_word(user_id, word_id, ru_word, en_word)
+    return 1
+
+
+@metrics.timed(metrics.db_seconds)
+async def load_vocabulary(conn, user_id, pending=None):
+    """
+    Функция загружает словарь пользователя в кэш словарей
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param pending: функция от user_id, возвращающая еще не записанные в БД ответы пользователя
+    {word_id: (правильных, неправильных)}. Вызывается после начала загрузки: ответ, пришедший позже,
+    меняет словарь во время загрузки, и загруженный снимок в кэш не попадает
+    :return: объект UserVocabulary или None если пользователя нет, словарь слишком большой для кэша
+    или менялся во время загрузки
+    """
+    generation = vocab_cache.begin_load(user_id)
+    try:
+        answers = pending(user_id) if pending else {}
+        rows = await conn.fetch("""
+                SELECT u.name, w.word_id, w.rus_word, w.en_word, uw.right_answer, uw.wrong_answer,
+                       extract(epoch FROM uw.due_at)::float8, uw.ease, uw.interval_days, uw.reps
+                  FROM users u
+                  LEFT JOIN userwords uw
+                    ON uw.user_id = u.user_id
+                  LEFT JOIN words w
+                    ON w.word_id = uw.word_id
+                 WHERE u.user_id = $1
+                 LIMIT $2
+                """, user_id, VOCAB_CACHE_MAX_WORDS + 1)
+        if not rows:
+            return None
+        if len(rows) > VOCAB_CACHE_MAX_WORDS:
+            vocab_cache.mark_too_large(user_id)
+            return None
+
+        vocab = UserVocabulary(rows[0][0])
+        for _, word_id, rus_word, en_word, right, wrong, due_at, ease, interval_days, reps in rows:
+            if word_id is not None:
+                vocab.add(word_id, rus_word, en_word, right, wrong, due_at, ease, interval_days, reps)
+        for word_id, (right, wrong) in answers.items():
+            vocab.add_answers(word_id, right, wrong)
+        return vocab if vocab_cache.put(user_id, vocab, generation) else None
+    finally:
+        vocab_cache.end_load(user_id)
+
+
+@metrics.timed(metrics.db_seconds)
+async def build_card(conn, user_id, lang, count=5, pending=None):
+    """
+    Функция собирает карточку так же, как db.db.build_card: из кэша словарей,
+    а если словарь в кэш не помещается - одним запросом к БД
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param lang: язык вариантов ответа ('ru' или 'en')
+    :param count: количество неправильных вариантов ответа
+    :param pending: функция от user_id, возвращающая еще не записанные в БД ответы пользователя
+    {word_id: (правильных, неправильных)}, или None
+    :return: словарь с ключами user_name, word_id, rus_word, en_word, others
+    или None если в БД нет ни одного слова
+    """
+    card = vocab_cache.read(user_id, 'build_card', lang, count)
+    if card is not None:
+        return card
+    if vocab_cache.is_cacheable(user_id):
+        vocab = await load_vocabulary(conn, user_id, pending)
+        if vocab is not None:
+            with vocab_cache.lock:
+                return vocab.build_card(lang, count)
+
+    sql, args = _numbered(BUILD_CARD_SQL, {'user_id': user_id, 'lang': lang, 'count': count,
+                                           'probes': count * SAMPLE_PROBES_FACTOR,
+                                           'p_ids': list(pending(user_id) if pending else {})})
+    result = await conn.fetchrow(sql, *args)
+    if result is None:
+        return None
+
+    return {
+        'user_name': result[0],
+        'word_id': result[1],
+        'rus_word': result[2],
+        'en_word': result[3],
+        'others': list(result[4]),
+    }
+
+
+@metrics.timed(metrics.db_seconds)
+async def del_word(conn, user_id, word_id):
+    """
+    Функция удаляет слово из словаря пользователя
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param word_id: id слова, которое надо удалить
+    :return: количество строк в результате выполнения функции
+    """
+    sql, args = _numbered(DEL_WORD_SQL, {'user_id': user_id, 'word_id': word_id})
+    status = await conn.execute(sql, *args)
+    vocab_cache.remove_word(user_id, word_id)
+    return _rowcount(status)
+
+
+@metrics.timed(metrics.db_seconds)
+async def find_stats(conn, user_id):
+    """
+    Функция читает сводную статистику пользователя так же, как db.db.find_stats
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :return: словарь с ключами user_name, words, learned, right, wrong, streak, rank или None
+    """
+    sql, args = _numbered(FIND_STATS_SQL, {'user_id': user_id})
+    return stats_from_row(await conn.fetchrow(sql, *args))
+
+
+@metrics.timed(metrics.db_seconds)
+async def find_leaderboard(conn, count):
+    """
+    Функция читает таблицу лидеров так же, как db.db.find_leaderboard
+    :param conn: объект asyncpg.Connection
+    :param count: количество пользователей
+    :return: list кортежей (user_id, имя, выучено слов, правильных ответов, неправильных ответов)
+    """
+    sql, args = _numbered(LEADERBOARD_SQL, {'count': count})
+    return [tuple(row) for row in await conn.fetch(sql, *args)]
+
+
+@metrics.timed(metrics.db_seconds)
+async def search_words(conn, user_id, text, limit, offset=0):
+    """
+    Функция ищет слова в словаре пользователя так же, как db.db.search_words
+    :param conn: объект asyncpg.Connection
+    :param user_id: номер пользователя в telegram
+    :param text: искомое слово или его начало, пустая строка - весь словарь
+    :param limit: количество слов на странице
+    :param offset: сколько слов пропустить
+    :return: кортеж (list кортежей (word_id, русское слово, английское слово), количество найденных слов)
+    """
+    sql, args = _numbered(*search_query(user_id, text, limit, offset))
+    rows = await conn.fetch(sql, *args)
+    return [tuple(row[:3]) for row in rows], rows[0][3] if rows else 0
+
+
+@metrics.timed(metrics.db_seconds)
+async def find_translation(conn, source_text, ttl, negative_ttl):
+    """
+    Функция ищет сохраненный перевод в кэше переводов
+    :param conn: объект asyncpg.Connection
+    :param source_text: нормализованный текст для перевода
+    :param ttl: сколько секунд действителен найденный перевод
+    :param negative_ttl: сколько секунд действительна запись о неудачном переводе
+    :return: кортеж (перевод или None) если запись есть и не устарела, иначе None
+    """
+    return await conn.fetchrow("""
+            SELECT result
+              FROM translations
+             WHERE source_text = $1
+               AND updated_at > now() - make_interval(secs => CASE WHEN result IS NULL THEN $2::float8 ELSE $3::float8 END)
+            """, source_text, negative_ttl, ttl)
+
+
+@metrics.timed(metrics.db_seconds)
+async def save_translation(conn, source_text, result):
+    """
+    Функция сохраняет перевод в кэш переводов
+    :param conn: объект asyncpg.Connection
+    :param source_text: нормализованный текст для перевода
+    :param result: словарь с переводом или None если перевести не удалось
+    :return: None
+    """
+    await conn.execute("""
+            INSERT INTO translations (source_text, result)
+            VALUES ($1, $2)
+            ON CONFLICT (source_text)
+            DO UPDATE SET result = EXCLUDED.result, updated_at = now()
+            """, source_text, result)
+
+
+@metrics.timed(metrics.db_seconds)
+async def take_local_random_word(conn):
+    """
+    Функция выбирает случайное английское слово из общего словаря без сортировки всей таблицы
+    :param conn: объект asyncpg.Connection
+    :return: str английское слово или None если словарь пуст
+    """
+    return await conn.fetchval("""
+            SELECT en_word
+              FROM words
+             WHERE word_id >= (SELECT floor(random() * max(word_id)) FROM words)
+             ORDER BY word_id
+             LIMIT 1
+            """)
@@ -0,0 +1,76 @@
+import argparse
+import csv
+
+from config import BULK_IMPORT_MAX_WORDS
+from db.db import get_connection, add_words_bulk
+from yandex_translate.cache import translate_many
+from yandex_translate.yandex_translate import detect_local
+
+
+def parse_words(text):
+    """
+    Функция разбирает список слов: по одному слову или фразе в строке или в ячейке CSV.
+    Строка из двух ячеек на русском и английском языках считается готовой парой и не переводится
+    :param text: текст списка или CSV файла
+    :return: кортеж (list готовых пар (ru, en), list слов для перевода)
+    """
+    lines = text.splitlines()
+    # Разделитель - первый из встретившихся в тексте: табуляция, точка с запятой или запятая
+    delimiter = next((item for item in '\t;,' if item in text), ',')
+    pairs = []
+    words = []
+    for row in csv.reader(lines, delimiter=delimiter):
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if len(cells) == 2:
+            langs = [detect_local(cell) for cell in cells]
+            if langs == ['ru', 'en']:
+                pairs.append((cells[0], cells[1]))
+                continue
+            if langs == ['en', 'ru']:
+                pairs.append((cells[1], cells[0]))
+                continue
+        words.extend(cells)
+    return pairs, list(dict.fromkeys(words))
+
+
+def import_words(user_id, text):
+    """
+    Функция переводит список слов пачками и сохраняет пары в словарь пользователя одной транзакцией
+    :param user_id: номер пользователя в telegram
+    :param text: текст списка или CSV файла
+    :return: кортеж (количество добавленных слов, list слов, которые не удалось перевести)
+    """
+    pairs, words = parse_words(text)
+    if not pairs and not words:
+        raise ValueError('Список слов пуст.')
+    if len(pairs) + len(words) > BULK_IMPORT_MAX_WORDS:
+        raise ValueError(f'Слишком много слов, можно добавить не больше {BULK_IMPORT_MAX_WORDS} за раз.')
+
+    failed = []
+    for word, result in zip(words, translate_many(words)):
+        if not result:
+            failed.append(word)
+            continue
+        translation = result['translations'][0]
+        if translation['detectedLanguageCode'] == 'ru':
+            pairs.append((word, translation['text']))
+        else:
+            pairs.append((translation['text'], word))
+
+    with get_connection() as conn:
+        added = add_words_bulk(conn, user_id, pairs)
+    return added, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Массовое добавление слов в словарь пользователя')
+    parser.add_argument('user_id', type=int, help='номер пользователя в telegram')
+    parser.add_argument('file', help='текстовый или CSV файл со словами')
+    parser.add_argument('--encoding', default='utf-8-sig', help='кодировка файла')
+    args = parser.parse_args()
+
+    with open(args.file, encoding=args.encoding) as f:
+        added, failed = import_words(args.user_id, f.read())
+    print(f'Добавлено слов: {added}')
+    if failed:
+        print('Не удалось перевести:', ', '.join(failed))
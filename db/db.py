@@ -1,8 +1,22 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from dotenv import load_dotenv
+import io
 import os
+import threading
+import time
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import execute_values, Json
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 
-from config import START_WORDS
+from db.scheduler import START_EASE, MIN_EASE, schedule_sql
+from db.stats import (STATS_UPSERT, FIND_STATS_SQL, LEADERBOARD_SQL, REBUILD_STATS_SQL, REFRESH_RANKS_SQL,
+                      learned_sql, is_learned_sql, streaks_sql)
+from db.vocab_cache import vocab_cache, UserVocabulary
+from metrics import metrics
+
+from config import START_WORDS, VOCAB_CACHE_MAX_WORDS, SCHEDULER_MAX_INTERVAL, SAMPLE_PROBES_FACTOR, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT, POOL_HEALTH_CHECK_IDLE, TRANSFER_CHUNK_SIZE
 
 load_dotenv()
 HOST = os.environ.get('HOST')
@@ -15,10 +29,147 @@ DB_PASS = os.environ.get('DB_PASS')
 if any(item is None for item in [HOST, PORT, DATABASE, DB_USER, DB_PASS]):
     raise ValueError('Параметры подключения к БД не установлены в переменных окружения.')
 
+# Общий пул соединений, создается при первом обращении
+_pool = None
+_pool_lock = threading.Lock()
+# Семафор ограничивает число одновременно выданных соединений, чтобы потоки ждали, а не падали с PoolError
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+# Время последнего возврата соединения в пул, по id соединения
+_last_used = {}
+# Ключ advisory блокировки журнала ответов: запись берет ее разделяемой, свертка - исключительной,
+# поэтому свертка видит только завершенные записи и не пропускает события с меньшими answer_id
+ANSWERS_LOCK_KEY = 7310
+# Установлено ли в БД расширение pg_trgm (проверяется в create_tables): без него поиск слов ищет только по началу
+trigram_search = False
+
+
+class CountingCursor(extensions.cursor):
+    """
+    Курсор, который учитывает каждый запрос в метриках. Используется пулом, только если метрики включены
+    """
+
+    def execute(self, query, vars=None):
+        metrics.count_query()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        metrics.count_query()
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.count_query()
+        return super().copy_expert(sql, file, size)
+
+
 def create_db_connection():
     conn = psycopg2.connect(host=HOST, port=PORT, database=DATABASE, user=DB_USER, password=DB_PASS)
     return conn
 
+
+def get_pool():
+    """
+    Функция возвращает общий потокобезопасный пул соединений, создавая его при первом обращении
+    :return: объект ThreadedConnectionPool
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, host=HOST, port=PORT,
+                                               database=DATABASE, user=DB_USER, password=DB_PASS,
+                                               cursor_factory=CountingCursor if metrics.enabled else None)
+    return _pool
+
+
+def close_pool():
+    """
+    Функция закрывает все соединения пула
+    :return: None
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+def _is_alive(conn):
+    """
+    Функция проверяет, что соединение из пула пригодно для работы.
+    Запрос к БД выполняется, только если соединение долго простаивало
+    :param conn: объект connection
+    :return: True если соединение рабочее
+    """
+    if conn.closed:
+        return False
+    if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < POOL_HEALTH_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool):
+    """
+    Функция берет из пула рабочее соединение, закрывая разорванные
+    :param pool: пул соединений
+    :return: объект connection
+    """
+    # Перебираем не больше соединений, чем может быть в пуле, плюс одно новое
+    for _ in range(POOL_MAX_SIZE + 1):
+        conn = pool.getconn()
+        if _is_alive(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise PoolError('Не удалось получить рабочее соединение с БД')
+
+
+@contextmanager
+def get_connection():
+    """
+    Контекстный менеджер выдает соединение из общего пула и возвращает его обратно.
+    Незавершенная транзакция откатывается, разорванное соединение закрывается.
+    Пример:
+    with get_connection() as conn:
+        find_user(conn, user_id)
+    :return: объект connection
+    """
+    if not _pool_slots.acquire(timeout=POOL_TIMEOUT):
+        raise PoolError('Нет свободных соединений с БД')
+    try:
+        pool = get_pool()
+        conn = _checkout(pool)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not conn.closed \
+                    and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # Откатываем транзакцию, оставшуюся после ошибки или без commit
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            broken = broken or bool(conn.closed)
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=broken)
+    finally:
+        _pool_slots.release()
+
 def create_tables(conn):
     """
     Функция создает необходимые таблицы и наполняет БД стартовыми словами
@@ -49,10 +200,149 @@ def create_tables(conn):
                     word_id INT NOT NULL REFERENCES words (word_id) ON DELETE CASCADE,
                     wrong_answer INTEGER NOT NULL DEFAULT 0,
                     right_answer INTEGER NOT NULL DEFAULT 0,
+                    rand_key DOUBLE PRECISION NOT NULL DEFAULT random(),
+                    due_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    ease REAL NOT NULL DEFAULT %(start_ease)s,
+                    interval_days REAL NOT NULL DEFAULT 0,
+                    reps INTEGER NOT NULL DEFAULT 0,
                     CONSTRAINT user_word UNIQUE (user_id, word_id)
                 );
+                """, {'start_ease': START_EASE})
+
+        # Расписание интервального повторения: для существующих строк заполняется по счетчикам ответов
+        cur.execute("""
+                SELECT 1
+                  FROM information_schema.columns
+                 WHERE table_name = 'userwords' AND column_name = 'due_at'
+                """)
+        if cur.fetchone() is None:
+            cur.execute("""
+                    ALTER TABLE userwords
+                      ADD COLUMN due_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                      ADD COLUMN ease REAL NOT NULL DEFAULT %(start_ease)s,
+                      ADD COLUMN interval_days REAL NOT NULL DEFAULT 0,
+                      ADD COLUMN reps INTEGER NOT NULL DEFAULT 0;
+                    UPDATE userwords
+                       SET ease = GREATEST(%(min_ease)s, LEAST(%(start_ease)s + 0.5,
+                                      %(start_ease)s + 0.1 * right_answer - 0.2 * wrong_answer)),
+                           reps = GREATEST(right_answer - wrong_answer, 0);
+                    UPDATE userwords
+                       SET interval_days = CASE WHEN reps = 0 THEN 0
+                                                WHEN reps = 1 THEN 1
+                                                ELSE LEAST(6 * power(ease, LEAST(reps - 2, 20)), %(max_interval)s) END;
+                    -- Сроки повторения разносим случайно в пределах интервала, чтобы слова не стали доступны разом
+                    UPDATE userwords
+                       SET due_at = now() + interval '1 day' * interval_days * random();
+                    """, {'start_ease': START_EASE, 'min_ease': MIN_EASE, 'max_interval': SCHEDULER_MAX_INTERVAL})
+        cur.execute("""
+                CREATE INDEX IF NOT EXISTS userwords_user_due_at
+                    ON userwords (user_id, due_at);
+                """)
+
+        # Случайный ключ строки для выборки случайных слов без сортировки всего словаря
+        cur.execute("""
+                ALTER TABLE userwords
+                  ADD COLUMN IF NOT EXISTS rand_key DOUBLE PRECISION NOT NULL DEFAULT random();
+                CREATE INDEX IF NOT EXISTS userwords_user_rand_key
+                    ON userwords (user_id, rand_key);
+                """)
+
+        # Индекс для поиска по английскому слову. Поиск по русскому слову обслуживает
+        # ограничение ru_en, а выборку слов пользователя - user_word и userwords_user_rand_key
+        cur.execute("""
+                CREATE INDEX IF NOT EXISTS words_en_word
+                    ON words (en_word);
+                """)
+
+        # Кэш переводов Яндекс переводчика. result IS NULL - слово перевести не удалось
+        cur.execute("""
+                CREATE TABLE IF NOT EXISTS translations(
+                    source_text TEXT PRIMARY KEY,
+                    result JSONB,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                """)
+
+        # Запас случайных слов, не поместившихся в пул в памяти
+        cur.execute("""
+                CREATE TABLE IF NOT EXISTS random_words(
+                    word VARCHAR(100) PRIMARY KEY
+                );
                 """)
 
+        # Журнал ответов: строки только добавляются, счетчики userwords обновляет периодическая свертка.
+        # Внешних ключей нет, чтобы запись журнала не проверяла горячие таблицы.
+        # latency - секунды от показа карточки до ответа, NULL если неизвестно
+        cur.execute("""
+                CREATE TABLE IF NOT EXISTS answers(
+                    answer_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    word_id INT NOT NULL,
+                    correct BOOLEAN NOT NULL,
+                    answered_at TIMESTAMPTZ NOT NULL,
+                    latency REAL
+                );
+                CREATE INDEX IF NOT EXISTS answers_answered_at
+                    ON answers USING brin (answered_at);
+                CREATE TABLE IF NOT EXISTS answers_compacted(
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    last_answer_id BIGINT NOT NULL DEFAULT 0
+                );
+                INSERT INTO answers_compacted (id)
+                VALUES (TRUE)
+                ON CONFLICT (id)
+                DO NOTHING;
+                """)
+
+        # Сводная статистика пользователей для /stats и таблицы лидеров, ведется приращениями (db.stats).
+        # Для существующей БД статистика при создании таблицы считается с нуля
+        cur.execute("SELECT to_regclass('user_stats')")
+        if cur.fetchone()[0] is None:
+            cur.execute("""
+                    CREATE TABLE user_stats(
+                        user_id BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+                        words INTEGER NOT NULL DEFAULT 0,
+                        learned INTEGER NOT NULL DEFAULT 0,
+                        right_answers BIGINT NOT NULL DEFAULT 0,
+                        wrong_answers BIGINT NOT NULL DEFAULT 0,
+                        streak INTEGER NOT NULL DEFAULT 0,
+                        last_day DATE
+                    );
+                    CREATE INDEX user_stats_rank
+                        ON user_stats (learned, right_answers);
+                    """)
+            cur.execute(REBUILD_STATS_SQL)
+        # Место в таблице лидеров, пересчитывается периодически (refresh_ranks)
+        cur.execute("""
+                ALTER TABLE user_stats
+                  ADD COLUMN IF NOT EXISTS rank INTEGER;
+                """)
+        cur.execute(REFRESH_RANKS_SQL)
+
+        # Поиск слов: по началу слова - btree индексы text_pattern_ops (LIKE 'начало%' при любом COLLATE),
+        # с опечатками - триграммные GIN индексы pg_trgm, если расширение можно установить
+        cur.execute("""
+                CREATE INDEX IF NOT EXISTS words_rus_word_prefix
+                    ON words (rus_word text_pattern_ops);
+                CREATE INDEX IF NOT EXISTS words_en_word_prefix
+                    ON words (en_word text_pattern_ops);
+                SAVEPOINT trigram;
+                """)
+        global trigram_search
+        try:
+            cur.execute("""
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    CREATE INDEX IF NOT EXISTS words_rus_word_trgm
+                        ON words USING gin (rus_word gin_trgm_ops);
+                    CREATE INDEX IF NOT EXISTS words_en_word_trgm
+                        ON words USING gin (en_word gin_trgm_ops);
+                    """)
+            trigram_search = True
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT trigram")
+            trigram_search = False
+            print(f'Расширение pg_trgm недоступно, поиск слов с опечатками отключен: {e}'.strip())
+
         cur.executemany("""
                 INSERT INTO words (word_id, rus_word, en_word)
                 VALUES (%s, %s, %s)
@@ -67,6 +357,7 @@ def create_tables(conn):
         conn.commit()
 
 
+@metrics.timed(metrics.db_seconds)
 def add_user(conn, user_id, user_name):
     """
     Функция добавляет пользователя в БД
@@ -84,6 +375,7 @@ def add_user(conn, user_id, user_name):
         return cur.rowcount
 
 
+@metrics.timed(metrics.db_seconds)
 def find_word(conn, word):
     """
     Функция ищет слово в таблице words
@@ -106,6 +398,7 @@ def find_word(conn, word):
 
         return result
 
+@metrics.timed(metrics.db_seconds)
 def add_words(conn, user_id, ru_word, en_word):
     """
     Функция сохраняет пару RU-EN слов в БД
@@ -129,14 +422,22 @@ def add_words(conn, user_id, ru_word, en_word):
         # Если такая пара есть в БД добавляем соответсвующую запись в таблицу userwords
         if result is not None:
             word_id = result[0]
-            # Добавляем соответсвующую запись в таблицу userwords
+            # Добавляем соответсвующую запись в таблицу userwords и учитываем слово в статистике
             cur.execute("""
-                    INSERT INTO userwords (user_id, word_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT ON CONSTRAINT user_word
-                    DO NOTHING
-                    """, (user_id, word_id))
+                    WITH added AS (
+                        INSERT INTO userwords (user_id, word_id)
+                        VALUES (%s, %s)
+                        ON CONFLICT ON CONSTRAINT user_word
+                        DO NOTHING
+                        RETURNING user_id
+                    )
+                    INSERT INTO user_stats AS s (user_id, words)
+                    SELECT user_id, 1
+                      FROM added
+                    """ + STATS_UPSERT, (user_id, word_id))
             conn.commit()
+            if cur.rowcount:
+                vocab_cache.add_word(user_id, word_id, ru_word, en_word)
             return cur.rowcount
         # Если нет, добавляем и пару и запись в userwords
         else:
@@ -147,14 +448,27 @@ def add_words(conn, user_id, ru_word, en_word):
                         ON CONFLICT ON CONSTRAINT ru_en
                         DO NOTHING
                         RETURNING word_id
+                    ), added AS (
+                        INSERT INTO userwords (user_id, word_id)
+                        VALUES (%s, (SELECT word_id FROM insert_word))
+                        RETURNING user_id, word_id
+                    ), stats AS (
+                        INSERT INTO user_stats AS s (user_id, words)
+                        SELECT user_id, 1
+                          FROM added
+                        """ + STATS_UPSERT + """
                     )
-                    INSERT INTO userwords (user_id, word_id)
-                    VALUES (%s, (SELECT word_id FROM insert_word))
+                    SELECT word_id
+                      FROM added
                     """, (ru_word, en_word, user_id))
+            result = cur.fetchone()
             conn.commit()
+            if result is not None:
+                vocab_cache.add_word(user_id, result[0], ru_word, en_word)
             return cur.rowcount
 
 
+@metrics.timed(metrics.db_seconds)
 def find_user(conn, user_id):
     """
     Функция ищет в БД пользователя по его id в telegram
@@ -171,28 +485,45 @@ def find_user(conn, user_id):
         return cur.fetchone()
 
 
-def take_random_word(conn, user_id):
+def _pending_params(pending):
+    """
+    Функция возвращает id слов с еще не записанными в БД ответами: их расписание в БД устарело
+    :param pending: словарь {word_id: (правильных, неправильных)} или None
+    :return: словарь параметров с ключом p_ids
     """
-    Функция выбирает из БД случайную пару EN-RU слов из 5 слов с худшими результатами по ответам
+    return {'p_ids': list(pending or {})}
+
+
+@metrics.timed(metrics.db_seconds)
+def take_random_word(conn, user_id, pending=None):
+    """
+    Функция выбирает из БД случайную пару EN-RU слов из 5 слов с самым ранним сроком повторения
     :param conn: объект connection
     :param user_id: номер пользователя в telegram
+    :param pending: еще не записанные в БД ответы пользователя {word_id: (правильных, неправильных)}
     :return: кортеж с парой En-Ru слов
     """
+    # Словарь в кэше уже учитывает незаписанные ответы
+    cached = vocab_cache.read(user_id, 'take_random_word')
+    if cached is not None:
+        return cached[1:]
+
     with conn.cursor() as cur:
         cur.execute("""
             SELECT rus_word, en_word
               FROM (
-                    SELECT w.rus_word, w.en_word
-                      FROM words w
-                      JOIN userwords uw
+                    SELECT w.word_id, w.rus_word, w.en_word
+                      FROM userwords uw
+                      JOIN words w
                         ON w.word_id = uw.word_id
-                     WHERE uw.user_id = %s
-                     ORDER BY ((uw.wrong_answer + 1.0) / (uw.right_answer + 1.0)) DESC
-                     LIMIT 5
+                     WHERE uw.user_id = %(user_id)s
+                     ORDER BY uw.due_at
+                     LIMIT 5 + cardinality(%(p_ids)s::int[])
               ) as top
-             ORDER BY RANDOM()
+             -- Слова с незаписанными ответами только что повторялись, выбираем их в последнюю очередь
+             ORDER BY top.word_id = ANY(%(p_ids)s::int[]), RANDOM()
              LIMIT 1
-                """, (user_id, ))
+                """, {'user_id': user_id, **_pending_params(pending)})
         result = cur.fetchone()
 
         # Если у пользователя нет ни одного слова в словаре выдаем слова из предустановленных
@@ -211,6 +542,7 @@ def take_random_word(conn, user_id):
         return result
 
 
+@metrics.timed(metrics.db_seconds)
 def take_other_words(conn, user_id, ex_word, lang, count=5):
     """
     Функция выбирает случайные слова, за исключением одного из БД
@@ -223,16 +555,36 @@ def take_other_words(conn, user_id, ex_word, lang, count=5):
     :return: list из случайных слов
     """
     ex_word = ex_word.lower()
+    cached = vocab_cache.read(user_id, 'take_other_words', ex_word, lang, count)
+    if cached is not None:
+        return cached
+
     with conn.cursor() as cur:
+        # Вместо сортировки всего словаря по RANDOM() делаем несколько независимых проб индекса
+        # (user_id, rand_key): каждая берет первое слово со случайным ключом не меньше случайного числа,
+        # а если такого нет - слово с наименьшим ключом
         if lang == 'ru':
             cur.execute("""
-                    SELECT w.rus_word
-                      FROM words w
-                      JOIN userwords uw
-                        ON w.word_id = uw.word_id
-                     WHERE uw.user_id = %s AND w.rus_word <> %s
-                     ORDER BY RANDOM() LIMIT %s
-                    """, (user_id, ex_word, count))
+                    SELECT DISTINCT s.rus_word
+                      FROM (SELECT random() AS k FROM generate_series(1, %(probes)s)) AS r
+                     CROSS JOIN LATERAL (
+                           (SELECT w.rus_word
+                              FROM userwords uw
+                              JOIN words w
+                                ON w.word_id = uw.word_id
+                             WHERE uw.user_id = %(user_id)s AND uw.rand_key >= r.k AND w.rus_word <> %(ex_word)s
+                             ORDER BY uw.rand_key LIMIT 1)
+                           UNION ALL
+                           (SELECT w.rus_word
+                              FROM userwords uw
+                              JOIN words w
+                                ON w.word_id = uw.word_id
+                             WHERE uw.user_id = %(user_id)s AND w.rus_word <> %(ex_word)s
+                             ORDER BY uw.rand_key LIMIT 1)
+                           LIMIT 1
+                     ) AS s
+                     LIMIT %(count)s
+                    """, {'user_id': user_id, 'ex_word': ex_word, 'count': count, 'probes': count * SAMPLE_PROBES_FACTOR})
             result = cur.fetchall()
 
             # Если слов в пользовательском словаре меньше чем нужно, берем слова из общего словаря
@@ -249,13 +601,26 @@ def take_other_words(conn, user_id, ex_word, lang, count=5):
 
         else:
             cur.execute("""
-                    SELECT w.en_word
-                      FROM words w
-                      JOIN userwords uw
-                        ON w.word_id = uw.word_id
-                     WHERE uw.user_id = %s AND w.en_word <> %s
-                     ORDER BY RANDOM() LIMIT %s
-                    """, (user_id, ex_word, count))
+                    SELECT DISTINCT s.en_word
+                      FROM (SELECT random() AS k FROM generate_series(1, %(probes)s)) AS r
+                     CROSS JOIN LATERAL (
+                           (SELECT w.en_word
+                              FROM userwords uw
+                              JOIN words w
+                                ON w.word_id = uw.word_id
+                             WHERE uw.user_id = %(user_id)s AND uw.rand_key >= r.k AND w.en_word <> %(ex_word)s
+                             ORDER BY uw.rand_key LIMIT 1)
+                           UNION ALL
+                           (SELECT w.en_word
+                              FROM userwords uw
+                              JOIN words w
+                                ON w.word_id = uw.word_id
+                             WHERE uw.user_id = %(user_id)s AND w.en_word <> %(ex_word)s
+                             ORDER BY uw.rand_key LIMIT 1)
+                           LIMIT 1
+                     ) AS s
+                     LIMIT %(count)s
+                    """, {'user_id': user_id, 'ex_word': ex_word, 'count': count, 'probes': count * SAMPLE_PROBES_FACTOR})
             result = cur.fetchall()
             if len(result) < count:
                 limit = count - len(result)
@@ -270,65 +635,742 @@ def take_other_words(conn, user_id, ex_word, lang, count=5):
         return [x[0] for x in result]
 
 
-def del_word(conn, user_id, word):
+@metrics.timed(metrics.db_seconds)
+def load_vocabulary(conn, user_id, pending=None):
     """
-    Функция удаляет слово из БД
+    Функция загружает словарь пользователя в кэш словарей
     :param conn: объект connection
     :param user_id: номер пользователя в telegram
-    :param word: слово, которое надо удалить
-    :return: количество строк в результате выполнения функции
+    :param pending: функция от user_id, возвращающая еще не записанные в БД ответы пользователя
+    {word_id: (правильных, неправильных)}. Вызывается после начала загрузки: ответ, пришедший позже,
+    меняет словарь во время загрузки, и загруженный снимок в кэш не попадает
+    :return: объект UserVocabulary или None если пользователя нет, словарь слишком большой для кэша
+    или менялся во время загрузки
     """
-    word = word.lower()
-    with conn.cursor() as cur:
-        # Получаем id удаляемого слова
-        word_id = find_word(conn, word)
-        if word_id is not None:
+    generation = vocab_cache.begin_load(user_id)
+    try:
+        answers = pending(user_id) if pending else {}
+        with conn.cursor() as cur:
             cur.execute("""
+                    SELECT u.name, w.word_id, w.rus_word, w.en_word, uw.right_answer, uw.wrong_answer,
+                           extract(epoch FROM uw.due_at), uw.ease, uw.interval_days, uw.reps
+                      FROM users u
+                      LEFT JOIN userwords uw
+                        ON uw.user_id = u.user_id
+                      LEFT JOIN words w
+                        ON w.word_id = uw.word_id
+                     WHERE u.user_id = %s
+                     LIMIT %s
+                    """, (user_id, VOCAB_CACHE_MAX_WORDS + 1))
+            rows = cur.fetchall()
+        if not rows:
+            return None
+        if len(rows) > VOCAB_CACHE_MAX_WORDS:
+            vocab_cache.mark_too_large(user_id)
+            return None
+
+        vocab = UserVocabulary(rows[0][0])
+        for _, word_id, rus_word, en_word, right, wrong, due_at, ease, interval_days, reps in rows:
+            if word_id is not None:
+                vocab.add(word_id, rus_word, en_word, right, wrong, float(due_at), ease, interval_days, reps)
+        for word_id, (right, wrong) in answers.items():
+            vocab.add_answers(word_id, right, wrong)
+        return vocab if vocab_cache.put(user_id, vocab, generation) else None
+    finally:
+        vocab_cache.end_load(user_id)
+
+
+# Запрос сборки карточки, общий для синхронного и асинхронного (db.async_db) доступа к БД
+BUILD_CARD_SQL = """
+            WITH target AS (
+                -- Случайная пара из 5 слов пользователя с самым ранним сроком повторения
+                -- (слова с незаписанными ответами - в последнюю очередь),
+                -- если у пользователя нет слов - из предустановленных
+                (SELECT word_id, rus_word, en_word
+                   FROM (
+                        SELECT w.word_id, w.rus_word, w.en_word
+                          FROM userwords uw
+                          JOIN words w
+                            ON w.word_id = uw.word_id
+                         WHERE uw.user_id = %(user_id)s
+                         ORDER BY uw.due_at
+                         LIMIT 5 + cardinality(%(p_ids)s::int[])
+                   ) as top
+                  ORDER BY top.word_id = ANY(%(p_ids)s::int[]), RANDOM()
+                  LIMIT 1)
+                UNION ALL
+                (SELECT word_id, rus_word, en_word
+                   FROM (
+                        SELECT word_id, rus_word, en_word
+                          FROM words
+                         LIMIT 10
+                   ) as start_words
+                  ORDER BY RANDOM()
+                  LIMIT 1)
+                LIMIT 1
+            ),
+            answer AS (
+                SELECT CASE WHEN %(lang)s = 'ru' THEN rus_word ELSE en_word END AS word
+                  FROM target
+            ),
+            others AS (
+                -- Неправильные варианты из словаря пользователя (случайные пробы индекса по rand_key),
+                -- недостающие - из общего словаря
+                SELECT word, MIN(prio) AS prio
+                  FROM (
+                        (SELECT s.word, 0 AS prio
+                           FROM (SELECT random() AS k FROM generate_series(1, %(probes)s)) AS r
+                          CROSS JOIN LATERAL (
+                                (SELECT CASE WHEN %(lang)s = 'ru' THEN w.rus_word ELSE w.en_word END AS word
+                                   FROM userwords uw
+                                   JOIN words w
+                                     ON w.word_id = uw.word_id
+                                  WHERE uw.user_id = %(user_id)s AND uw.rand_key >= r.k
+                                    AND CASE WHEN %(lang)s = 'ru' THEN w.rus_word ELSE w.en_word END
+                                        <> (SELECT word FROM answer)
+                                  ORDER BY uw.rand_key LIMIT 1)
+                                UNION ALL
+                                (SELECT CASE WHEN %(lang)s = 'ru' THEN w.rus_word ELSE w.en_word END AS word
+                                   FROM userwords uw
+                                   JOIN words w
+                                     ON w.word_id = uw.word_id
+                                  WHERE uw.user_id = %(user_id)s
+                                    AND CASE WHEN %(lang)s = 'ru' THEN w.rus_word ELSE w.en_word END
+                                        <> (SELECT word FROM answer)
+                                  ORDER BY uw.rand_key LIMIT 1)
+                                LIMIT 1
+                          ) AS s)
+                        UNION ALL
+                        (SELECT CASE WHEN %(lang)s = 'ru' THEN rus_word ELSE en_word END AS word, 1 AS prio
+                           FROM words
+                          WHERE CASE WHEN %(lang)s = 'ru' THEN rus_word ELSE en_word END
+                                <> (SELECT word FROM answer)
+                          LIMIT %(count)s * 2)
+                  ) as candidates
+                 GROUP BY word
+            )
+            SELECT (SELECT name FROM users WHERE user_id = %(user_id)s),
+                   t.word_id, t.rus_word, t.en_word,
+                   ARRAY(SELECT word FROM others ORDER BY prio LIMIT %(count)s)
+              FROM target t
+            """
+
+
+@metrics.timed(metrics.db_seconds)
+def build_card(conn, user_id, lang, count=5, pending=None):
+    """
+    Функция за один запрос к БД собирает карточку: проверяет пользователя,
+    выбирает пару слов для перевода и случайные неправильные варианты ответов
+    :param conn: объект connection
+    :param user_id: номер пользователя в telegram
+    :param lang: язык вариантов ответа ('ru' или 'en')
+    :param count: количество неправильных вариантов ответа
+    :param pending: функция от user_id, возвращающая еще не записанные в БД ответы пользователя
+    {word_id: (правильных, неправильных)}, или None
+    :return: словарь с ключами user_name, word_id, rus_word, en_word, others
+    или None если в БД нет ни одного слова
+    """
+    # Карточку собираем в памяти, если словарь пользователя есть в кэше или его можно туда загрузить.
+    # Если словарь менялся во время загрузки, карточка собирается запросом к БД
+    card = vocab_cache.read(user_id, 'build_card', lang, count)
+    if card is not None:
+        return card
+    if vocab_cache.is_cacheable(user_id):
+        vocab = load_vocabulary(conn, user_id, pending)
+        if vocab is not None:
+            with vocab_cache.lock:
+                return vocab.build_card(lang, count)
+
+    with conn.cursor() as cur:
+        cur.execute(BUILD_CARD_SQL, {'user_id': user_id, 'lang': lang, 'count': count,
+                                     'probes': count * SAMPLE_PROBES_FACTOR,
+                                     **_pending_params(pending(user_id) if pending else None)})
+        result = cur.fetchone()
+        if result is None:
+            return None
+
+        return {
+            'user_name': result[0],
+            'word_id': result[1],
+            'rus_word': result[2],
+            'en_word': result[3],
+            'others': result[4],
+        }
+
+
+# Удаление слова из словаря пользователя вместе с его вкладом в статистику, общее для db.db и db.async_db
+DEL_WORD_SQL = """
+                WITH deleted AS (
                     DELETE FROM userwords
-                     WHERE user_id = %s 
-                       AND word_id = %s;
-                    """, (user_id, word_id))
-            conn.commit()
-            return cur.rowcount
-        else:
-            return 0
+                     WHERE user_id = %(user_id)s
+                       AND word_id = %(word_id)s
+                    RETURNING user_id, right_answer, wrong_answer
+                )
+                INSERT INTO user_stats AS s (user_id, words, learned, right_answers, wrong_answers)
+                SELECT user_id, -1, -""" + is_learned_sql('right_answer') + """, -right_answer, -wrong_answer
+                  FROM deleted
+                """ + STATS_UPSERT
+
+
+@metrics.timed(metrics.db_seconds)
+def del_word(conn, user_id, word_id):
+    """
+    Функция удаляет слово из словаря пользователя
+    :param conn: объект connection
+    :param user_id: номер пользователя в telegram
+    :param word_id: id слова, которое надо удалить
+    :return: количество строк в результате выполнения функции
+    """
+    with conn.cursor() as cur:
+        cur.execute(DEL_WORD_SQL, {'user_id': user_id, 'word_id': word_id})
+        conn.commit()
+        vocab_cache.remove_word(user_id, word_id)
+        return cur.rowcount
+
+
+# Запросы поиска по словарю пользователя, общие для db.db и db.async_db. Слова ищутся в words по индексам
+# (по началу слова и, если есть pg_trgm, по триграммам), принадлежность словарю пользователя проверяется
+# по ограничению user_word. Совпадения по началу слова идут первыми, остальные - по убыванию похожести
+_USER_WORD_EXISTS = """
+               AND EXISTS (SELECT 1
+                             FROM userwords uw
+                            WHERE uw.user_id = %(user_id)s
+                              AND uw.word_id = w.word_id)"""
+SEARCH_PREFIX_SQL = """
+            SELECT w.word_id, w.rus_word, w.en_word, count(*) OVER ()
+              FROM words w
+             WHERE (w.rus_word LIKE %(pattern)s OR w.en_word LIKE %(pattern)s)""" + _USER_WORD_EXISTS + """
+             ORDER BY w.rus_word, w.en_word
+             LIMIT %(limit)s OFFSET %(offset)s;
+            """
+# w %> text - слово text похоже на часть w с похожестью не ниже pg_trgm.word_similarity_threshold
+SEARCH_TRIGRAM_SQL = """
+            SELECT w.word_id, w.rus_word, w.en_word, count(*) OVER ()
+              FROM words w
+             WHERE (w.rus_word LIKE %(pattern)s OR w.en_word LIKE %(pattern)s
+                    OR w.rus_word %%> %(text)s OR w.en_word %%> %(text)s)""" + _USER_WORD_EXISTS + """
+             ORDER BY (w.rus_word LIKE %(pattern)s OR w.en_word LIKE %(pattern)s) DESC,
+                      GREATEST(word_similarity(%(text)s, w.rus_word), word_similarity(%(text)s, w.en_word)) DESC,
+                      w.rus_word, w.en_word
+             LIMIT %(limit)s OFFSET %(offset)s;
+            """
+# Просмотр словаря без запроса: последние добавленные слова по индексу user_word,
+# количество слов - отдельным подсчетом по тому же индексу, без чтения words
+LIST_WORDS_SQL = """
+            SELECT w.word_id, w.rus_word, w.en_word,
+                   (SELECT count(*) FROM userwords WHERE user_id = %(user_id)s)
+              FROM userwords uw
+              JOIN words w ON w.word_id = uw.word_id
+             WHERE uw.user_id = %(user_id)s
+             ORDER BY uw.word_id DESC
+             LIMIT %(limit)s OFFSET %(offset)s;
+            """
+
+
+def search_query(user_id, text, limit, offset=0):
+    """
+    Функция выбирает запрос поиска слов и его параметры
+    :param user_id: номер пользователя в telegram
+    :param text: искомое слово или его начало, пустая строка - весь словарь
+    :param limit: количество слов на странице
+    :param offset: сколько слов пропустить
+    :return: кортеж (текст запроса, словарь параметров)
+    """
+    text = ' '.join(text.lower().split())
+    # Спецсимволы LIKE в искомом тексте экранируем, чтобы искать их буквально
+    pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    if not text:
+        sql = LIST_WORDS_SQL
+    elif trigram_search:
+        sql = SEARCH_TRIGRAM_SQL
+    else:
+        sql = SEARCH_PREFIX_SQL
+    return sql, {'user_id': user_id, 'text': text, 'pattern': pattern, 'limit': limit, 'offset': offset}
 
-def add_right_answer(conn, user_id, word):
+
+@metrics.timed(metrics.db_seconds)
+def search_words(conn, user_id, text, limit, offset=0):
     """
-    Функция увеличивает на 1 счетчик правильных ответов для слова
+    Функция ищет слова в словаре пользователя по началу русского или английского слова,
+    а если в БД есть pg_trgm - и с опечатками
     :param conn: объект connection
     :param user_id: номер пользователя в telegram
-    :param word: слово для которого надо увеличить счетчик
+    :param text: искомое слово или его начало, пустая строка - весь словарь
+    :param limit: количество слов на странице
+    :param offset: сколько слов пропустить
+    :return: кортеж (list кортежей (word_id, русское слово, английское слово), количество найденных слов)
+    """
+    sql, params = search_query(user_id, text, limit, offset)
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    return [row[:3] for row in rows], rows[0][3] if rows else 0
+
+
+@metrics.timed(metrics.db_seconds)
+def log_answers(conn, events):
+    """
+    Функция дописывает ответы в журнал answers одной командой COPY
+    :param conn: объект connection
+    :param events: list из кортежей (user_id, word_id, правильный ли ответ, время ответа time.time(),
+    секунд от показа карточки до ответа или None)
     :return: None
     """
-    word_id = find_word(conn, word)
-    if word_id is not None:
-        with conn.cursor() as cur:
-            cur.execute("""
-                    UPDATE userwords
-                       SET right_answer = right_answer + 1
-                     WHERE user_id = %s AND word_id = %s;
-                    """, (user_id, word_id))
+    buffer = io.StringIO()
+    for user_id, word_id, correct, answered_at, latency in events:
+        buffer.write('\t'.join((str(user_id), str(word_id), 't' if correct else 'f',
+                                datetime.fromtimestamp(answered_at, timezone.utc).isoformat(),
+                                '\\N' if latency is None else repr(float(latency)))) + '\n')
+    buffer.seek(0)
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock_shared(%s)', (ANSWERS_LOCK_KEY,))
+        cur.copy_expert('COPY answers (user_id, word_id, correct, answered_at, latency) FROM STDIN', buffer)
+        conn.commit()
+
+
+@metrics.timed(metrics.db_seconds)
+def compact_answers(conn, limit):
+    """
+    Функция сворачивает еще не учтенные события журнала answers в счетчики ответов и расписание userwords.
+    Это единственное место, где ответы попадают в userwords. Расписание каждого слова пересчитывается
+    один раз: если среди ответов есть неправильный, слово повторяется заново
+    :param conn: объект connection
+    :param limit: сколько событий свернуть за раз
+    :return: количество свернутых событий
+    """
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (ANSWERS_LOCK_KEY,))
+        cur.execute("""
+                WITH batch AS (
+                    SELECT a.answer_id, a.user_id, a.word_id, a.correct, a.answered_at
+                      FROM answers a
+                     WHERE a.answer_id > (SELECT last_answer_id FROM answers_compacted)
+                     ORDER BY a.answer_id
+                     LIMIT %(limit)s
+                ), d AS (
+                    SELECT user_id, word_id,
+                           count(*) FILTER (WHERE correct) AS right_delta,
+                           count(*) FILTER (WHERE NOT correct) AS wrong_delta
+                      FROM batch
+                     GROUP BY user_id, word_id
+                ), updated AS (
+                    UPDATE userwords uw
+                       SET right_answer = uw.right_answer + d.right_delta,
+                           wrong_answer = uw.wrong_answer + d.wrong_delta,
+                           """ + schedule_sql('d.wrong_delta = 0') + """
+                      FROM d
+                     WHERE uw.user_id = d.user_id AND uw.word_id = d.word_id
+                    RETURNING uw.user_id, uw.right_answer, d.right_delta, d.wrong_delta
+                ), counters AS (
+                    SELECT user_id, sum(""" + learned_sql('right_answer', 'right_delta') + """) AS learned,
+                           sum(right_delta) AS right_delta, sum(wrong_delta) AS wrong_delta
+                      FROM updated
+                     GROUP BY user_id
+                ), """ + streaks_sql('batch').lstrip() + """, stats AS (
+                    -- Статистику ведем только для существующих пользователей: у журнала нет внешних ключей
+                    INSERT INTO user_stats AS s (user_id, learned, right_answers, wrong_answers, streak, last_day)
+                    SELECT st.user_id, coalesce(c.learned, 0), coalesce(c.right_delta, 0), coalesce(c.wrong_delta, 0),
+                           st.streak, st.last_day
+                      FROM streaks st
+                      JOIN users u ON u.user_id = st.user_id
+                      LEFT JOIN counters c ON c.user_id = st.user_id
+                    """ + STATS_UPSERT + """
+                )
+                UPDATE answers_compacted
+                   SET last_answer_id = (SELECT max(answer_id) FROM batch)
+                 WHERE EXISTS (SELECT 1 FROM batch)
+                RETURNING (SELECT count(*) FROM batch)
+                """, {'limit': limit})
+        row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else 0
+
+
+@metrics.timed(metrics.db_seconds)
+def refresh_ranks(conn):
+    """
+    Функция пересчитывает места пользователей в таблице лидеров
+    :param conn: объект connection
+    :return: количество пользователей, у которых место изменилось
+    """
+    with conn.cursor() as cur:
+        cur.execute(REFRESH_RANKS_SQL)
+        conn.commit()
+        return cur.rowcount
+
+
+def stats_from_row(row):
+    """
+    Функция переводит строку FIND_STATS_SQL в словарь статистики
+    :param row: строка результата запроса или None
+    :return: словарь статистики или None если пользователя нет в БД
+    """
+    if row is None:
+        return None
+    name, words, learned, right, wrong, streak, rank = row
+    return {'user_name': name, 'words': words or 0, 'learned': learned or 0, 'right': right or 0,
+            'wrong': wrong or 0, 'streak': streak or 0, 'rank': rank if words is not None else None}
+
+
+@metrics.timed(metrics.db_seconds)
+def find_stats(conn, user_id):
+    """
+    Функция читает сводную статистику пользователя
+    :param conn: объект connection
+    :param user_id: номер пользователя в telegram
+    :return: словарь с ключами user_name, words, learned, right, wrong, streak, rank (место в таблице лидеров
+    на момент последнего пересчета или None если его еще нет) или None если пользователя нет в БД
+    """
+    with conn.cursor() as cur:
+        cur.execute(FIND_STATS_SQL, {'user_id': user_id})
+        return stats_from_row(cur.fetchone())
+
+
+@metrics.timed(metrics.db_seconds)
+def find_leaderboard(conn, count):
+    """
+    Функция читает таблицу лидеров по количеству выученных слов, затем по количеству правильных ответов
+    :param conn: объект connection
+    :param count: количество пользователей
+    :return: list кортежей (user_id, имя, выучено слов, правильных ответов, неправильных ответов)
+    """
+    with conn.cursor() as cur:
+        cur.execute(LEADERBOARD_SQL, {'count': count})
+        return cur.fetchall()
+
+
+def rebuild_stats(conn, save=True):
+    """
+    Функция пересчитывает статистику всех пользователей с нуля для проверки приращений.
+    На время пересчета приостанавливаются изменения статистики и запись журнала ответов
+    :param conn: объект connection
+    :param save: False - только сравнить с текущей статистикой и откатить пересчет
+    :return: кортеж (количество пользователей, количество пользователей, у которых статистика расходилась)
+    """
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (ANSWERS_LOCK_KEY,))
+        cur.execute('LOCK TABLE user_stats IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute(REBUILD_STATS_SQL)
+        result = cur.fetchone()
+        if save:
+            cur.execute(REFRESH_RANKS_SQL)
             conn.commit()
+        else:
+            conn.rollback()
+        return result
+
+
+@metrics.timed(metrics.db_seconds)
+def find_translation(conn, source_text, ttl, negative_ttl):
+    """
+    Функция ищет сохраненный перевод в кэше переводов
+    :param conn: объект connection
+    :param source_text: нормализованный текст для перевода
+    :param ttl: сколько секунд действителен найденный перевод
+    :param negative_ttl: сколько секунд действительна запись о неудачном переводе
+    :return: кортеж (перевод или None) если запись есть и не устарела, иначе None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                SELECT result
+                  FROM translations
+                 WHERE source_text = %s
+                   AND updated_at > now() - make_interval(secs => CASE WHEN result IS NULL THEN %s ELSE %s END)
+                """, (source_text, negative_ttl, ttl))
+        return cur.fetchone()
+
+
+@metrics.timed(metrics.db_seconds)
+def save_translation(conn, source_text, result):
+    """
+    Функция сохраняет перевод в кэш переводов
+    :param conn: объект connection
+    :param source_text: нормализованный текст для перевода
+    :param result: словарь с переводом или None если перевести не удалось
+    :return: None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                INSERT INTO translations (source_text, result)
+                VALUES (%s, %s)
+                ON CONFLICT (source_text)
+                DO UPDATE SET result = EXCLUDED.result, updated_at = now()
+                """, (source_text, Json(result) if result is not None else None))
+        conn.commit()
+
+
+@metrics.timed(metrics.db_seconds)
+def find_translations(conn, source_texts, ttl, negative_ttl):
+    """
+    Функция ищет сохраненные переводы нескольких текстов одним запросом
+    :param conn: объект connection
+    :param source_texts: list нормализованных текстов
+    :param ttl: сколько секунд действителен найденный перевод
+    :param negative_ttl: сколько секунд действительна запись о неудачном переводе
+    :return: словарь {текст: перевод или None} для найденных и не устаревших записей
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                SELECT source_text, result
+                  FROM translations
+                 WHERE source_text = ANY(%s)
+                   AND updated_at > now() - make_interval(secs => CASE WHEN result IS NULL THEN %s ELSE %s END)
+                """, (list(source_texts), negative_ttl, ttl))
+        return dict(cur.fetchall())
+
+
+@metrics.timed(metrics.db_seconds)
+def save_translations(conn, items):
+    """
+    Функция сохраняет несколько переводов в кэш переводов одним запросом
+    :param conn: объект connection
+    :param items: list из пар (нормализованный текст, словарь с переводом или None)
+    :return: None
+    """
+    with conn.cursor() as cur:
+        execute_values(cur, """
+                INSERT INTO translations (source_text, result)
+                VALUES %s
+                ON CONFLICT (source_text)
+                DO UPDATE SET result = EXCLUDED.result, updated_at = now()
+                """, [(text, Json(result) if result is not None else None) for text, result in dict(items).items()],
+                       page_size=max(len(items), 1))
+        conn.commit()
+
+
+@metrics.timed(metrics.db_seconds)
+def add_words_bulk(conn, user_id, pairs):
+    """
+    Функция сохраняет список пар RU-EN слов в словарь пользователя одной транзакцией
+    :param conn: объект connection
+    :param user_id: номер пользователя в telegram
+    :param pairs: list из пар (русское слово, английское слово)
+    :return: количество слов, добавленных в словарь пользователя
+    """
+    pairs = list(dict.fromkeys((ru_word.lower(), en_word.lower()) for ru_word, en_word in pairs))
+    if not pairs:
+        return 0
+    with conn.cursor() as cur:
+        execute_values(cur, """
+                INSERT INTO words (rus_word, en_word)
+                VALUES %s
+                ON CONFLICT ON CONSTRAINT ru_en
+                DO NOTHING
+                """, pairs, page_size=len(pairs))
+        added = execute_values(cur, """
+                WITH added AS (
+                    INSERT INTO userwords (user_id, word_id)
+                    SELECT p.user_id, w.word_id
+                      FROM (VALUES %s) AS p(user_id, rus_word, en_word)
+                      JOIN words w
+                        ON w.rus_word = p.rus_word AND w.en_word = p.en_word
+                    ON CONFLICT ON CONSTRAINT user_word
+                    DO NOTHING
+                    RETURNING user_id
+                ), stats AS (
+                    INSERT INTO user_stats AS s (user_id, words)
+                    SELECT user_id, count(*)
+                      FROM added
+                     GROUP BY user_id
+                    """ + STATS_UPSERT + """
+                )
+                SELECT count(*)
+                  FROM added
+                """, [(user_id, ru_word, en_word) for ru_word, en_word in pairs], page_size=len(pairs), fetch=True)
+        conn.commit()
+        vocab_cache.invalidate(user_id)
+        return added[0][0]
+
+
+# Колонки выгрузки и загрузки словаря пользователя: пара слов, счетчики ответов и расписание повторения
+TRANSFER_COLUMNS = ('rus_word', 'en_word', 'right_answer', 'wrong_answer', 'due_at', 'ease', 'interval_days', 'reps')
+
+
+def iter_user_words(conn, user_id, chunk_size=TRANSFER_CHUNK_SIZE):
+    """
+    Функция читает словарь пользователя именованным (серверным) курсором: в памяти не больше chunk_size строк,
+    сколько бы слов ни было в словаре
+    :param conn: объект connection, занят до окончания чтения
+    :param user_id: номер пользователя в telegram
+    :param chunk_size: сколько строк получать с сервера за раз
+    :return: генератор кортежей со значениями TRANSFER_COLUMNS
+    """
+    with conn.cursor(name='export_words') as cur:
+        cur.itersize = chunk_size
+        cur.execute("""
+                SELECT w.rus_word, w.en_word, uw.right_answer, uw.wrong_answer,
+                       uw.due_at, uw.ease, uw.interval_days, uw.reps
+                  FROM userwords uw
+                  JOIN words w ON w.word_id = uw.word_id
+                 WHERE uw.user_id = %s
+                 ORDER BY uw.word_id
+                """, (user_id,))
+        yield from cur
+    conn.rollback()
+
 
+def _copy_value(value):
+    # Значение колонки в текстовом формате COPY
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
 
-def add_wrong_answer(conn, user_id, word):
+
+class CopyStream:
+    """
+    Файл только для чтения для copy_expert: строки COPY собираются из итератора строк таблицы по мере чтения,
+    поэтому в памяти не больше одного куска, который запросил copy_expert
     """
-    Функция увеличивает на 1 счетчик неправильных ответов для слова
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            line = '\t'.join(_copy_value(value) for value in row) + '\n'
+            parts.append(line)
+            length += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+@metrics.timed(metrics.db_seconds)
+def import_user_words(conn, user_id, rows):
+    """
+    Функция загружает слова в словарь пользователя потоком через COPY FROM STDIN во временную таблицу.
+    Пары, которые уже есть в words, не дублируются (ограничение ru_en), слова, которые уже есть
+    в словаре пользователя, остаются со своими счетчиками (ограничение user_word)
     :param conn: объект connection
     :param user_id: номер пользователя в telegram
-    :param word: слово для которого надо увеличить счетчик
+    :param rows: итерируемый набор кортежей со значениями TRANSFER_COLUMNS, None - значение по умолчанию
+    :return: количество слов, добавленных в словарь пользователя
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                CREATE TEMP TABLE import_words(
+                    rus_word VARCHAR(100) NOT NULL,
+                    en_word VARCHAR(100) NOT NULL,
+                    right_answer INTEGER,
+                    wrong_answer INTEGER,
+                    due_at TIMESTAMPTZ,
+                    ease REAL,
+                    interval_days REAL,
+                    reps INTEGER
+                ) ON COMMIT DROP
+                """)
+        cur.copy_expert(f'COPY import_words ({", ".join(TRANSFER_COLUMNS)}) FROM STDIN', CopyStream(rows))
+        cur.execute("""
+                INSERT INTO words (rus_word, en_word)
+                SELECT DISTINCT rus_word, en_word
+                  FROM import_words
+                ON CONFLICT ON CONSTRAINT ru_en
+                DO NOTHING
+                """)
+        cur.execute("""
+                WITH added AS (
+                    INSERT INTO userwords (user_id, word_id, right_answer, wrong_answer, due_at, ease,
+                                           interval_days, reps)
+                    SELECT DISTINCT ON (w.word_id)
+                           %(user_id)s, w.word_id, coalesce(i.right_answer, 0), coalesce(i.wrong_answer, 0),
+                           coalesce(i.due_at, now()), coalesce(i.ease, %(start_ease)s),
+                           coalesce(i.interval_days, 0), coalesce(i.reps, 0)
+                      FROM import_words i
+                      JOIN words w
+                        ON w.rus_word = i.rus_word AND w.en_word = i.en_word
+                     ORDER BY w.word_id
+                    ON CONFLICT ON CONSTRAINT user_word
+                    DO NOTHING
+                    RETURNING user_id, right_answer, wrong_answer
+                ), stats AS (
+                    INSERT INTO user_stats AS s (user_id, words, learned, right_answers, wrong_answers)
+                    SELECT user_id, count(*), sum(""" + is_learned_sql('right_answer') + """),
+                           sum(right_answer), sum(wrong_answer)
+                      FROM added
+                     GROUP BY user_id
+                    """ + STATS_UPSERT + """
+                )
+                SELECT count(*)
+                  FROM added
+                """, {'user_id': user_id, 'start_ease': START_EASE})
+        added = cur.fetchone()[0]
+        conn.commit()
+        vocab_cache.invalidate(user_id)
+        return added
+
+
+@metrics.timed(metrics.db_seconds)
+def save_random_words(conn, words):
+    """
+    Функция сохраняет в БД запас случайных слов
+    :param conn: объект connection
+    :param words: list случайных слов
     :return: None
     """
-    word_id = find_word(conn, word)
-    if word_id is not None:
-        with conn.cursor() as cur:
-            cur.execute("""
-                    UPDATE userwords
-                       SET wrong_answer = wrong_answer + 1
-                     WHERE user_id = %s AND word_id = %s;
-                    """, (user_id, word_id))
-            conn.commit()
+    with conn.cursor() as cur:
+        execute_values(cur, """
+                INSERT INTO random_words (word)
+                VALUES %s
+                ON CONFLICT (word)
+                DO NOTHING
+                """, [(word,) for word in words], page_size=max(len(words), 1))
+        conn.commit()
+
+
+@metrics.timed(metrics.db_seconds)
+def take_saved_random_words(conn, count):
+    """
+    Функция забирает из БД сохраненные случайные слова, удаляя их из запаса
+    :param conn: объект connection
+    :param count: количество слов
+    :return: list случайных слов
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                DELETE FROM random_words
+                 WHERE word IN (
+                       SELECT word
+                         FROM random_words
+                        LIMIT %s
+                          FOR UPDATE SKIP LOCKED
+                 )
+                RETURNING word
+                """, (count,))
+        result = [x[0] for x in cur.fetchall()]
+        conn.commit()
+        return result
+
+
+@metrics.timed(metrics.db_seconds)
+def take_local_random_word(conn):
+    """
+    Функция выбирает случайное английское слово из общего словаря без сортировки всей таблицы
+    :param conn: объект connection
+    :return: str английское слово или None если словарь пуст
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+                SELECT en_word
+                  FROM words
+                 WHERE word_id >= (SELECT floor(random() * max(word_id)) FROM words)
+                 ORDER BY word_id
+                 LIMIT 1
+                """)
+        result = cur.fetchone()
+        if result is not None:
+            return result[0]
+
+        return result
+
 
 if __name__ == '__main__':
     conn = create_db_connection()
@@ -0,0 +1,48 @@
+from config import SCHEDULER_RELEARN_DELAY, SCHEDULER_MAX_INTERVAL
+
+# Параметры алгоритма SM-2: правильный ответ считается оценкой 5, неправильный - оценкой 2
+START_EASE = 2.5
+MIN_EASE = 1.3
+EASE_BONUS = 0.1
+EASE_PENALTY = 0.32
+
+DAY = 24 * 60 * 60
+
+
+def next_review(ease, interval_days, reps, correct):
+    """
+    Функция пересчитывает расписание повторения слова по алгоритму SM-2
+    :param ease: коэффициент легкости слова
+    :param interval_days: текущий интервал повторения в днях
+    :param reps: количество правильных ответов подряд
+    :param correct: True если ответ правильный
+    :return: кортеж (ease, interval_days, reps, через сколько секунд повторить)
+    """
+    if not correct:
+        return max(MIN_EASE, ease - EASE_PENALTY), 0.0, 0, SCHEDULER_RELEARN_DELAY
+    if reps == 0:
+        interval_days = 1.0
+    elif reps == 1:
+        interval_days = 6.0
+    else:
+        interval_days = min(interval_days * ease, SCHEDULER_MAX_INTERVAL)
+    return ease + EASE_BONUS, interval_days, reps + 1, interval_days * DAY
+
+
+def schedule_sql(correct):
+    """
+    Функция возвращает SQL выражения SET для пересчета расписания строки userwords uw,
+    те же вычисления, что и в next_review
+    :param correct: SQL выражение, истинное при правильном ответе
+    :return: str фрагмент SET запроса UPDATE
+    """
+    interval = f"""CASE WHEN uw.reps = 0 THEN 1
+                        WHEN uw.reps = 1 THEN 6
+                        ELSE LEAST(uw.interval_days * uw.ease, {SCHEDULER_MAX_INTERVAL}) END"""
+    return f"""
+        ease = CASE WHEN {correct} THEN uw.ease + {EASE_BONUS}
+                    ELSE GREATEST({MIN_EASE}, uw.ease - {EASE_PENALTY}) END,
+        interval_days = CASE WHEN {correct} THEN {interval} ELSE 0 END,
+        reps = CASE WHEN {correct} THEN uw.reps + 1 ELSE 0 END,
+        due_at = now() + CASE WHEN {correct} THEN interval '1 day' * ({interval})
+                              ELSE interval '1 second' * {SCHEDULER_RELEARN_DELAY} END"""
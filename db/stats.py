@@ -0,0 +1,166 @@
+import argparse
+
+from config import STATS_LEARNED_ANSWERS, STATS_TIMEZONE
+
+# Сводная статистика пользователей в user_stats ведется приращениями в тех же запросах, что меняют userwords
+# и сворачивают журнал ответов, поэтому /stats и таблица лидеров читают готовые значения без агрегации userwords.
+# Слово считается выученным после STATS_LEARNED_ANSWERS правильных ответов: счетчик правильных ответов
+# только растет, и момент, когда слово стало выученным, видно по самому приращению.
+# Серия - количество дней подряд с ответами, дни считаются в часовом поясе STATS_TIMEZONE
+
+
+def day_sql(column):
+    """
+    Функция возвращает SQL выражение дня в часовом поясе STATS_TIMEZONE
+    :param column: SQL выражение типа TIMESTAMPTZ
+    :return: str фрагмент запроса
+    """
+    return f"({column} AT TIME ZONE '{STATS_TIMEZONE}')::date"
+
+
+def learned_sql(right_answer, right_delta):
+    """
+    Функция возвращает SQL выражение: 1, если слово стало выученным после right_delta правильных ответов, иначе 0
+    :param right_answer: SQL выражение счетчика правильных ответов после обновления
+    :param right_delta: SQL выражение количества добавленных правильных ответов
+    :return: str фрагмент запроса
+    """
+    return (f"({right_answer} >= {STATS_LEARNED_ANSWERS} "
+            f"AND {right_answer} - {right_delta} < {STATS_LEARNED_ANSWERS})::int")
+
+
+def is_learned_sql(right_answer):
+    """
+    Функция возвращает SQL выражение: 1, если слово выучено, иначе 0
+    :param right_answer: SQL выражение счетчика правильных ответов
+    :return: str фрагмент запроса
+    """
+    return f"({right_answer} >= {STATS_LEARNED_ANSWERS})::int"
+
+
+def streaks_sql(events):
+    """
+    Функция возвращает CTE streaks(user_id, streak, last_day): последняя серия дней подряд с ответами
+    для каждого пользователя и ее последний день
+    :param events: имя CTE или таблицы с колонками user_id и answered_at
+    :return: str фрагмент WITH без ведущей запятой
+    """
+    return f"""
+                days AS (
+                    SELECT DISTINCT user_id, {day_sql('answered_at')} AS day
+                      FROM {events}
+                ), runs AS (
+                    -- У дней одной серии разность дня и его номера одинакова
+                    SELECT user_id, day, day - (row_number() OVER (PARTITION BY user_id ORDER BY day))::int AS run
+                      FROM days
+                ), streaks AS (
+                    SELECT DISTINCT ON (user_id) user_id, count(*)::int AS streak, max(day) AS last_day
+                      FROM runs
+                     GROUP BY user_id, run
+                     ORDER BY user_id, max(day) DESC
+                )"""
+
+
+TODAY_SQL = day_sql('now()')
+
+# Окончание INSERT INTO user_stats AS s: строка вставки содержит приращения счетчиков и последнюю серию дней.
+# Серия продолжается, если новая серия начинается не позже чем на следующий день после last_day
+STATS_UPSERT = """
+                ON CONFLICT (user_id)
+                DO UPDATE
+                   SET words = s.words + EXCLUDED.words,
+                       learned = s.learned + EXCLUDED.learned,
+                       right_answers = s.right_answers + EXCLUDED.right_answers,
+                       wrong_answers = s.wrong_answers + EXCLUDED.wrong_answers,
+                       streak = CASE WHEN EXCLUDED.last_day IS NULL THEN s.streak
+                                     WHEN s.last_day IS NULL THEN EXCLUDED.streak
+                                     WHEN s.last_day >= EXCLUDED.last_day THEN s.streak
+                                     WHEN s.last_day >= EXCLUDED.last_day - EXCLUDED.streak
+                                          THEN s.streak + (EXCLUDED.last_day - s.last_day)
+                                     ELSE EXCLUDED.streak END,
+                       last_day = GREATEST(s.last_day, EXCLUDED.last_day)"""
+
+# Статистика пользователя: чтение одной строки по первичному ключу. Серия, прерванная раньше вчерашнего дня,
+# показывается нулевой. Место в таблице лидеров читается из колонки rank, которую пересчитывает REFRESH_RANKS_SQL,
+# поэтому оно может отставать от счетчиков до следующего пересчета
+FIND_STATS_SQL = f"""
+                SELECT u.name, s.words, s.learned, s.right_answers, s.wrong_answers,
+                       CASE WHEN s.last_day >= {TODAY_SQL} - 1 THEN s.streak ELSE 0 END,
+                       s.rank
+                  FROM users u
+                  LEFT JOIN user_stats s ON s.user_id = u.user_id
+                 WHERE u.user_id = %(user_id)s;
+                """
+
+LEADERBOARD_SQL = """
+                SELECT s.user_id, u.name, s.learned, s.right_answers, s.wrong_answers
+                  FROM user_stats s
+                  JOIN users u ON u.user_id = s.user_id
+                 ORDER BY s.learned DESC, s.right_answers DESC
+                 LIMIT %(count)s;
+                """
+
+# Пересчет мест в таблице лидеров. Стоит O(количество пользователей), поэтому выполняется не при каждом чтении,
+# а после свертки журнала ответов, которая и меняет счетчики. Перезаписываются только строки, у которых место
+# изменилось. У пользователей с одинаковыми счетчиками место одно
+REFRESH_RANKS_SQL = """
+                UPDATE user_stats s
+                   SET rank = r.rank
+                  FROM (SELECT user_id, rank() OVER (ORDER BY learned DESC, right_answers DESC)::int AS rank
+                          FROM user_stats) r
+                 WHERE s.user_id = r.user_id AND s.rank IS DISTINCT FROM r.rank;
+                """
+
+# Пересчет статистики с нуля: слова и счетчики ответов - по userwords, серии - по свернутой части журнала answers.
+# Возвращает количество пересчитанных пользователей и пользователей, у которых статистика расходилась
+REBUILD_STATS_SQL = f"""
+                WITH counters AS (
+                    SELECT user_id, count(*)::int AS words,
+                           sum({is_learned_sql('right_answer')})::int AS learned,
+                           sum(right_answer) AS right_answers, sum(wrong_answer) AS wrong_answers
+                      FROM userwords
+                     GROUP BY user_id
+                ), compacted AS (
+                    SELECT user_id, answered_at
+                      FROM answers
+                     WHERE answer_id <= (SELECT last_answer_id FROM answers_compacted)
+                ), {streaks_sql('compacted').lstrip()}, rebuilt AS (
+                    SELECT u.user_id, coalesce(c.words, 0) AS words, coalesce(c.learned, 0) AS learned,
+                           coalesce(c.right_answers, 0) AS right_answers,
+                           coalesce(c.wrong_answers, 0) AS wrong_answers,
+                           coalesce(st.streak, 0) AS streak, st.last_day
+                      FROM users u
+                      LEFT JOIN counters c ON c.user_id = u.user_id
+                      LEFT JOIN streaks st ON st.user_id = u.user_id
+                ), saved AS (
+                    INSERT INTO user_stats AS s (user_id, words, learned, right_answers, wrong_answers, streak, last_day)
+                    SELECT user_id, words, learned, right_answers, wrong_answers, streak, last_day
+                      FROM rebuilt
+                    ON CONFLICT (user_id)
+                    DO UPDATE
+                       SET words = EXCLUDED.words,
+                           learned = EXCLUDED.learned,
+                           right_answers = EXCLUDED.right_answers,
+                           wrong_answers = EXCLUDED.wrong_answers,
+                           streak = EXCLUDED.streak,
+                           last_day = EXCLUDED.last_day
+                )
+                SELECT (SELECT count(*) FROM rebuilt),
+                       (SELECT count(*)
+                          FROM rebuilt r
+                          LEFT JOIN user_stats s ON s.user_id = r.user_id
+                         WHERE (r.words, r.learned, r.right_answers, r.wrong_answers, r.streak, r.last_day)
+                               IS DISTINCT FROM
+                               (s.words, s.learned, s.right_answers, s.wrong_answers, s.streak, s.last_day));
+                """
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Пересчет статистики пользователей (user_stats) с нуля')
+    parser.add_argument('--check', action='store_true', help='только сравнить с текущей статистикой, не сохраняя')
+    args = parser.parse_args()
+
+    from db.db import get_connection, rebuild_stats
+    with get_connection() as conn:
+        users, changed = rebuild_stats(conn, save=not args.check)
+    print(f'Пользователей: {users}, статистика расходилась у {changed}' + (' (не сохранено)' if args.check else ''))
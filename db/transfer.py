@@ -0,0 +1,188 @@
+import argparse
+import csv
+from datetime import datetime
+import io
+import json
+import math
+import os
+import tempfile
+
+from db.db import get_connection, iter_user_words, import_user_words, TRANSFER_COLUMNS
+from config import SCHEDULER_MAX_INTERVAL
+from db.scheduler import START_EASE, MIN_EASE
+
+# Выгрузка и загрузка словаря пользователя в CSV (с заголовком из TRANSFER_COLUMNS) или JSON Lines.
+# Строки идут из БД в файл и из файла в БД потоком, не накапливаясь в памяти
+FORMATS = ('csv', 'jsonl')
+# Наибольшая длина слова, как у колонок таблицы words
+WORD_MAX_LENGTH = 100
+# Наибольшее значение счетчиков: с запасом до предела INTEGER (2 ** 31 - 1), чтобы свертка журнала ответов
+# могла и дальше увеличивать счетчики загруженного слова
+COUNTER_MAX = 10 ** 9
+# Наибольший коэффициент легкости: SM-2 его не ограничивает, но больший коэффициент на практике не набирается,
+# а интервал повторения и так не больше SCHEDULER_MAX_INTERVAL
+EASE_MAX = 100.0
+
+
+def detect_format(file_name):
+    """
+    Функция определяет формат файла по расширению
+    :param file_name: имя файла
+    :return: 'jsonl' для .jsonl и .json, иначе 'csv'
+    """
+    return 'jsonl' if os.path.splitext(file_name or '')[1].lower() in ('.jsonl', '.json') else 'csv'
+
+
+def export_words(user_id, f, fmt='csv'):
+    """
+    Функция выгружает словарь пользователя в файл построчно
+    :param user_id: номер пользователя в telegram
+    :param f: текстовый файл, открытый на запись
+    :param fmt: формат из FORMATS
+    :return: количество выгруженных слов
+    """
+    count = 0
+    writer = csv.writer(f) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(TRANSFER_COLUMNS)
+    with get_connection() as conn:
+        for row in iter_user_words(conn, user_id):
+            values = list(row)
+            values[4] = values[4].isoformat()
+            if writer is not None:
+                writer.writerow(values)
+            else:
+                f.write(json.dumps(dict(zip(TRANSFER_COLUMNS, values)), ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def export_to_tempfile(user_id, fmt='csv'):
+    """
+    Функция выгружает словарь пользователя во временный файл на диске: файл удаляется при закрытии
+    :param user_id: номер пользователя в telegram
+    :param fmt: формат из FORMATS
+    :return: кортеж (двоичный файл, открытый на чтение с начала, количество слов)
+    """
+    f = tempfile.TemporaryFile()
+    try:
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        count = export_words(user_id, text, fmt)
+        text.flush()
+        text.detach()
+        f.seek(0)
+    except BaseException:
+        f.close()
+        raise
+    return f, count
+
+
+def read_records(f, fmt):
+    """
+    Функция читает записи файла выгрузки по одной
+    :param f: текстовый файл, открытый на чтение
+    :param fmt: формат из FORMATS
+    :return: генератор словарей колонка -> значение, None для строки, которую не удалось разобрать
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield record if isinstance(record, dict) else None
+
+
+def _word(value):
+    word = ' '.join(str(value or '').split()).lower()
+    if not word or len(word) > WORD_MAX_LENGTH:
+        raise ValueError(word)
+    return word
+
+
+def _number(value, convert, default=None, maximum=COUNTER_MAX):
+    # Бесконечность, NaN и счетчики больше maximum - ошибка строки; дробные значения больше maximum урезаются
+    if value is None or value == '':
+        return default
+    number = convert(value)
+    if not math.isfinite(number) or (convert is int and number > maximum):
+        raise ValueError(value)
+    return convert(min(max(number, 0), maximum))
+
+
+def parse_record(record):
+    """
+    Функция проверяет запись файла выгрузки и приводит ее к строке для import_user_words
+    :param record: словарь колонка -> значение
+    :return: кортеж значений TRANSFER_COLUMNS или None если запись неправильная
+    """
+    try:
+        due_at = record.get('due_at') or None
+        if due_at is not None:
+            due_at = datetime.fromisoformat(due_at).isoformat()
+        ease = _number(record.get('ease'), float, maximum=EASE_MAX)
+        return (_word(record.get('rus_word')), _word(record.get('en_word')),
+                _number(record.get('right_answer'), int, 0), _number(record.get('wrong_answer'), int, 0),
+                due_at, START_EASE if ease is None else max(ease, MIN_EASE),
+                _number(record.get('interval_days'), float, 0.0, SCHEDULER_MAX_INTERVAL),
+                _number(record.get('reps'), int, 0))
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def import_words(user_id, f, fmt='csv'):
+    """
+    Функция загружает слова из файла выгрузки в словарь пользователя одной транзакцией
+    :param user_id: номер пользователя в telegram
+    :param f: текстовый файл, открытый на чтение
+    :param fmt: формат из FORMATS
+    :return: кортеж (количество добавленных слов, количество пропущенных неправильных строк)
+    """
+    skipped = 0
+
+    def rows():
+        nonlocal skipped
+        for record in read_records(f, fmt):
+            row = parse_record(record) if record is not None else None
+            if row is None:
+                skipped += 1
+            else:
+                yield row
+
+    with get_connection() as conn:
+        added = import_user_words(conn, user_id, rows())
+    return added, skipped
+
+
+def import_bytes(user_id, data, fmt='csv'):
+    """
+    Функция загружает слова из содержимого файла выгрузки, полученного целиком (например, из Telegram)
+    :param user_id: номер пользователя в telegram
+    :param data: bytes содержимое файла в UTF-8
+    :param fmt: формат из FORMATS
+    :return: кортеж (количество добавленных слов, количество пропущенных неправильных строк)
+    """
+    with io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', errors='replace', newline='') as f:
+        return import_words(user_id, f, fmt)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Выгрузка и загрузка словаря пользователя')
+    parser.add_argument('action', choices=('export', 'import'), help='выгрузить словарь в файл или загрузить из файла')
+    parser.add_argument('user_id', type=int, help='номер пользователя в telegram')
+    parser.add_argument('file', help='файл CSV или JSON Lines')
+    parser.add_argument('--format', choices=FORMATS, help='формат файла, по умолчанию - по расширению')
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.file)
+    if args.action == 'export':
+        with open(args.file, 'w', encoding='utf-8', newline='') as f:
+            print(f'Выгружено слов: {export_words(args.user_id, f, fmt)}')
+    else:
+        with open(args.file, encoding='utf-8-sig', newline='') as f:
+            added, skipped = import_words(args.user_id, f, fmt)
+        print(f'Добавлено слов: {added}, пропущено строк: {skipped}')
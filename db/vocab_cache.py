@@ -0,0 +1,325 @@
+from array import array
+from collections import OrderedDict
+import heapq
+import random
+import sys
+import threading
+import time
+
+from config import START_WORDS, VOCAB_CACHE_MAX_BYTES, VOCAB_CACHE_MAX_WORDS
+from db.scheduler import START_EASE, next_review
+from metrics import metrics
+
+# Примерный размер пустого словаря пользователя и служебных данных на одно слово, байт
+_BASE_SIZE = 500
+_WORD_OVERHEAD = 200
+# Сколько секунд не пытаться кэшировать словарь, не поместившийся в VOCAB_CACHE_MAX_WORDS
+_TOO_LARGE_TIMEOUT = 600
+
+
+class UserVocabulary:
+    """
+    Словарь пользователя в памяти: id слов, написания, счетчики ответов и расписание повторения
+    в компактных массивах. Куча сроков повторения позволяет выбрать следующее слово без просмотра всего словаря
+    """
+    __slots__ = ('user_name', 'word_ids', 'rus_words', 'en_words', 'right', 'wrong',
+                 'due_at', 'ease', 'interval_days', 'reps', 'positions', 'heap', 'size')
+
+    def __init__(self, user_name):
+        self.user_name = user_name
+        self.word_ids = array('i')
+        self.rus_words = []
+        self.en_words = []
+        self.right = array('i')
+        self.wrong = array('i')
+        self.due_at = array('d')
+        self.ease = array('f')
+        self.interval_days = array('f')
+        self.reps = array('i')
+        # word_id -> позиция в массивах
+        self.positions = {}
+        # Куча (срок повторения, word_id), устаревшие записи удаляются при чтении
+        self.heap = []
+        self.size = _BASE_SIZE
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def _columns(self):
+        return (self.word_ids, self.rus_words, self.en_words, self.right, self.wrong,
+                self.due_at, self.ease, self.interval_days, self.reps)
+
+    def add(self, word_id, rus_word, en_word, right=0, wrong=0, due_at=None, ease=START_EASE, interval_days=0, reps=0):
+        if word_id in self.positions:
+            return
+        if due_at is None:
+            due_at = time.time()
+        self.positions[word_id] = len(self.word_ids)
+        for values, value in zip(self._columns(),
+                                 (word_id, rus_word, en_word, right, wrong, due_at, ease, interval_days, reps)):
+            values.append(value)
+        heapq.heappush(self.heap, (due_at, word_id))
+        self.size += _WORD_OVERHEAD + sys.getsizeof(rus_word) + sys.getsizeof(en_word)
+
+    def remove(self, word_id):
+        pos = self.positions.pop(word_id, None)
+        if pos is None:
+            return
+        self.size -= _WORD_OVERHEAD + sys.getsizeof(self.rus_words[pos]) + sys.getsizeof(self.en_words[pos])
+        # Переносим последнее слово на место удаляемого, запись в куче станет устаревшей
+        last = len(self.word_ids) - 1
+        if pos != last:
+            for values in self._columns():
+                values[pos] = values[last]
+            self.positions[self.word_ids[pos]] = pos
+        for values in self._columns():
+            values.pop()
+
+    def add_answers(self, word_id, right, wrong):
+        pos = self.positions.get(word_id)
+        if pos is None:
+            return
+        self.right[pos] += right
+        self.wrong[pos] += wrong
+        ease, interval_days, reps, delay = next_review(self.ease[pos], self.interval_days[pos], self.reps[pos],
+                                                       wrong == 0)
+        self.ease[pos] = ease
+        self.interval_days[pos] = interval_days
+        self.reps[pos] = reps
+        self.due_at[pos] = time.time() + delay
+        heapq.heappush(self.heap, (self.due_at[pos], word_id))
+        # Перестраиваем кучу, когда устаревших записей становится больше актуальных
+        if len(self.heap) > 2 * len(self.word_ids) + 16:
+            self.heap = [(self.due_at[i], self.word_ids[i]) for i in range(len(self.word_ids))]
+            heapq.heapify(self.heap)
+
+    def _pop_due(self):
+        """
+        Функция достает из кучи актуальную запись с самым ранним сроком повторения
+        :return: кортеж (срок, word_id) или None если куча пуста
+        """
+        while self.heap:
+            due_at, word_id = heapq.heappop(self.heap)
+            pos = self.positions.get(word_id)
+            if pos is not None and self.due_at[pos] == due_at:
+                return due_at, word_id
+        return None
+
+    def take_random_word(self):
+        """
+        Функция выбирает случайную пару из 5 слов с самым ранним сроком повторения,
+        если слов нет - из предустановленных
+        :return: кортеж (word_id, русское слово, английское слово)
+        """
+        if not self.word_ids:
+            return random.choice(START_WORDS)
+        top = []
+        while len(top) < 5:
+            item = self._pop_due()
+            if item is None:
+                break
+            top.append(item)
+        for item in top:
+            heapq.heappush(self.heap, item)
+        pos = self.positions[random.choice(top)[1]]
+        return self.word_ids[pos], self.rus_words[pos], self.en_words[pos]
+
+    def take_other_words(self, ex_word, lang, count=5):
+        """
+        Функция выбирает случайные слова пользователя, кроме ex_word, недостающие - из предустановленных
+        :param ex_word: слово, которое не должно попасть в выборку
+        :param lang: язык на котором должны быть слова
+        :param count: количество возвращаемых слов
+        :return: list из случайных слов
+        """
+        words = self.rus_words if lang == 'ru' else self.en_words
+        sample = random.sample(range(len(words)), min(len(words), count * 2))
+        start_words = [item[1] if lang == 'ru' else item[2] for item in START_WORDS]
+        result = []
+        for word in [words[i] for i in sample] + start_words:
+            if word != ex_word and word not in result:
+                result.append(word)
+                if len(result) == count:
+                    break
+        return result
+
+    def build_card(self, lang, count=5):
+        """
+        Функция собирает карточку в формате db.db.build_card
+        :param lang: язык вариантов ответа ('ru' или 'en')
+        :param count: количество неправильных вариантов ответа
+        :return: словарь с ключами user_name, word_id, rus_word, en_word, others
+        """
+        word_id, rus_word, en_word = self.take_random_word()
+        return {
+            'user_name': self.user_name,
+            'word_id': word_id,
+            'rus_word': rus_word,
+            'en_word': en_word,
+            'others': self.take_other_words(rus_word if lang == 'ru' else en_word, lang, count),
+        }
+
+
+
+class VocabCache:
+    """
+    Кэш словарей пользователей с вытеснением давно не использованных при превышении VOCAB_CACHE_MAX_BYTES.
+    Функции db.db, изменяющие словарь, обновляют кэш сразу после записи в БД
+    """
+
+    def __init__(self, max_bytes=VOCAB_CACHE_MAX_BYTES, max_words=VOCAB_CACHE_MAX_WORDS):
+        self.max_bytes = max_bytes
+        self.max_words = max_words
+        self._users = OrderedDict()
+        self._too_large = {}
+        self._size = 0
+        self._lock = threading.RLock()
+        # Функции, которые вызываются с user_id и word_id после каждого изменения словаря пользователя
+        self._listeners = []
+        # Загрузки словарей из БД: user_id -> [количество загрузок, номер изменения словаря].
+        # Изменение словаря во время загрузки делает снимок из БД устаревшим, и put() его не сохраняет
+        self._loading = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self._users)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def read(self, user_id, method, *args):
+        """
+        Функция вызывает метод UserVocabulary для словаря пользователя из кэша
+        :param user_id: номер пользователя в telegram
+        :param method: имя метода UserVocabulary
+        :param args: параметры метода
+        :return: результат метода или None если словаря нет в кэше
+        """
+        with self._lock:
+            vocab = self._users.get(user_id)
+            if vocab is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self._users.move_to_end(user_id)
+            return getattr(vocab, method)(*args)
+
+    def is_cacheable(self, user_id):
+        """
+        Функция проверяет, не пропускается ли словарь пользователя из-за размера
+        :param user_id: номер пользователя в telegram
+        :return: True если словарь можно загрузить в кэш
+        """
+        with self._lock:
+            until = self._too_large.get(user_id)
+            if until is None:
+                return True
+            if until < time.monotonic():
+                del self._too_large[user_id]
+                return True
+            return False
+
+    def mark_too_large(self, user_id):
+        with self._lock:
+            self._too_large[user_id] = time.monotonic() + _TOO_LARGE_TIMEOUT
+
+    def add_listener(self, listener):
+        """
+        Функция подписывает на изменения словарей: добавление и удаление слов, ответы, сброс словаря
+        :param listener: функция от user_id и word_id: word_id - слово, на которое пришел ответ,
+        None при добавлении и удалении слов и сбросе словаря. Вызывается и для пользователей, которых нет в кэше
+        :return: None
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, user_id, word_id=None):
+        for listener in self._listeners:
+            listener(user_id, word_id)
+
+    def begin_load(self, user_id):
+        """
+        Функция отмечает начало загрузки словаря пользователя из БД
+        :param user_id: номер пользователя в telegram
+        :return: номер изменения словаря, который надо передать в put()
+        """
+        with self._lock:
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            return loading[1]
+
+    def end_load(self, user_id):
+        with self._lock:
+            loading = self._loading[user_id]
+            loading[0] -= 1
+            if not loading[0]:
+                del self._loading[user_id]
+
+    def put(self, user_id, vocab, generation=None):
+        """
+        Функция сохраняет загруженный словарь пользователя
+        :param user_id: номер пользователя в telegram
+        :param vocab: объект UserVocabulary
+        :param generation: номер изменения словаря из begin_load()
+        :return: True если словарь сохранен, False если словарь менялся во время загрузки
+        """
+        with self._lock:
+            if generation is not None and self._loading.get(user_id, [0, None])[1] != generation:
+                return False
+            self._drop(user_id)
+            self._users[user_id] = vocab
+            self._size += vocab.size
+            self._evict()
+            return True
+
+    def _changed(self, user_id):
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1] += 1
+
+    def _drop(self, user_id):
+        with self._lock:
+            vocab = self._users.pop(user_id, None)
+            if vocab is not None:
+                self._size -= vocab.size
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._drop(user_id)
+            self._changed(user_id)
+        self._notify(user_id)
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._users) > 1:
+            _, vocab = self._users.popitem(last=False)
+            self._size -= vocab.size
+
+    def _update(self, user_id, method, *args):
+        with self._lock:
+            self._changed(user_id)
+            vocab = self._users.get(user_id)
+            if vocab is not None:
+                self._size -= vocab.size
+                getattr(vocab, method)(*args)
+                self._size += vocab.size
+                self._evict()
+
+    def add_word(self, user_id, word_id, rus_word, en_word):
+        self._update(user_id, 'add', word_id, rus_word, en_word)
+        self._notify(user_id)
+
+    def remove_word(self, user_id, word_id):
+        self._update(user_id, 'remove', word_id)
+        self._notify(user_id)
+
+    def add_answers(self, user_id, word_id, right, wrong):
+        self._update(user_id, 'add_answers', word_id, right, wrong)
+        self._notify(user_id, word_id)
+
+
+vocab_cache = VocabCache()
+metrics.collect('vocab_cache', lambda: dict(vocab_cache.stats, users=len(vocab_cache), bytes=vocab_cache.size))
@@ -0,0 +1,231 @@
+from functools import lru_cache
+import json
+import random
+
+from telebot import types
+from telebot.handler_backends import State, StatesGroup
+
+from config import BUTTON_CACHE_SIZE
+
+# Тексты кнопок, состояния диалога и клавиатуры, общие для main.py и async_main.py.
+# Клавиатуры собираются сразу в JSON: telebot передает строку в reply_markup без изменений
+
+
+def show_hint(*lines):
+    return '\n'.join(lines)
+
+
+def show_target(data):
+    return f"{data['target_word']} -> {data['translate_word']}"
+
+
+def answer_latency(data, message):
+    """
+    Функция считает, сколько секунд пользователь думал над карточкой: от показа карточки до отправки ответа
+    :param data: данные состояния с временем показа карточки shown_at
+    :param message: сообщение с ответом
+    :return: float секунд или None если время показа неизвестно
+    """
+    if 'shown_at' not in data:
+        return None
+    # message.date - время отправки сообщения пользователем с точностью до секунды
+    return max(0.0, message.date - data['shown_at'])
+
+
+@lru_cache(maxsize=BUTTON_CACHE_SIZE)
+def _button(text):
+    # Кнопка в том же JSON виде, что дает types.KeyboardButton
+    return json.dumps({'text': text})
+
+
+def _rows(buttons, row_width):
+    return ', '.join('[' + ', '.join(buttons[i:i + row_width]) + ']' for i in range(0, len(buttons), row_width))
+
+
+def keyboard(*texts, row_width=1, one_time=False):
+    """
+    Функция строит клавиатуру из кнопок с текстом сразу в JSON, который передается в reply_markup
+    :param texts: тексты кнопок
+    :param row_width: количество кнопок в ряду
+    :param one_time: True если клавиатура скрывается после нажатия
+    :return: str JSON клавиатуры, как у types.ReplyKeyboardMarkup.to_json()
+    """
+    markup = '{"keyboard": [' + _rows([_button(text) for text in texts], row_width) + ']'
+    if one_time:
+        markup += ', "one_time_keyboard": true, "resize_keyboard": false'
+    return markup + '}'
+
+
+def card_markup(answers, wrong=()):
+    """
+    Функция строит клавиатуру карточки: варианты ответа по два в ряд и заранее сериализованные служебные кнопки
+    :param answers: list вариантов ответа в порядке показа
+    :param wrong: номера вариантов, которые уже выбраны неправильно, они помечаются ❌
+    :return: str JSON клавиатуры
+    """
+    buttons = [_button(word + '❌' if i in wrong else word) for i, word in enumerate(answers)]
+    if not buttons:
+        return SERVICE_MARKUP
+    return '{"keyboard": [' + _rows(buttons, 2) + _CARD_SERVICE_ROWS
+
+
+def prepare_card(card, lang):
+    """
+    Функция готовит карточку к показу: текст вопроса, варианты ответа в случайном порядке и клавиатуру
+    :param card: словарь из build_card
+    :param lang: язык вариантов ответа ('ru' или 'en')
+    :return: словарь с ключами word_id, target_word, translate_word, greeting, answers, markup
+    """
+    if lang == 'ru':
+        target_word = card['rus_word']
+        translate = card['en_word']
+        # Для английских слов добавляем гиперссылку на яндекс словарь, что бы можно было посмотреть транскрипцию
+        greeting = f"Выбери перевод слова: <a href='https://translate.yandex.ru/?source_lang=en&target_lang=ru&text={translate}'>{translate}</a>"
+    else:
+        target_word = card['en_word']
+        translate = card['rus_word']
+        greeting = f"Выбери перевод слова: {translate}"
+
+    # Правильный и неправильные ответы перемешиваем в случайном порядке
+    answers = [target_word] + card['others']
+    random.shuffle(answers)
+    return {
+        'word_id': card['word_id'],
+        'target_word': target_word,
+        'translate_word': translate,
+        'greeting': greeting,
+        'answers': answers,
+        'markup': card_markup(answers),
+    }
+
+
+# Начало данных кнопок листания результатов поиска: search:<номер страницы>:<запрос>
+SEARCH_CALLBACK = 'search:'
+# Telegram принимает данные кнопки не длиннее 64 байт
+_CALLBACK_MAX_BYTES = 64
+
+
+def _search_button(text, label, page):
+    data = f'{SEARCH_CALLBACK}{page}:{text}'
+    if len(data.encode('utf-8')) > _CALLBACK_MAX_BYTES:
+        return None
+    return {'text': label, 'callback_data': data}
+
+
+def search_page(text, words, total, page, page_size):
+    """
+    Функция готовит страницу результатов поиска по словарю
+    :param text: запрос, пустая строка - просмотр всего словаря
+    :param words: list кортежей (word_id, русское слово, английское слово) на странице
+    :param total: количество найденных слов
+    :param page: номер страницы, с 0
+    :param page_size: количество слов на странице
+    :return: кортеж (текст сообщения, str JSON inline клавиатуры листания или None)
+    """
+    if not words:
+        return (f'По запросу "{text}" ничего не найдено.' if text else 'В словаре пока нет слов.'), None
+    pages = -(-total // page_size)
+    header = f'Найдено слов: {total}' if text else f'Слов в словаре: {total}'
+    if pages > 1:
+        header += f', страница {page + 1} из {pages}'
+    lines = [header] + [f'{rus_word} - {en_word}' for _, rus_word, en_word in words]
+
+    buttons = []
+    if page > 0:
+        buttons.append(_search_button(text, '◀', page - 1))
+    if page + 1 < pages:
+        buttons.append(_search_button(text, '▶', page + 1))
+    # Слишком длинный запрос не помещается в данные кнопки, тогда показываем только первую страницу
+    buttons = [button for button in buttons if button is not None]
+    markup = json.dumps({'inline_keyboard': [buttons]}, ensure_ascii=False) if buttons else None
+    return show_hint(*lines), markup
+
+
+def parse_search_callback(data):
+    """
+    Функция разбирает данные кнопки листания результатов поиска
+    :param data: данные кнопки вида search:<номер страницы>:<запрос>
+    :return: кортеж (запрос, номер страницы)
+    """
+    page, _, text = data[len(SEARCH_CALLBACK):].partition(':')
+    return text, int(page) if page.isdigit() else 0
+
+
+def inline_results(words):
+    """
+    Функция готовит найденные слова для ответа на inline запрос: выбранная пара отправляется в чат текстом
+    :param words: list кортежей (word_id, русское слово, английское слово)
+    :return: list объектов types.InlineQueryResultArticle
+    """
+    return [types.InlineQueryResultArticle(str(word_id), f'{rus_word} - {en_word}',
+                                           types.InputTextMessageContent(f'{rus_word} - {en_word}'))
+            for word_id, rus_word, en_word in words]
+
+
+def stats_text(stats, pending=None):
+    """
+    Функция готовит сообщение со статистикой пользователя
+    :param stats: словарь из find_stats
+    :param pending: еще не записанные в БД ответы пользователя {word_id: (правильных, неправильных)}
+    :return: str текст сообщения
+    """
+    right = stats['right'] + sum(item[0] for item in (pending or {}).values())
+    wrong = stats['wrong'] + sum(item[1] for item in (pending or {}).values())
+    accuracy = f'{right / (right + wrong):.0%}' if right + wrong else '-'
+    lines = [f"{stats['user_name']}, твоя статистика:",
+             f"Слов в словаре: {stats['words']}",
+             f"Выучено слов: {stats['learned']}",
+             f'Правильных ответов: {right} из {right + wrong} ({accuracy})',
+             f"Дней подряд: {stats['streak']}"]
+    if stats['rank'] is not None:
+        lines.append(f"Место в таблице лидеров: {stats['rank']}")
+    return show_hint(*lines)
+
+
+def leaderboard_text(rows, user_id):
+    """
+    Функция готовит сообщение с таблицей лидеров
+    :param rows: list кортежей (user_id, имя, выучено слов, правильных ответов, неправильных ответов)
+    :param user_id: номер пользователя, который запросил таблицу: его строка отмечается
+    :return: str текст сообщения
+    """
+    if not rows:
+        return 'В таблице лидеров пока никого нет.'
+    lines = ['Таблица лидеров (выучено слов, правильных ответов):']
+    for place, (row_user_id, name, learned, right, _) in enumerate(rows, 1):
+        lines.append(f'{place}. {name} - {learned}, {right}' + (' ⬅' if row_user_id == user_id else ''))
+    return show_hint(*lines)
+
+
+class Command:
+    ADD_WORD = 'Добавить слово ➕'
+    ADD_RAND_WORD = 'Добавить случайное слово'
+    DELETE_WORD = 'Удалить слово🔙'
+    NEXT = 'Дальше ⏭'
+    YES = '=Да='
+    NO = '=Нет='
+    CANCEL = '=Отмена='
+
+class MyStates(StatesGroup):
+    waitng_for_name = State()
+    waitng_for_word = State()
+    waiting_for_list = State()
+    waiting_for_search = State()
+    waiting_for_import = State()
+    check_answer = State()
+    save_word = State()
+    delete_word = State()
+
+
+# Служебные кнопки карточки: дальше, добавить слово, добавить случайное слово, удалить слово
+SERVICE_BUTTONS = (Command.NEXT, Command.ADD_WORD, Command.ADD_RAND_WORD, Command.DELETE_WORD)
+# Ряды служебных кнопок в конце клавиатуры карточки сериализуются один раз
+_CARD_SERVICE_ROWS = ', ' + _rows([_button(text) for text in SERVICE_BUTTONS], 2) + ']}'
+
+# Неизменяемые клавиатуры
+START_MARKUP = keyboard('/start')
+SERVICE_MARKUP = keyboard(*SERVICE_BUTTONS)
+NEXT_MARKUP = keyboard(Command.NEXT, one_time=True)
+CANCEL_MARKUP = keyboard(Command.CANCEL, one_time=True)
+YES_CANCEL_MARKUP = keyboard(Command.YES, Command.CANCEL, one_time=True)
+REMOVE_MARKUP = types.ReplyKeyboardRemove().to_json()
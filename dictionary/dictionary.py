@@ -0,0 +1,175 @@
+import argparse
+import mmap
+import os
+import struct
+import threading
+
+from config import DICTIONARY_PATH
+
+# Офлайн словарь: файл с отсортированной таблицей ключей, открывается через mmap.
+# Все процессы бота читают одну копию файла из страничного кэша ОС, в памяти процесса словарь не хранится.
+# Формат файла:
+#   заголовок: MAGIC, количество записей
+#   таблица записей, отсортированная по байтам ключа в UTF-8. Запись: первые 8 байт ключа как число
+#   (для сравнения без чтения строк), смещение и длина ключа, смещение и длина перевода
+#   строки ключей и переводов в UTF-8
+MAGIC = b'ECDICT1\0'
+HEADER = struct.Struct('>8sI4x')
+ENTRY = struct.Struct('>QIIHH')
+
+
+def _prefix(key):
+    return int.from_bytes(key[:8].ljust(8, b'\0'), 'big')
+
+
+def normalize(text):
+    # Ключи приводятся к тому же виду, что и ключи кэша переводов (yandex_translate.cache.normalize)
+    return ' '.join(text.lower().split())
+
+
+class Dictionary:
+    """
+    Офлайн словарь, открытый через mmap. Поиск - двоичный по таблице записей,
+    перевод декодируется прямо из отображенной памяти без промежуточных копий
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f'{path} не является файлом офлайн словаря')
+        self._view = memoryview(self._mm)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, text):
+        """
+        Функция ищет перевод нормализованного текста
+        :param text: нормализованное слово или фраза
+        :return: str перевод или None если слова в словаре нет
+        """
+        key = text.encode('utf-8')
+        prefix = _prefix(key)
+        mm = self._mm
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_prefix, key_offset, _, key_len, _ = ENTRY.unpack_from(mm, HEADER.size + mid * ENTRY.size)
+            # Строку ключа читаем, только если первые 8 байт совпали
+            if entry_prefix < prefix or (entry_prefix == prefix and mm[key_offset:key_offset + key_len] < key):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        entry_prefix, key_offset, value_offset, key_len, value_len = \
+            ENTRY.unpack_from(mm, HEADER.size + lo * ENTRY.size)
+        if entry_prefix != prefix or self._view[key_offset:key_offset + key_len] != key:
+            return None
+        return str(self._view[value_offset:value_offset + value_len], 'utf-8')
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+
+
+def build(pairs, path):
+    """
+    Функция записывает файл словаря. Файл сначала пишется рядом и затем атомарно заменяет старый:
+    запущенные процессы продолжают читать старую копию до перезапуска
+    :param pairs: итерируемый набор пар (слово, перевод). Для повторяющихся слов остается первый перевод
+    :param path: путь к файлу словаря
+    :return: количество записей
+    """
+    items = {}
+    for key, value in pairs:
+        key = normalize(key).encode('utf-8')
+        value = ' '.join(value.split()).encode('utf-8')
+        if key and value and len(key) < 2 ** 16 and len(value) < 2 ** 16:
+            items.setdefault(key, value)
+    keys = sorted(items)
+
+    offset = HEADER.size + len(keys) * ENTRY.size
+    table = bytearray()
+    strings = []
+    for key in keys:
+        value = items[key]
+        table += ENTRY.pack(_prefix(key), offset, offset + len(key), len(key), len(value))
+        strings.append(key)
+        strings.append(value)
+        offset += len(key) + len(value)
+    if offset >= 2 ** 32:
+        raise ValueError('Словарь больше 4 ГБ')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys)))
+        f.write(table)
+        for item in strings:
+            f.write(item)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+def read_tsv(path, both=True, encoding='utf-8'):
+    """
+    Функция читает пары слов из TSV: слово и перевод в первых двух колонках, остальные колонки не используются
+    :param path: путь к TSV файлу
+    :param both: добавлять и обратный перевод
+    :param encoding: кодировка файла
+    :return: генератор пар (слово, перевод)
+    """
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) < 2 or line.startswith('#'):
+                continue
+            yield columns[0], columns[1]
+            if both:
+                yield columns[1], columns[0]
+
+
+_dictionary = None
+_dictionary_lock = threading.Lock()
+_dictionary_checked = False
+
+
+def get_dictionary(path=DICTIONARY_PATH):
+    """
+    Функция открывает офлайн словарь при первом обращении
+    :param path: путь к файлу словаря
+    :return: объект Dictionary или None если файла словаря нет
+    """
+    global _dictionary, _dictionary_checked
+    if not _dictionary_checked:
+        with _dictionary_lock:
+            if not _dictionary_checked:
+                if os.path.exists(path):
+                    _dictionary = Dictionary(path)
+                _dictionary_checked = True
+    return _dictionary
+
+
+def lookup(text):
+    """
+    Функция ищет перевод в офлайн словаре
+    :param text: нормализованное слово или фраза
+    :return: str перевод или None если словаря нет или слова в нем нет
+    """
+    dictionary = get_dictionary()
+    return dictionary.get(text) if dictionary is not None else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сборка офлайн словаря из TSV файла (слово<TAB>перевод)')
+    parser.add_argument('file', help='TSV файл со словами')
+    parser.add_argument('--output', default=DICTIONARY_PATH, help='файл словаря')
+    parser.add_argument('--one-way', action='store_true', help='не добавлять обратный перевод')
+    parser.add_argument('--encoding', default='utf-8-sig', help='кодировка файла')
+    args = parser.parse_args()
+
+    count = build(read_tsv(args.file, not args.one_way, args.encoding), args.output)
+    print(f'Записей в словаре: {count}, размер файла: {os.path.getsize(args.output)} байт')
@@ -0,0 +1,80 @@
+import asyncio
+import random
+
+import aiohttp
+
+from config import HTTP_POOL_SIZE, HTTP_TIMEOUTS, HTTP_RETRIES, HTTP_BACKOFF
+from http_client.http_client import RETRY_STATUSES, _breakers
+
+# Асинхронный вариант http_client для бота на asyncio: те же таймауты, повторы и общие с ним предохранители
+
+_session = None
+
+
+def get_session():
+    """
+    Функция возвращает общую сессию aiohttp, создавая ее при первом обращении внутри цикла событий
+    :return: объект aiohttp.ClientSession
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE))
+    return _session
+
+
+async def close_session():
+    """
+    Функция закрывает общую сессию и ее соединения
+    :return: None
+    """
+    global _session
+    if _session is not None:
+        session, _session = _session, None
+        await session.close()
+
+
+async def request(method, url, endpoint, **kwargs):
+    """
+    Функция выполняет HTTP запрос через общую сессию aiohttp.
+    Таймауты берутся из настроек сервиса, при сетевых ошибках и кодах RETRY_STATUSES
+    запрос повторяется с экспоненциальной случайной задержкой
+    :param method: HTTP метод
+    :param url: адрес запроса
+    :param endpoint: имя сервиса из HTTP_TIMEOUTS
+    :param kwargs: параметры aiohttp (json, params, headers, ...)
+    :return: объект aiohttp.ClientResponse с уже прочитанным телом
+    """
+    breaker = _breakers[endpoint]
+    probe = breaker.before_request(endpoint)
+    connect, read = HTTP_TIMEOUTS[endpoint]
+    kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+    # Отмененный пробный запрос (CancelledError) не доходит до record(), поэтому пробу завершаем в finally
+    try:
+        for attempt in range(HTTP_RETRIES + 1):
+            last = attempt == HTTP_RETRIES
+            try:
+                async with get_session().request(method, url, **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    breaker.record(False)
+                    raise
+            except aiohttp.ClientError:
+                breaker.record(False)
+                raise
+            else:
+                if response.status not in RETRY_STATUSES or last:
+                    breaker.record(response.status < 500)
+                    return response
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+    finally:
+        if probe:
+            breaker.end_probe()
+
+
+async def get(url, endpoint, **kwargs):
+    return await request('GET', url, endpoint, **kwargs)
+
+
+async def post(url, endpoint, **kwargs):
+    return await request('POST', url, endpoint, **kwargs)
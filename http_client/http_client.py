@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+from config import HTTP_POOL_SIZE, HTTP_TIMEOUTS, HTTP_RETRIES, HTTP_BACKOFF, CIRCUIT_FAILURES, CIRCUIT_RESET_TIMEOUT
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Сервис недоступен: запрос не выполнялся, так как предохранитель разомкнут
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для стороннего сервиса. После CIRCUIT_FAILURES неудач подряд запросы
+    сразу завершаются ошибкой, через CIRCUIT_RESET_TIMEOUT секунд пропускается один пробный запрос
+    """
+
+    def __init__(self, failures=CIRCUIT_FAILURES, reset_timeout=CIRCUIT_RESET_TIMEOUT, name=None):
+        self.failures = failures
+        # Имя сервиса для метрик ошибок
+        self.name = name
+        self.reset_timeout = reset_timeout
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_request(self, endpoint):
+        """
+        Функция проверяет, можно ли выполнять запрос
+        :param endpoint: имя сервиса для текста ошибки
+        :return: True если запрос пробный - тогда после него нужно вызвать end_probe(),
+        при разомкнутом предохранителе выбрасывает CircuitOpenError
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                metrics.errors.inc(('circuit_open', self.name))
+                raise CircuitOpenError(f'Сервис {endpoint} временно недоступен')
+            # Пропускаем один пробный запрос
+            self._probing = True
+            return True
+
+    def end_probe(self):
+        """
+        Функция завершает пробный запрос, даже если он прерван (например, отменен) и не дошел до record()
+        :return: None
+        """
+        with self._lock:
+            self._probing = False
+
+    def record(self, success):
+        """
+        Функция учитывает результат запроса
+        :param success: True если сервис ответил без ошибки
+        :return: None
+        """
+        with self._lock:
+            self._probing = False
+            if success:
+                self._failed = 0
+                self._opened_at = None
+            else:
+                metrics.errors.inc(('http', self.name))
+                self._failed += 1
+                if self._failed >= self.failures:
+                    self._opened_at = time.monotonic()
+
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=len(HTTP_TIMEOUTS), pool_maxsize=HTTP_POOL_SIZE)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+_breakers = {endpoint: CircuitBreaker(name=endpoint) for endpoint in HTTP_TIMEOUTS}
+metrics.collect('circuit_open', lambda: {endpoint: int(breaker._opened_at is not None)
+                                         for endpoint, breaker in _breakers.items()})
+
+
+def request(method, url, endpoint, **kwargs):
+    """
+    Функция выполняет HTTP запрос через общую сессию с постоянными соединениями.
+    Таймауты берутся из настроек сервиса, при сетевых ошибках и кодах RETRY_STATUSES
+    запрос повторяется с экспоненциальной случайной задержкой
+    :param method: HTTP метод
+    :param url: адрес запроса
+    :param endpoint: имя сервиса из HTTP_TIMEOUTS
+    :param kwargs: параметры requests (json, params, headers, ...)
+    :return: объект requests.Response
+    """
+    breaker = _breakers[endpoint]
+    probe = breaker.before_request(endpoint)
+    kwargs.setdefault('timeout', HTTP_TIMEOUTS[endpoint])
+    try:
+        for attempt in range(HTTP_RETRIES + 1):
+            last = attempt == HTTP_RETRIES
+            try:
+                response = _session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    breaker.record(False)
+                    raise
+            except requests.RequestException:
+                breaker.record(False)
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last:
+                    breaker.record(response.status_code < 500)
+                    return response
+            time.sleep(HTTP_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+    finally:
+        if probe:
+            breaker.end_probe()
+
+
+def get(url, endpoint, **kwargs):
+    return request('GET', url, endpoint, **kwargs)
+
+
+def post(url, endpoint, **kwargs):
+    return request('POST', url, endpoint, **kwargs)
+
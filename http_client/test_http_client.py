@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+from http_client import async_http_client, http_client
+
+# Проверка повторов, задержек, таймаутов и предохранителя http_client на локальной заглушке.
+# Запуск из корня проекта: python -m unittest http_client.test_http_client
+
+# Имя сервиса заглушки: таймауты и предохранитель для него подставляются на время теста
+ENDPOINT = 'stub'
+# Таймауты заглушки (соединение, чтение) и время, на которое "зависает" ответ
+TIMEOUTS = (1, 0.2)
+HANG_SECONDS = 2
+BACKOFF = 0.3
+RETRIES = 2
+
+
+class StubServer:
+    """
+    Локальный HTTP сервер, отвечающий по очереди кодами из списка ответов.
+    Ответ 'hang' задерживается дольше таймаута чтения. Когда список закончился, отвечает 200
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = 0
+        self.released = threading.Event()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    stub.requests += 1
+                    response = stub.responses.pop(0) if stub.responses else 200
+                if response == 'hang':
+                    stub.released.wait(HANG_SECONDS)
+                    response = 200
+                try:
+                    self.send_response(response)
+                    self.send_header('Content-Length', '2')
+                    self.end_headers()
+                    self.wfile.write(b'{}')
+                except OSError:
+                    # Клиент уже закрыл соединение по таймауту
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.released.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class HttpClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubServer()
+        self.addCleanup(self.stub.close)
+        self.breaker = http_client.CircuitBreaker(failures=2, reset_timeout=0.5, name=ENDPOINT)
+        # Задержки между повторами записываются, а не выполняются
+        self.sleeps = []
+        patches = [
+            mock.patch.dict(http_client.HTTP_TIMEOUTS, {ENDPOINT: TIMEOUTS}),
+            mock.patch.dict(http_client._breakers, {ENDPOINT: self.breaker}),
+            mock.patch.object(http_client, 'HTTP_RETRIES', RETRIES),
+            mock.patch.object(http_client, 'HTTP_BACKOFF', BACKOFF),
+            mock.patch.object(http_client.time, 'sleep', self.sleeps.append),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get(self):
+        return http_client.get(self.stub.url, ENDPOINT)
+
+    def assert_backoff(self, count):
+        self.assertEqual(len(self.sleeps), count)
+        for attempt, delay in enumerate(self.sleeps):
+            base = BACKOFF * 2 ** attempt
+            self.assertTrue(base * 0.5 <= delay <= base * 1.5, (attempt, delay))
+
+    def test_retry_until_success(self):
+        self.stub.responses = [503, 502]
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(self.stub.requests, 3)
+        self.assert_backoff(2)
+        self.assertIsNone(self.breaker._opened_at)
+
+    def test_no_retry_on_client_error(self):
+        self.stub.responses = [404]
+        self.assertEqual(self.get().status_code, 404)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(self.sleeps, [])
+        # Ответ 4xx - не отказ сервиса
+        self.assertEqual(self.breaker._failed, 0)
+
+    def test_retries_exhausted(self):
+        self.stub.responses = [500] * (RETRIES + 1)
+        self.assertEqual(self.get().status_code, 500)
+        self.assertEqual(self.stub.requests, RETRIES + 1)
+        self.assert_backoff(RETRIES)
+        self.assertEqual(self.breaker._failed, 1)
+
+    def test_jitter(self):
+        # Каждый запрос получает ответ на последней попытке, поэтому предохранитель не размыкается
+        self.stub.responses = ([503] * RETRIES + [200]) * 5
+        for _ in range(5):
+            self.get()
+        # Случайная задержка: первые задержки разных запросов не совпадают
+        self.assertGreater(len(set(self.sleeps[::RETRIES])), 1)
+
+    def test_read_timeout(self):
+        self.stub.responses = ['hang'] * (RETRIES + 1)
+        started = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            self.get()
+        elapsed = time.monotonic() - started
+        self.assertEqual(self.stub.requests, RETRIES + 1)
+        # Каждая попытка прерывается по таймауту чтения сервиса, а не ждет ответа заглушки
+        self.assertLess(elapsed, (RETRIES + 1) * HANG_SECONDS / 2)
+        self.assert_backoff(RETRIES)
+        self.assertEqual(self.breaker._failed, 1)
+
+    def test_timeout_then_recover(self):
+        self.stub.responses = ['hang']
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(self.stub.requests, 2)
+        self.assert_backoff(1)
+
+    def test_circuit_breaker(self):
+        # Два запроса подряд исчерпывают повторы: предохранитель размыкается
+        self.stub.responses = [503] * (RETRIES + 1) * 2
+        self.get()
+        self.get()
+        self.assertIsNotNone(self.breaker._opened_at)
+        requests_before = self.stub.requests
+        with self.assertRaises(http_client.CircuitOpenError):
+            self.get()
+        self.assertEqual(self.stub.requests, requests_before)
+
+        # После reset_timeout пропускается один пробный запрос. Пробный запрос неудачен - снова разомкнут
+        self.breaker._opened_at -= self.breaker.reset_timeout
+        self.stub.responses = [503] * (RETRIES + 1)
+        self.get()
+        self.assertEqual(self.stub.requests, requests_before + RETRIES + 1)
+        with self.assertRaises(http_client.CircuitOpenError):
+            self.get()
+
+        # Удачный пробный запрос замыкает предохранитель
+        self.breaker._opened_at -= self.breaker.reset_timeout
+        self.assertEqual(self.get().status_code, 200)
+        self.assertIsNone(self.breaker._opened_at)
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_half_open_single_probe(self):
+        self.stub.responses = [503] * (RETRIES + 1) * 2
+        self.get()
+        self.get()
+        self.breaker._opened_at -= self.breaker.reset_timeout
+        self.stub.responses = ['hang']
+        probe = threading.Thread(target=self.get)
+        probe.start()
+        # Пока пробный запрос выполняется, остальные запросы сразу получают ошибку.
+        # time.sleep подменен, поэтому ждем начала пробного запроса через Event
+        waiting = threading.Event()
+        while self.stub.requests < (RETRIES + 1) * 2 + 1:
+            waiting.wait(0.01)
+        with self.assertRaises(http_client.CircuitOpenError):
+            self.get()
+        probe.join()
+        self.assertIsNone(self.breaker._opened_at)
+
+    def test_cancelled_probe(self):
+        # Отмененный пробный запрос асинхронного клиента не оставляет предохранитель в состоянии пробы
+        self.stub.responses = [503] * (RETRIES + 1) * 2
+        self.get()
+        self.get()
+        self.breaker._opened_at -= self.breaker.reset_timeout
+        self.stub.responses = ['hang']
+
+        async def cancel_probe():
+            try:
+                await asyncio.wait_for(async_http_client.get(self.stub.url, ENDPOINT), TIMEOUTS[1] / 2)
+            finally:
+                await async_http_client.close_session()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(cancel_probe())
+        self.assertFalse(self.breaker._probing)
+        # Следующий запрос снова пробный, и после удачного ответа предохранитель замыкается
+        self.assertEqual(self.get().status_code, 200)
+        self.assertIsNone(self.breaker._opened_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import os, sys
-from config import OTHER_WORDS_COUNT, ACTIVATE_THIS_PATH
-if sys.platform != 'win32':
+from config import (OTHER_WORDS_COUNT, ACTIVATE_THIS_PATH, SEARCH_PAGE_SIZE, SEARCH_INLINE_LIMIT, LEADERBOARD_SIZE,
+                    TRANSFER_MAX_FILE_SIZE)
+if sys.platform != 'win32' and os.path.exists(ACTIVATE_THIS_PATH):
     with open(ACTIVATE_THIS_PATH) as f:
          exec(f.read(), {'__file__': ACTIVATE_THIS_PATH})
 
@@ -8,15 +9,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import random
-
-from telebot import types, TeleBot, custom_filters
-from telebot.storage import StateMemoryStorage
-from telebot.handler_backends import State, StatesGroup
-
-from db.db import create_db_connection, add_user, find_user, add_words, take_random_word, take_other_words, \
-    del_word, add_right_answer, add_wrong_answer
-from random_word.random_word import get_random_word
-from yandex_translate.yandex_translate import translate
+import time
+
+from telebot import TeleBot, custom_filters
+
+from card_deck.card_deck import card_deck
+from db.db import (get_connection, add_user, find_user, add_words, build_card, del_word, search_words, find_stats,
+                   find_leaderboard)
+from db.answer_buffer import answer_buffer
+from db.bulk_import import import_words
+from db import transfer
+from dialog.dialog import (Command, MyStates, show_hint, show_target, answer_latency, keyboard, card_markup,
+                           prepare_card, search_page, parse_search_callback, inline_results, stats_text,
+                           leaderboard_text, SEARCH_CALLBACK, START_MARKUP, SERVICE_MARKUP, NEXT_MARKUP, CANCEL_MARKUP, YES_CANCEL_MARKUP, REMOVE_MARKUP)
+from metrics import metrics
+from outbox.outbox import Outbox
+from random_word.pool import random_word_pool
+from state_storage.state_storage import SQLiteStateStorage
+from webhook.webhook import run_webhook
+from yandex_translate.cache import translate
 
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 
@@ -25,37 +36,15 @@ if TELEGRAM_TOKEN is None:
 
 print('Start telegram bot...')
 
-state_storage = StateMemoryStorage()
+state_storage = SQLiteStateStorage()
 bot = TeleBot(TELEGRAM_TOKEN, state_storage=state_storage)
+# Сообщения отправляются из очереди с учетом ограничений Telegram, обработчики не ждут отправки
+outbox = Outbox(bot)
+metrics.collect('outbox', outbox.metrics)
 
 buttons = []
 
 
-def show_hint(*lines):
-    return '\n'.join(lines)
-
-
-def show_target(data):
-    return f"{data['target_word']} -> {data['translate_word']}"
-
-
-class Command:
-    ADD_WORD = 'Добавить слово ➕'
-    ADD_RAND_WORD = 'Добавить случайное слово'
-    DELETE_WORD = 'Удалить слово🔙'
-    NEXT = 'Дальше ⏭'
-    YES = '=Да='
-    NO = '=Нет='
-    CANCEL = '=Отмена='
-
-class MyStates(StatesGroup):
-    waitng_for_name = State()
-    waitng_for_word = State()
-    check_answer = State()
-    save_word = State()
-    delete_word = State()
-
-
 def main_dialog(message):
     """
     Функция построения основного диалога игры
@@ -63,80 +52,38 @@ def main_dialog(message):
     :return:
     """
     cid = message.chat.id
-    conn = create_db_connection()
-    # Запрашиваем имя пользователя из БД
-    user_name = find_user(conn, cid)
-    conn.close()
-    # Если пользователь не найден отправляем на /start
-    if user_name is None:
-        markup = types.ReplyKeyboardMarkup(row_width=1)
-        markup.add(types.KeyboardButton('/start'))
-        bot.send_message(message.chat.id, 'Мы не нашли вас в базе данных. Нажмите /start', reply_markup=markup)
-        return True
-
-    markup = types.ReplyKeyboardMarkup(row_width=2)
-
-    buttons = []
-    conn = create_db_connection()
-    # Получаем из БД пару слов
-    pair = list(take_random_word(conn, cid))
-
-    rus_word = pair[0]
-
-    # Перемешиваем направление перевода en-ru или ru-en
-    random.shuffle(pair)
-    translate = pair[0]
-    target_word = pair[1]
-
-    # Запрашиваем остальные слова в зависимость с какого языка переводим
-    # запрашиваем русские слова
-    if target_word == rus_word:
-        others = take_other_words(conn, cid, target_word, 'ru', OTHER_WORDS_COUNT)
-        # Для английских слов добавляем гиперссылку на яндекс словарь, что бы можно было посмотреть транскрипцию
-        greeting = f"Выбери перевод слова: <a href='https://translate.yandex.ru/?source_lang=en&target_lang=ru&text={translate}'>{translate}</a>"
-    # запрашиваем англ слова
-    else:
-        others = take_other_words(conn, cid, target_word, 'en', OTHER_WORDS_COUNT)
-        greeting = f"Выбери перевод слова: {translate}"
-
-    conn.close()
-    # Кнопка с правильным ответом
-    target_word_btn = types.KeyboardButton(target_word)
-    buttons.append(target_word_btn)
-    # Кнопки с неправильными ответами
-    other_words_btns = [types.KeyboardButton(word) for word in others]
-    buttons.extend(other_words_btns)
-    # Перемешиваем кнопки в случайном порядке
-    random.shuffle(buttons)
-
-    # Служебные кнопки:
-
-    # Кнопка дальше
-    next_btn = types.KeyboardButton(Command.NEXT)
-
-    # Кнопка добавить слово
-    add_word_btn = types.KeyboardButton(Command.ADD_WORD)
-
-    # Кнопка добавить случайное слово
-    add_rnd_btn = types.KeyboardButton(Command.ADD_RAND_WORD)
-
-    # Кнопка удалить слово
-    delete_word_btn = types.KeyboardButton(Command.DELETE_WORD)
-
-    # Добавляем служебные кнопки в конец клавиатуры
-    buttons.extend([next_btn, add_word_btn, add_rnd_btn, delete_word_btn])
-    markup.add(*buttons)
-
-    # Отправляем сообщение пользователю
-    bot.send_message(message.chat.id, greeting, reply_markup=markup, parse_mode='HTML')
+    # Карточка из заранее собранной колоды пользователя
+    card = card_deck.pop(cid)
+    if card is None:
+        # Перемешиваем направление перевода en-ru или ru-en: lang - язык вариантов ответа
+        lang = random.choice(['ru', 'en'])
+        # Пользователь, пара слов и неправильные варианты ответа за один запрос к БД
+        with get_connection() as conn:
+            card = build_card(conn, cid, lang, OTHER_WORDS_COUNT, answer_buffer.pending)
+
+        # Если пользователь не найден отправляем на /start
+        if card is None or card['user_name'] is None:
+            outbox.send_message(message.chat.id, 'Мы не нашли вас в базе данных. Нажмите /start',
+                                reply_markup=START_MARKUP)
+            return True
+        card = prepare_card(card, lang)
+
+    # Отправляем сообщение пользователю: новая карточка заменяет еще не отправленную предыдущую
+    outbox.send_message(message.chat.id, card['greeting'], kind='card', reply_markup=card['markup'],
+                        parse_mode='HTML')
     bot.set_state(message.from_user.id, MyStates.check_answer, message.chat.id)
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
-        data['target_word'] = target_word
-        data['translate_word'] = translate
-        data['buttons'] = buttons
+        data['word_id'] = card['word_id']
+        data['target_word'] = card['target_word']
+        data['translate_word'] = card['translate_word']
+        # Вместо объектов кнопок храним только порядок вариантов ответа и номера ошибочно выбранных
+        data['answers'] = card['answers']
+        data['wrong'] = []
+        data['shown_at'] = time.time()
 
 
 @bot.message_handler(commands=['start'])
+@metrics.handler
 def start_command(message):
     """
     Стартовый диалог. Запрашивает имя пользователя, если пользователя нет в БД
@@ -144,21 +91,21 @@ def start_command(message):
     :return:
     """
     cid = message.chat.id
-    conn = create_db_connection()
-    # Запрашиваем имя пользователя из БД
-    user_name = find_user(conn, cid)
-    conn.close()
+    with get_connection() as conn:
+        # Запрашиваем имя пользователя из БД
+        user_name = find_user(conn, cid)
     if user_name is None:
         # Если пользователя нет в БД устанавливаем стэйт на добавление имени пользователя
         bot.set_state(message.from_user.id, MyStates.waitng_for_name, cid)
-        bot.send_message(cid, "Привет, давай знакомиться. Как тебя зовут?", reply_markup=types.ReplyKeyboardRemove())
+        outbox.send_message(cid, "Привет, давай знакомиться. Как тебя зовут?", reply_markup=REMOVE_MARKUP)
     else:
         # Приветствуем пользователя и запускаем основной диалог
-        bot.send_message(cid, f"Привет, {user_name[0]}!")
+        outbox.send_message(cid, f"Привет, {user_name[0]}!")
         main_dialog(message)
 
 
 @bot.message_handler(content_types=["text"], state=MyStates.waitng_for_name)
+@metrics.handler
 def create_user(message):
     """
     Функция записывает нового пользователя в БД
@@ -166,39 +113,213 @@ def create_user(message):
     :return:
     """
     user_name = message.text
-    conn = create_db_connection()
-    add_user(conn, message.chat.id, user_name)
-    conn.close()
+    with get_connection() as conn:
+        add_user(conn, message.chat.id, user_name)
     start_command(message)
 
 # Хэндлер для кнопки Дальше или Отмена
 @bot.message_handler(func=lambda message: message.text == Command.NEXT or message.text == Command.CANCEL)
+@metrics.handler
 def next_cards(message):
     main_dialog(message)
 
 
+def import_list(message, text):
+    """
+    Функция добавляет в словарь пользователя список слов и сообщает результат
+    :param message:
+    :param text: текст списка или CSV файла
+    :return:
+    """
+    bot.delete_state(message.from_user.id, message.chat.id)
+    try:
+        added, failed = import_words(message.chat.id, text)
+    except ValueError as e:
+        outbox.reply_to(message, str(e), reply_markup=NEXT_MARKUP)
+        return
+    msg = f'Добавлено слов в словарь - {added}'
+    if failed:
+        msg = show_hint(msg, 'Не удалось перевести: ' + ', '.join(failed[:50]))
+    outbox.reply_to(message, msg, reply_markup=NEXT_MARKUP)
+
+
+# Хэндлер для массового добавления слов: список можно передать сразу после команды
+@bot.message_handler(commands=['add_list'])
+@metrics.handler
+def add_list(message):
+    text = message.text.partition(' ')[2]
+    if text.strip():
+        import_list(message, text)
+    else:
+        bot.set_state(message.from_user.id, MyStates.waiting_for_list, message.chat.id)
+        outbox.send_message(message.chat.id, 'Отправьте список слов (по одному в строке) или файл .txt/.csv.',
+                            reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для списка слов, отправленного текстом
+@bot.message_handler(content_types=['text'], state=MyStates.waiting_for_list)
+@metrics.handler
+def add_list_text(message):
+    import_list(message, message.text)
+
+
+# Хэндлер для списка слов, отправленного файлом
+@bot.message_handler(content_types=['document'], state=MyStates.waiting_for_list)
+@metrics.handler
+def add_list_file(message):
+    file_info = bot.get_file(message.document.file_id)
+    text = bot.download_file(file_info.file_path).decode('utf-8-sig', errors='replace')
+    import_list(message, text)
+
+
+def find_words(user_id, text, page):
+    """
+    Функция ищет слова в словаре пользователя и готовит страницу результатов
+    :param user_id: номер пользователя в telegram
+    :param text: запрос, пустая строка - весь словарь
+    :param page: номер страницы, с 0
+    :return: кортеж (текст сообщения, str JSON inline клавиатуры листания или None)
+    """
+    with get_connection() as conn:
+        words, total = search_words(conn, user_id, text, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+    return search_page(text, words, total, page, SEARCH_PAGE_SIZE)
+
+
+# Хэндлер для поиска по словарю: запрос можно передать сразу после команды
+@bot.message_handler(commands=['search'])
+@metrics.handler
+def search(message):
+    text = message.text.partition(' ')[2].strip()
+    if text:
+        msg, markup = find_words(message.chat.id, text, 0)
+        outbox.send_message(message.chat.id, msg, reply_markup=markup)
+    else:
+        bot.set_state(message.from_user.id, MyStates.waiting_for_search, message.chat.id)
+        outbox.send_message(message.chat.id, 'Введите слово или его начало. Чтобы посмотреть весь словарь, '
+                                             'отправьте *', reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для запроса поиска, отправленного отдельным сообщением
+@bot.message_handler(content_types=['text'], state=MyStates.waiting_for_search)
+@metrics.handler
+def search_text(message):
+    bot.delete_state(message.from_user.id, message.chat.id)
+    text = '' if message.text.strip() == '*' else message.text
+    msg, markup = find_words(message.chat.id, text, 0)
+    outbox.send_message(message.chat.id, msg, reply_markup=markup or NEXT_MARKUP)
+
+
+# Хэндлер для кнопок листания результатов поиска: страница заменяет текст того же сообщения
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith(SEARCH_CALLBACK))
+@metrics.handler
+def search_page_button(call):
+    text, page = parse_search_callback(call.data)
+    cid = call.message.chat.id
+    msg, markup = find_words(cid, text, page)
+    outbox.send(cid, 'edit_message_text', msg, cid, call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+
+# Хэндлер для inline запросов @бот <запрос>: поиск по словарю пользователя, следующие страницы
+# Telegram запрашивает сам со смещением next_offset. Ответ на запрос не сообщение в чат и идет мимо очереди
+@bot.inline_handler(func=lambda query: True)
+@metrics.handler
+def inline_search(query):
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    with get_connection() as conn:
+        words, total = search_words(conn, query.from_user.id, query.query, SEARCH_INLINE_LIMIT, offset)
+    next_offset = str(offset + len(words)) if words and offset + len(words) < total else ''
+    bot.answer_inline_query(query.id, inline_results(words), cache_time=0, is_personal=True, next_offset=next_offset)
+
+
+# Хэндлер для статистики пользователя: ответы, которые еще не записаны в БД, учитываются из буфера
+@bot.message_handler(commands=['stats'])
+@metrics.handler
+def stats(message):
+    cid = message.chat.id
+    with get_connection() as conn:
+        user_stats = find_stats(conn, cid)
+    if user_stats is None:
+        outbox.send_message(cid, 'Мы не нашли вас в базе данных. Нажмите /start', reply_markup=START_MARKUP)
+    else:
+        outbox.send_message(cid, stats_text(user_stats, answer_buffer.pending(cid)))
+
+
+# Хэндлер для таблицы лидеров
+@bot.message_handler(commands=['top'])
+@metrics.handler
+def leaderboard(message):
+    with get_connection() as conn:
+        rows = find_leaderboard(conn, LEADERBOARD_SIZE)
+    outbox.send_message(message.chat.id, leaderboard_text(rows, message.chat.id))
+
+
+# Хэндлер для выгрузки словаря: формат можно передать после команды (/export jsonl)
+@bot.message_handler(commands=['export'])
+@metrics.handler
+def export_dictionary(message):
+    fmt = message.text.partition(' ')[2].strip().lower() or 'csv'
+    if fmt not in transfer.FORMATS:
+        outbox.reply_to(message, 'Формат выгрузки: ' + ', '.join(transfer.FORMATS))
+        return
+    # Словарь пишется из серверного курсора во временный файл на диске, файл удаляется после отправки
+    f, count = transfer.export_to_tempfile(message.chat.id, fmt)
+    outbox.send_document(message.chat.id, f, visible_file_name=f'words.{fmt}',
+                         caption=f'Слов в выгрузке - {count}. Загрузить словарь обратно: /import')
+
+
+# Хэндлер для загрузки словаря из файла выгрузки
+@bot.message_handler(commands=['import'])
+@metrics.handler
+def import_dictionary(message):
+    bot.set_state(message.from_user.id, MyStates.waiting_for_import, message.chat.id)
+    outbox.send_message(message.chat.id, 'Отправьте файл, полученный командой /export (.csv или .jsonl).',
+                        reply_markup=CANCEL_MARKUP)
+
+
+# Хэндлер для файла выгрузки словаря
+@bot.message_handler(content_types=['document'], state=MyStates.waiting_for_import)
+@metrics.handler
+def import_dictionary_file(message):
+    bot.delete_state(message.from_user.id, message.chat.id)
+    file_info = bot.get_file(message.document.file_id)
+    # Telegram отдает файл целиком в память, поэтому файл без известного размера не скачиваем
+    file_size = message.document.file_size or file_info.file_size
+    if not file_size or file_size > TRANSFER_MAX_FILE_SIZE:
+        outbox.reply_to(message, f'Можно загрузить файл размером до {TRANSFER_MAX_FILE_SIZE // 2 ** 20} МБ.',
+                        reply_markup=NEXT_MARKUP)
+        return
+    # Строки файла разбираются и передаются в COPY потоком
+    added, skipped = transfer.import_bytes(message.chat.id, bot.download_file(file_info.file_path),
+                                           transfer.detect_format(message.document.file_name))
+    msg = f'Добавлено слов в словарь - {added}'
+    if skipped:
+        msg = show_hint(msg, f'Пропущено строк с ошибками - {skipped}')
+    outbox.reply_to(message, msg, reply_markup=NEXT_MARKUP)
+
+
 # Хэндлер для кнопки добавить слово
 @bot.message_handler(func=lambda message: message.text == Command.ADD_WORD)
+@metrics.handler
 def add_word(message):
     cid = message.chat.id
     bot.set_state(message.from_user.id , MyStates.waitng_for_word, cid)
-    bot.send_message(cid, "Введите слово.", reply_markup=types.ReplyKeyboardRemove())
+    outbox.send_message(cid, "Введите слово.", reply_markup=REMOVE_MARKUP)
 
 
 # Хэндлер для кнопки добавить случайное слово
 @bot.message_handler(func=lambda message: message.text == Command.ADD_RAND_WORD)
+@metrics.handler
 def add_rand_word(message):
     cid = message.chat.id
-    markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-    markup.add(types.KeyboardButton(get_random_word()))
-    markup.add(types.KeyboardButton(Command.ADD_RAND_WORD))
-    markup.add(types.KeyboardButton(Command.CANCEL))
     bot.set_state(message.from_user.id, MyStates.waitng_for_word, cid)
-    bot.send_message(cid, "Введите слово.", reply_markup=markup)
+    markup = keyboard(random_word_pool.get(), Command.ADD_RAND_WORD, Command.CANCEL, one_time=True)
+    outbox.send_message(cid, "Введите слово.", reply_markup=markup)
 
 
 # Хэндлер для обработки стейта по добавлению слова в БД
 @bot.message_handler(content_types=["text"], state=MyStates.waitng_for_word)
+@metrics.handler
 def translate_word(message):
     word = message.text
     # Получаем словарь с переводом введенного слова
@@ -206,9 +327,8 @@ def translate_word(message):
 
     # Если что то пошло не так с переводом
     if not translate_dict:
-        markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-        markup.add(types.KeyboardButton(Command.NEXT))
-        bot.reply_to(message, 'Не могу перевести слово.', reply_markup=markup)
+        text = 'Не могу перевести слово.' if translate_dict is False else 'Переводчик недоступен, попробуйте позже.'
+        outbox.reply_to(message, text, reply_markup=NEXT_MARKUP)
     else:
         word_lang_code = translate_dict['translations'][0]['detectedLanguageCode']
         translated_word = translate_dict['translations'][0]['text']
@@ -220,12 +340,7 @@ def translate_word(message):
             ru_word = translated_word
             en_word = word
 
-        markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-        add_word_btn = types.KeyboardButton(Command.YES)
-        cancel_btn = types.KeyboardButton(Command.CANCEL)
-        markup.add(add_word_btn)
-        markup.add(cancel_btn)
-        bot.reply_to(message, f'Добавить пару {ru_word}-{en_word} в словарь?', reply_markup=markup)
+        outbox.reply_to(message, f'Добавить пару {ru_word}-{en_word} в словарь?', reply_markup=YES_CANCEL_MARKUP)
         # Устанавливаем стэйт для сохранения пары слов в БД
         bot.set_state(message.from_user.id, MyStates.save_word, message.chat.id)
         with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
@@ -235,114 +350,114 @@ def translate_word(message):
 
 # Хэндлер для сохранения слов в БД
 @bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.save_word)
+@metrics.handler
 def save_word(message):
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
-        markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-        markup.add(types.KeyboardButton(Command.NEXT))
         if data['ru_word'] and data['en_word'] and message.chat.id and message.text == Command.YES:
 
             # Сохраняем слово в БД
-            conn = create_db_connection()
-            row_count = add_words(conn, message.chat.id, data['ru_word'], data['en_word'])
-            conn.close()
+            with get_connection() as conn:
+                row_count = add_words(conn, message.chat.id, data['ru_word'], data['en_word'])
 
             if row_count:
                 msg = f'{row_count} cлово добавлено.'
             else:
                 msg = 'Не удалось добавить слово'
 
-            bot.reply_to(message, msg, reply_markup=markup)
+            outbox.reply_to(message, msg, reply_markup=NEXT_MARKUP)
             bot.delete_state(message.from_user.id, message.chat.id)
         else:
-            bot.reply_to(message, 'Что-то пошло не так', reply_markup=markup)
+            outbox.reply_to(message, 'Что-то пошло не так', reply_markup=NEXT_MARKUP)
             bot.delete_state(message.from_user.id, message.chat.id)
 
 # Хэндлер для кнопки удалить слово
 @bot.message_handler(func=lambda message: message.text == Command.DELETE_WORD)
+@metrics.handler
 def delete_question(message):
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         # Если есть что удалять
-        if 'translate_word' in data:
-            markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-            del_word_btn = types.KeyboardButton(Command.YES)
-            next_btn = types.KeyboardButton(Command.CANCEL)
-            markup.add(del_word_btn)
-            markup.add(next_btn)
-            bot.send_message(message.chat.id, f'Удалить слово {data['translate_word']} из словаря?', reply_markup=markup)
+        if 'word_id' in data and 'translate_word' in data:
+            outbox.send_message(message.chat.id, f'Удалить слово {data['translate_word']} из словаря?',
+                                reply_markup=YES_CANCEL_MARKUP)
             bot.set_state(message.from_user.id, MyStates.delete_word, message.chat.id)
 
 
 # Хэндлер для удаления слова из БД
 @bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.delete_word)
+@metrics.handler
 def delete_word(message):
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
-
-        markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=False, one_time_keyboard=True)
-        markup.add(types.KeyboardButton(Command.NEXT))
         # Если определено слово для удаления
-        if 'translate_word' in data and message.text == Command.YES:
-            if data['translate_word'] and message.chat.id:
-                conn = create_db_connection()
-                count = del_word(conn, message.chat.id, data['translate_word'])
-                conn.close()
-                bot.reply_to(message, f'Удалено слов из словаря - {count}', reply_markup=markup)
+        if 'word_id' in data and message.text == Command.YES:
+            if data['word_id'] and message.chat.id:
+                with get_connection() as conn:
+                    count = del_word(conn, message.chat.id, data['word_id'])
+                outbox.reply_to(message, f'Удалено слов из словаря - {count}', reply_markup=NEXT_MARKUP)
                 bot.delete_state(message.from_user.id, message.chat.id)
         else:
-            bot.reply_to(message, 'Что-то пошло не так', reply_markup=markup)
+            outbox.reply_to(message, 'Что-то пошло не так', reply_markup=NEXT_MARKUP)
             bot.delete_state(message.from_user.id, message.chat.id)
 
 @bot.message_handler(func=lambda message: True, content_types=['text'], state=MyStates.check_answer)
+@metrics.handler
 def message_reply(message):
     text = message.text
     with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
         # print(data)
         # print('Ответ: ', text)
-        if 'target_word' in data:
+        if 'target_word' in data and 'word_id' in data:
             target_word = data['target_word']
             # Если ответ правильный
             if text == target_word:
-                # Добавляем 1 к счетчику правильных ответов слова
-                conn = create_db_connection()
-                add_right_answer(conn, message.chat.id, target_word)
-                conn.close()
+                # Добавляем 1 к счетчику правильных ответов слова (запись в БД - пачкой в фоне)
+                answer_buffer.add(message.chat.id, data['word_id'], True, answer_latency(data, message))
                 hint = show_target(data)
                 hint_text = ["Отлично!❤", hint]
-                next_btn = types.KeyboardButton(Command.NEXT)
-                add_word_btn = types.KeyboardButton(Command.ADD_WORD)
-                add_rnd_word_btn = types.KeyboardButton(Command.ADD_RAND_WORD)
-                delete_word_btn = types.KeyboardButton(Command.DELETE_WORD)
-                btns = []
-                btns.extend([next_btn, add_word_btn, add_rnd_word_btn, delete_word_btn])
                 hint = show_hint(*hint_text)
-                markup = types.ReplyKeyboardMarkup(row_width=1)
-                markup.add(*btns)
-                bot.reply_to(message, hint, reply_markup=markup)
+                outbox.reply_to(message, hint, reply_markup=SERVICE_MARKUP)
             else:
-                # Добавляем 1 к счетчику неправильных ответов слова
-                conn = create_db_connection()
-                add_wrong_answer(conn, message.chat.id, target_word)
-                conn.close()
-                buttons = data['buttons']
-                for btn in buttons:
-                    if btn.text == text:
-                        btn.text = text + '❌'
-                        break
+                # Добавляем 1 к счетчику неправильных ответов слова (запись в БД - пачкой в фоне)
+                answer_buffer.add(message.chat.id, data['word_id'], False, answer_latency(data, message))
+                answers = data.get('answers', [])
+                if text in answers and answers.index(text) not in data['wrong']:
+                    data['wrong'].append(answers.index(text))
                 hint = show_hint("Допущена ошибка!",
                                  f"Попробуй ещё раз вспомнить слово {data['translate_word']}")
-                markup = types.ReplyKeyboardMarkup(row_width=2)
-                markup.add(*buttons)
-                bot.reply_to(message, hint, reply_markup=markup)
+                # Новая подсказка с клавиатурой заменяет еще не отправленную предыдущую
+                outbox.reply_to(message, hint, kind='hint', reply_markup=card_markup(answers, data['wrong']))
         else:
             main_dialog(message)
 
 
 # Хэндлер с любым текстом
 @bot.message_handler(content_types=["text"])
+@metrics.handler
 def random_text(message):
     main_dialog(message)
 
 bot.add_custom_filter(custom_filters.StateFilter(bot))
 
-bot.infinity_polling(skip_pending=True)
+
+def run():
+    """
+    Функция запускает фоновые потоки и получение обновлений, а после остановки бота завершает их
+    :return: None
+    """
+    answer_buffer.start()
+    random_word_pool.start()
+    card_deck.start()
+    outbox.start()
+    metrics.start_server()
+    if os.environ.get('BOT_MODE', 'polling') == 'webhook':
+        run_webhook(bot, os.environ.get('WEBHOOK_HOST', '0.0.0.0'), int(os.environ.get('WEBHOOK_PORT', 8443)),
+                    os.environ.get('WEBHOOK_URL'), os.environ.get('WEBHOOK_SECRET') or None)
+    else:
+        bot.infinity_polling(skip_pending=True)
+    outbox.stop()
+    card_deck.stop()
+    random_word_pool.stop()
+    answer_buffer.stop()
 
 
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,327 @@
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import functools
+import inspect
+import json
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from config import METRICS_BUCKETS, QUERY_COUNT_BUCKETS, TRACE_SAMPLE_RATE, TRACE_LOG_PATH
+
+load_dotenv()
+METRICS_HOST = os.environ.get('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+# Метрики собираются, только если задан порт HTTP сервера метрик.
+# Без него декораторы возвращают функции без изменений и не добавляют никаких затрат
+enabled = bool(METRICS_PORT)
+
+_lock = threading.Lock()
+_trace_lock = threading.Lock()
+# Гистограммы и счетчики в порядке создания
+_families = []
+# Функции, возвращающие словари показателей компонентов бота: имя -> функция
+_collectors = {}
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                          for name, value in pairs) + '}'
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus: количество наблюдений по корзинам, сумма и количество для каждой метки
+    """
+
+    def __init__(self, name, help_text, label=None, kind=None, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = (label,) if label else ()
+        # Вид замера для счетчика ошибок и трасс: 'handler', 'db', 'external'
+        self.kind = kind
+        self.buckets = tuple(buckets)
+        # значение метки -> [счетчики корзин, сумма, количество]
+        self._series = {}
+        _families.append(self)
+
+    def observe(self, value, label=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with _lock:
+            series = sorted((label or '', counts[:], total, count)
+                            for label, (counts, total, count) in self._series.items())
+        for label, counts, total, count in series:
+            values = (label,) if self.label_names else ()
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, values, le=le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, values)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, values)} {count}')
+        return lines
+
+
+class Counter:
+    """
+    Счетчик в формате Prometheus с произвольным набором меток
+    """
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        _families.append(self)
+
+    def inc(self, labels=(), value=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with _lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+update_seconds = Histogram('bot_update_seconds', 'Время обработки обновления')
+handler_seconds = Histogram('bot_handler_seconds', 'Время работы обработчика', 'handler', 'handler')
+db_seconds = Histogram('bot_db_query_seconds', 'Время работы функций запросов к БД', 'function', 'db')
+external_seconds = Histogram('bot_external_call_seconds', 'Время обращений к внешним сервисам', 'call', 'external')
+queries_per_update = Histogram('bot_db_queries_per_update', 'Количество запросов к БД на одно обновление',
+                               buckets=QUERY_COUNT_BUCKETS)
+queries_total = Counter('bot_db_queries_total', 'Количество запросов к БД')
+errors = Counter('bot_errors_total', 'Количество исключений и неудачных запросов', ('kind', 'name'))
+
+
+class _Update:
+    __slots__ = ('started', 'queries', 'spans')
+
+    def __init__(self, sampled):
+        self.started = time.perf_counter()
+        self.queries = 0
+        # Замеры внутри обновления записываются, только если обновление попало в выборку трасс
+        self.spans = [] if sampled else None
+
+
+# Обновление, которое обрабатывается в текущем потоке или задаче asyncio
+_update = ContextVar('metrics_update', default=None)
+
+
+def _record(histogram, name, started):
+    duration = time.perf_counter() - started
+    histogram.observe(duration, name)
+    update = _update.get()
+    if update is not None and update.spans is not None:
+        update.spans.append((histogram.kind, name, started - update.started, duration))
+
+
+def timed(histogram):
+    """
+    Декоратор записывает время каждого вызова функции в гистограмму с меткой по имени функции,
+    а исключения - в счетчик errors. Работает и с корутинами
+    :param histogram: объект Histogram
+    :return: декоратор
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+        name = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc((histogram.kind, name))
+                    raise
+                finally:
+                    _record(histogram, name, started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc((histogram.kind, name))
+                raise
+            finally:
+                _record(histogram, name, started)
+        return wrapper
+    return decorator
+
+
+def _begin(sampled):
+    if _update.get() is not None:
+        return None
+    return _update.set(_Update(sampled))
+
+
+def _end(token, name, args):
+    update = _update.get()
+    _update.reset(token)
+    duration = time.perf_counter() - update.started
+    update_seconds.observe(duration)
+    queries_per_update.observe(update.queries)
+    if update.spans is not None:
+        _write_trace(name, args, update, duration)
+
+
+def handler(func):
+    """
+    Декоратор обработчика сообщений: время обработчика, количество запросов к БД на обновление
+    и, для доли TRACE_SAMPLE_RATE обновлений, трасса всех замеров в TRACE_LOG_PATH.
+    Обработчик, вызванный из другого обработчика, замеряется как часть того же обновления
+    :param func: функция или корутина обработчика telebot
+    :return: обернутый обработчик
+    """
+    func = timed(handler_seconds)(func)
+    if not enabled:
+        return func
+    name = func.__name__
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            token = _begin(random.random() < TRACE_SAMPLE_RATE)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                if token is not None:
+                    _end(token, name, args)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _begin(random.random() < TRACE_SAMPLE_RATE)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if token is not None:
+                _end(token, name, args)
+    return wrapper
+
+
+def count_query():
+    """
+    Функция учитывает запрос к БД в общем счетчике и в счетчике текущего обновления
+    :return: None
+    """
+    queries_total.inc()
+    update = _update.get()
+    if update is not None:
+        update.queries += 1
+
+
+def _write_trace(name, args, update, duration):
+    """
+    Функция дописывает трассу обновления строкой JSON в TRACE_LOG_PATH
+    :param name: имя обработчика
+    :param args: аргументы обработчика, первый - сообщение telebot
+    :param update: объект _Update
+    :param duration: время обработки в секундах
+    :return: None
+    """
+    chat = getattr(args[0], 'chat', None) if args else None
+    record = {
+        'ts': round(time.time(), 3),
+        'handler': name,
+        'chat_id': getattr(chat, 'id', None),
+        'ms': round(duration * 1000, 3),
+        'queries': update.queries,
+        'spans': [{'kind': kind, 'name': span_name, 'start_ms': round(start * 1000, 3), 'ms': round(span * 1000, 3)}
+                  for kind, span_name, start, span in update.spans],
+    }
+    line = json.dumps(record, ensure_ascii=False)
+    with _trace_lock:
+        with open(TRACE_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def collect(name, func):
+    """
+    Функция регистрирует показатели компонента бота, которые читаются при каждом запросе /metrics
+    :param name: имя компонента, становится частью имени метрики bot_<name>_<показатель>
+    :param func: функция без параметров, возвращающая словарь числовых показателей
+    :return: None
+    """
+    _collectors[name] = func
+
+
+def render():
+    """
+    Функция формирует текст всех метрик в формате Prometheus
+    :return: str
+    """
+    lines = []
+    for family in _families:
+        lines.extend(family.render())
+    for name, func in list(_collectors.items()):
+        try:
+            values = func()
+        except Exception as e:
+            print(f'Не удалось собрать показатели {name}: {e}')
+            continue
+        for key, value in values.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'# TYPE bot_{name}_{key} gauge')
+                lines.append(f'bot_{name}_{key} {float(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Функция запускает HTTP сервер метрик в фоновом потоке, если метрики включены
+    :param host: адрес HTTP сервера
+    :param port: порт HTTP сервера
+    :return: объект ThreadingHTTPServer или None если метрики выключены
+    """
+    if not enabled:
+        return None
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f'Метрики доступны по адресу http://{host}:{server.server_port}/metrics')
+    return server
@@ -0,0 +1,301 @@
+from collections import deque
+import atexit
+import heapq
+import itertools
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from config import (OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_GROUP_RATE, OUTBOX_WORKERS,
+                    OUTBOX_SWEEP_INTERVAL)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется со скоростью rate токенов в секунду, вмещает не больше capacity
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        """
+        Функция возвращает, сколько секунд ждать следующего токена
+        :param now: текущее время time.monotonic()
+        :return: float, 0 если токен есть
+        """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Chat:
+    __slots__ = ('messages', 'bucket', 'blocked_until', 'scheduled')
+
+    def __init__(self, bucket):
+        # Очередь сообщений чата: (метод бота, args, kwargs, вид сообщения, время постановки в очередь)
+        self.messages = deque()
+        self.bucket = bucket
+        # До какого времени Telegram попросил не писать в чат (retry_after)
+        self.blocked_until = 0
+        # Чат стоит в расписании отправки или его сообщение отправляется прямо сейчас
+        self.scheduled = False
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений. Обработчики ставят сообщения в очередь и сразу освобождаются,
+    потоки отправки соблюдают ограничения Telegram на скорость для всех чатов и для каждого чата.
+    Сообщения одного чата отправляются строго по порядку. Ответ 429 откладывает только свой чат
+    на retry_after секунд. Сообщение с видом kind заменяет еще не отправленное сообщение того же вида
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, group_rate=OUTBOX_GROUP_RATE):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # Расписание отправки: куча из (время, номер, chat_id)
+        self._ready = []
+        self._seq = itertools.count()
+        self._depth = 0
+        self._last_sweep = time.monotonic()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        self.stats = {'sent': 0, 'failed': 0, 'coalesced': 0, 'rate_limited': 0,
+                      'latency_total': 0.0, 'latency_max': 0.0, 'send_total': 0.0}
+
+    def _bucket(self, chat_id):
+        # Отрицательные id у групп и каналов
+        if chat_id < 0:
+            return TokenBucket(self.group_rate, 1)
+        return TokenBucket(self.chat_rate, self.chat_burst)
+
+    def _schedule(self, chat_id, at):
+        heapq.heappush(self._ready, (at, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def send(self, chat_id, method, *args, kind=None, **kwargs):
+        """
+        Функция ставит вызов метода бота в очередь чата
+        :param chat_id: id чата, в который отправляется сообщение
+        :param method: имя метода бота ('send_message', 'reply_to', ...) или функция, которая отправляет сообщение
+        :param args: позиционные аргументы метода
+        :param kind: вид сообщения, например 'card': неотправленные сообщения того же вида в чате удаляются
+        :param kwargs: именованные аргументы метода
+        :return: None
+        """
+        now = time.monotonic()
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(self._bucket(chat_id))
+            if kind is not None and chat.messages:
+                kept = deque(message for message in chat.messages if message[3] != kind)
+                coalesced = len(chat.messages) - len(kept)
+                if coalesced:
+                    chat.messages = kept
+                    self._depth -= coalesced
+                    self.stats['coalesced'] += coalesced
+            chat.messages.append((method, args, kwargs, kind, now))
+            self._depth += 1
+            if not chat.scheduled:
+                chat.scheduled = True
+                self._schedule(chat_id, max(now, chat.blocked_until))
+            if now - self._last_sweep > OUTBOX_SWEEP_INTERVAL:
+                self._sweep(now)
+
+    def send_message(self, chat_id, text, kind=None, **kwargs):
+        self.send(chat_id, 'send_message', chat_id, text, kind=kind, **kwargs)
+
+    def reply_to(self, message, text, kind=None, **kwargs):
+        self.send(message.chat.id, 'reply_to', message, text, kind=kind, **kwargs)
+
+    def send_document(self, chat_id, document, kind=None, **kwargs):
+        def send(*args, **kw):
+            # После ответа 429 отправка повторяется, поэтому файл каждый раз читается с начала
+            document.seek(0)
+            return self.bot.send_document(*args, **kw)
+        self.send(chat_id, send, chat_id, document, kind=kind, **kwargs)
+
+    def _sweep(self, now):
+        # Счетчики чатов без сообщений, у которых ведро уже полное, больше не нужны
+        self._last_sweep = now
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.scheduled and now >= chat.blocked_until and chat.bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+    def _next(self):
+        """
+        Функция ждет, пока какой-нибудь чат сможет отправить сообщение, и достает это сообщение
+        :return: кортеж (chat_id, сообщение) или None если очередь остановлена и пуста
+        """
+        with self._cond:
+            while True:
+                if not self._ready:
+                    if self._stopped:
+                        return None
+                    self._cond.wait()
+                    continue
+                at, _, chat_id = self._ready[0]
+                now = time.monotonic()
+                if at > now:
+                    self._cond.wait(at - now)
+                    continue
+                chat = self._chats[chat_id]
+                wait = chat.bucket.delay(now)
+                if wait:
+                    heapq.heapreplace(self._ready, (now + wait, next(self._seq), chat_id))
+                    continue
+                wait = self._global.delay(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._ready)
+                chat.bucket.take()
+                self._global.take()
+                self._depth -= 1
+                return chat_id, chat.messages.popleft()
+
+    def _finish(self, chat_id, message, retry_after=None):
+        with self._cond:
+            chat = self._chats[chat_id]
+            now = time.monotonic()
+            if retry_after is not None:
+                # Сообщение возвращается в начало очереди, чат откладывается, остальные чаты не ждут
+                chat.messages.appendleft(message)
+                self._depth += 1
+                chat.blocked_until = now + retry_after
+                self.stats['rate_limited'] += 1
+            if chat.messages:
+                self._schedule(chat_id, max(now, chat.blocked_until))
+            else:
+                chat.scheduled = False
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            chat_id, message = item
+            method, args, kwargs, _, enqueued_at = message
+            started = time.monotonic()
+            retry_after = None
+            try:
+                (method if callable(method) else getattr(self.bot, method))(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                else:
+                    self._count_failed(chat_id, e)
+            except Exception as e:
+                self._count_failed(chat_id, e)
+            else:
+                now = time.monotonic()
+                with self._cond:
+                    self.stats['sent'] += 1
+                    self.stats['send_total'] += now - started
+                    self.stats['latency_total'] += now - enqueued_at
+                    self.stats['latency_max'] = max(self.stats['latency_max'], now - enqueued_at)
+            self._finish(chat_id, message, retry_after)
+
+    def _count_failed(self, chat_id, error):
+        with self._cond:
+            self.stats['failed'] += 1
+        print(f'Не удалось отправить сообщение в чат {chat_id}: {error}')
+
+    def depth(self):
+        """
+        Функция возвращает количество сообщений в очереди
+        :return: int
+        """
+        return self._depth
+
+    def metrics(self):
+        """
+        Функция возвращает метрики очереди: глубину, счетчики и задержки отправки
+        :return: словарь, latency_avg - среднее время от постановки в очередь до отправки,
+        send_avg - среднее время запроса к Telegram, в секундах
+        """
+        with self._cond:
+            stats = dict(self.stats)
+            stats['depth'] = self._depth
+            stats['chats'] = sum(1 for chat in self._chats.values() if chat.messages)
+        sent = stats['sent'] or 1
+        stats['latency_avg'] = stats.pop('latency_total') / sent
+        stats['send_avg'] = stats.pop('send_total') / sent
+        return stats
+
+    def start(self):
+        """
+        Функция запускает потоки отправки и отправку остатка очереди при завершении программы
+        :return: None
+        """
+        if not self._threads:
+            self._stopped = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Функция дожидается отправки сообщений из очереди и останавливает потоки отправки
+        :return: None
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+if __name__ == '__main__':
+    # Проверка на заглушке бота: первая отправка получает 429, карточки заменяют друг друга,
+    # сообщения одного чата уходят не чаще OUTBOX_CHAT_RATE в секунду после всплеска
+    class StubBot:
+        def __init__(self):
+            self.sent = []
+            self.limited = False
+
+        def send_message(self, chat_id, text, **kwargs):
+            if not self.limited:
+                self.limited = True
+                raise ApiTelegramException('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                                                 'parameters': {'retry_after': 1}})
+            self.sent.append((round(time.monotonic() - started, 1), chat_id, text))
+
+    stub = StubBot()
+    outbox = Outbox(stub)
+    started = time.monotonic()
+    outbox.start()
+    for i in range(5):
+        outbox.send_message(1, f'карточка {i}', kind='card')
+    for i in range(5):
+        outbox.send_message(2, f'сообщение {i}')
+    outbox.stop()
+    for item in stub.sent:
+        print(*item)
+    print(outbox.metrics())
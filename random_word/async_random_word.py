@@ -0,0 +1,34 @@
+from db import async_db
+from http_client import async_http_client
+from metrics import metrics
+from random_word.pool import random_word_pool
+from random_word.random_word import RANDOM_WORD_URL
+
+# Асинхронное получение случайных слов для бота на asyncio
+
+
+@metrics.timed(metrics.external_seconds)
+async def get_random_words(count):
+    """
+    Функция обращается к стороннему сервису для получения нескольких случайных слов на англ. языке
+    :param count: количество слов
+    :return: list случайных слов на англ. языке
+    """
+    response = await async_http_client.get(RANDOM_WORD_URL, 'random_word', params={'number': count})
+    response.raise_for_status()
+    return await response.json(content_type=None)
+
+
+async def get_random_word():
+    """
+    Функция выдает случайное слово: из пула случайных слов, если он пуст - из общего словаря,
+    если и словарь пуст - из стороннего сервиса
+    :return: str случайное слово на англ. языке
+    """
+    word = random_word_pool.get_nowait()
+    if word is None:
+        async with async_db.get_connection() as conn:
+            word = await async_db.take_local_random_word(conn)
+    if word is None:
+        word = (await get_random_words(1))[0]
+    return word
@@ -0,0 +1,124 @@
+from collections import deque
+import threading
+
+from config import RANDOM_WORD_POOL_LOW, RANDOM_WORD_POOL_HIGH, RANDOM_WORD_PRETRANSLATE
+from db.db import get_connection, save_random_words, take_saved_random_words, take_local_random_word
+from metrics import metrics
+from random_word.random_word import get_random_words
+from yandex_translate.cache import translate_many
+
+
+class RandomWordPool:
+    """
+    Пул случайных слов, который пополняется в фоне, чтобы обработчик не ждал сторонний сервис.
+    Слова сверх RANDOM_WORD_POOL_HIGH сохраняются в БД и используются при следующем пополнении
+    """
+
+    def __init__(self, low=RANDOM_WORD_POOL_LOW, high=RANDOM_WORD_POOL_HIGH, pretranslate=RANDOM_WORD_PRETRANSLATE):
+        self.low = low
+        self.high = high
+        self.pretranslate = pretranslate
+        self._words = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._words)
+
+    def get(self):
+        """
+        Функция выдает случайное слово из пула. Если пул пуст, слово берется из общего словаря
+        :return: str случайное слово на англ. языке или None
+        """
+        word = self.get_nowait()
+        if word is None:
+            with get_connection() as conn:
+                word = take_local_random_word(conn)
+        return word
+
+    def get_nowait(self):
+        """
+        Функция выдает случайное слово из пула, не обращаясь к БД
+        :return: str случайное слово на англ. языке или None если пул пуст
+        """
+        if len(self._words) < self.low:
+            self._wakeup.set()
+        try:
+            return self._words.popleft()
+        except IndexError:
+            return None
+
+    def refill(self):
+        """
+        Функция пополняет пул: сначала из запаса в БД, затем из стороннего сервиса
+        :return: количество добавленных слов
+        """
+        need = self.high - len(self._words)
+        if need <= 0:
+            return 0
+        with get_connection() as conn:
+            words = take_saved_random_words(conn, need)
+        if len(words) < need:
+            try:
+                words += get_random_words(need - len(words))
+            except Exception:
+                # Сервис недоступен: слова, уже взятые из запаса в БД, не теряем, а отдаем в пул
+                with self._lock:
+                    self._words.extend(words)
+                raise
+
+        # Убираем слова, для которых у переводчика нет перевода: переводы остальных попадут в кэш переводов.
+        # Слова, которые не удалось перевести из-за недоступности переводчика (None), остаются в пуле
+        if self.pretranslate and words:
+            words = [word for word, result in zip(words, translate_many(words)) if result is not False]
+
+        with self._lock:
+            free = self.high - len(self._words)
+            self._words.extend(words[:free])
+            overflow = words[free:]
+        if overflow:
+            with get_connection() as conn:
+                save_random_words(conn, overflow)
+        return len(words) - len(overflow)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if len(self._words) < self.low:
+                try:
+                    self.refill()
+                except Exception as e:
+                    print(f'Не удалось пополнить пул случайных слов: {e}')
+            self._wakeup.wait(60)
+            self._wakeup.clear()
+
+    def start(self):
+        """
+        Функция запускает фоновое пополнение пула
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='random-word-pool', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Функция останавливает пополнение и сохраняет оставшиеся слова в БД для следующего запуска
+        :return: None
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            words = list(self._words)
+            self._words.clear()
+        if words:
+            with get_connection() as conn:
+                save_random_words(conn, words)
+
+
+random_word_pool = RandomWordPool()
+metrics.collect('random_word_pool', lambda: {'words': len(random_word_pool)})
@@ -1,13 +1,31 @@
-import requests
+import os
+
+from http_client import http_client
+from metrics import metrics
+
+# Адрес сервиса случайных слов, можно заменить локальной заглушкой (benchmarks/load_test.py)
+RANDOM_WORD_URL = os.environ.get('RANDOM_WORD_URL') or 'https://random-word-api.herokuapp.com/word'
+
+
+@metrics.timed(metrics.external_seconds)
+def get_random_words(count):
+    """
+    Функция обращается к стороннему сервису для получения нескольких случайных слов на англ. языке
+    :param count: количество слов
+    :return: list случайных слов на англ. языке
+    """
+    response = http_client.get(RANDOM_WORD_URL, 'random_word', params={'number': count})
+    response.raise_for_status()
+    return response.json()
+
 
 def get_random_word():
     """
     Функция обращается к стороннему сервису для получения случайного слова на англ. языке
     :return: str случайное слово на англ. языке
     """
-    response = requests.get('https://random-word-api.herokuapp.com/word')
-    return response.json()[0]
+    return get_random_words(1)[0]
 
 
 if __name__ == '__main__':
-    print(get_random_word())
\ No newline at end of file
+    print(get_random_word())
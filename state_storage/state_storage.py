@@ -0,0 +1,173 @@
+import json
+import sqlite3
+import threading
+import time
+
+from telebot.storage.base_storage import StateStorageBase, StateDataContext
+from telebot import asyncio_storage
+
+from config import STATE_DB_PATH, STATE_TTL, STATE_PURGE_INTERVAL
+
+
+class SQLiteStateStorage(StateStorageBase):
+    """
+    Хранилище состояний диалогов в файле SQLite: состояние и данные переживают перезапуск бота.
+    Данные хранятся в JSON, поэтому в них можно класть только строки, числа, списки и словари.
+    Записи чатов, неактивных дольше STATE_TTL секунд, считаются отсутствующими и периодически удаляются
+    """
+
+    def __init__(self, path=STATE_DB_PATH, ttl=STATE_TTL, separator=':', prefix='telebot'):
+        super().__init__()
+        self.ttl = ttl
+        self.separator = separator
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._last_purge = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS states(
+                    key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+                """)
+
+    def _key(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self._get_key(chat_id, user_id, self.prefix, self.separator,
+                             business_connection_id, message_thread_id, bot_id)
+
+    def _load(self, key):
+        """
+        Функция читает запись состояния
+        :param key: ключ записи
+        :return: кортеж (состояние, словарь данных) или None если записи нет или она устарела
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT state, data FROM states WHERE key = ? AND updated_at >= ?',
+                                    (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _execute(self, sql, params):
+        """
+        Функция выполняет изменяющий запрос и время от времени удаляет устаревшие записи
+        :return: количество измененных строк
+        """
+        now = time.time()
+        with self._lock:
+            rowcount = self.conn.execute(sql, params).rowcount
+            if now - self._last_purge > STATE_PURGE_INTERVAL:
+                self._last_purge = now
+                self.conn.execute('DELETE FROM states WHERE updated_at < ?', (now - self.ttl,))
+        return rowcount
+
+    @staticmethod
+    def _dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    def set_state(self, chat_id, user_id, state, business_connection_id=None, message_thread_id=None, bot_id=None):
+        if hasattr(state, 'name'):
+            state = state.name
+        now = time.time()
+        # Данные устаревшей записи не переносятся в новое состояние
+        self._execute("""
+                INSERT INTO states (key, state, data, updated_at)
+                VALUES (?, ?, '{}', ?)
+                ON CONFLICT (key) DO UPDATE
+                   SET state = excluded.state,
+                       data = CASE WHEN states.updated_at < ? THEN '{}' ELSE states.data END,
+                       updated_at = excluded.updated_at
+                """, (self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id),
+                      state, now, now - self.ttl))
+        return True
+
+    def get_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        record = self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record[0] if record is not None else None
+
+    def delete_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        return self._execute('DELETE FROM states WHERE key = ?', (key,)) > 0
+
+    def set_data(self, chat_id, user_id, key, value,
+                 business_connection_id=None, message_thread_id=None, bot_id=None):
+        _key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = self._load(_key)
+        if record is None:
+            raise RuntimeError(f'SQLiteStateStorage: key {_key} does not exist.')
+        data = record[1]
+        data[key] = value
+        self._execute('UPDATE states SET data = ?, updated_at = ? WHERE key = ?',
+                      (self._dumps(data), time.time(), _key))
+        return True
+
+    def get_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        record = self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record[1] if record is not None else {}
+
+    def reset_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        return self._execute("UPDATE states SET data = '{}', updated_at = ? WHERE key = ? AND updated_at >= ?",
+                             (time.time(), key, time.time() - self.ttl)) > 0
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None,
+                             bot_id=None):
+        return StateDataContext(self, chat_id=chat_id, user_id=user_id, business_connection_id=business_connection_id,
+                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    def save(self, chat_id, user_id, data, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        return self._execute('UPDATE states SET data = ?, updated_at = ? WHERE key = ? AND updated_at >= ?',
+                             (self._dumps(data), time.time(), key, time.time() - self.ttl)) > 0
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class AsyncSQLiteStateStorage(asyncio_storage.StateStorageBase):
+    """
+    То же хранилище состояний в SQLite для AsyncTeleBot. Запросы к локальному файлу в режиме WAL
+    занимают доли миллисекунды, поэтому выполняются прямо в цикле событий
+    """
+
+    def __init__(self, path=STATE_DB_PATH, ttl=STATE_TTL, separator=':', prefix='telebot'):
+        super().__init__()
+        self.storage = SQLiteStateStorage(path, ttl, separator, prefix)
+
+    async def set_state(self, chat_id, user_id, state,
+                        business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.set_state(chat_id, user_id, state, business_connection_id, message_thread_id, bot_id)
+
+    async def get_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.get_state(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+
+    async def delete_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.delete_state(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+
+    async def set_data(self, chat_id, user_id, key, value,
+                       business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.set_data(chat_id, user_id, key, value,
+                                     business_connection_id, message_thread_id, bot_id)
+
+    async def get_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.get_data(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+
+    async def reset_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.reset_data(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None,
+                             bot_id=None):
+        return asyncio_storage.StateDataContext(self, chat_id=chat_id, user_id=user_id,
+                                                business_connection_id=business_connection_id,
+                                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    async def save(self, chat_id, user_id, data, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.storage.save(chat_id, user_id, data, business_connection_id, message_thread_id, bot_id)
+
+    def close(self):
+        self.storage.close()
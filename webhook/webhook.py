@@ -0,0 +1,157 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import threading
+
+from telebot import types
+
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_PATH, WEBHOOK_RETRY_AFTER
+from metrics import metrics
+
+
+def update_chat_id(update):
+    """
+    Функция определяет чат, к которому относится обновление
+    :param update: объект types.Update
+    :return: id чата, пользователя или номер обновления, если чата нет
+    """
+    message = update.message or update.edited_message
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query is not None:
+        return update.inline_query.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Пул обработчиков обновлений. У каждого обработчика своя ограниченная очередь,
+    обновления одного чата всегда попадают в одну очередь и обрабатываются по порядку
+    """
+
+    def __init__(self, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.bot = bot
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self._threads = []
+
+    def submit(self, update):
+        """
+        Функция ставит обновление в очередь его чата
+        :param update: объект types.Update
+        :return: False если очередь заполнена и обновление не принято
+        """
+        worker_queue = self.queues[hash(update_chat_id(update)) % len(self.queues)]
+        try:
+            worker_queue.put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        """
+        Функция возвращает общее количество обновлений в очередях
+        :return: int
+        """
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def _run(self, worker_queue):
+        while True:
+            update = worker_queue.get()
+            if update is None:
+                break
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f'Ошибка обработки обновления {update.update_id}: {e}')
+
+    def start(self):
+        # Обработчики выполняются в потоках пула, собственный пул потоков бота нарушил бы порядок
+        self.bot.threaded = False
+        for i, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(worker_queue,), name=f'webhook-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Функция дожидается обработки уже принятых обновлений и останавливает пул
+        :return: None
+        """
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def make_handler(dispatcher, secret_token=None):
+    """
+    Функция создает класс обработчика HTTP запросов вебхука
+    :param dispatcher: объект UpdateDispatcher
+    :param secret_token: секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+    :return: класс для ThreadingHTTPServer
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, headers=None):
+            self.send_response(code)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != WEBHOOK_PATH:
+                return self._reply(404)
+            if secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+                return self._reply(403)
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                # Отрицательная длина заставила бы читать тело до закрытия соединения
+                if length < 0:
+                    raise ValueError(length)
+                update = types.Update.de_json(json.loads(self.rfile.read(length)))
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400)
+            # При переполненной очереди Telegram повторит доставку обновления позже
+            if not dispatcher.submit(update):
+                return self._reply(503, {'Retry-After': str(WEBHOOK_RETRY_AFTER)})
+            self._reply(200)
+
+        def log_message(self, *args):
+            pass
+
+    return WebhookHandler
+
+
+def run_webhook(bot, host, port, url=None, secret_token=None):
+    """
+    Функция запускает встроенный HTTP сервер для получения обновлений от Telegram.
+    Если url не задан, вебхук в Telegram не регистрируется: так можно отправлять
+    на сервер записанные обновления локально
+    :param bot: объект TeleBot
+    :param host: адрес для HTTP сервера
+    :param port: порт для HTTP сервера
+    :param url: публичный адрес вебхука без WEBHOOK_PATH
+    :param secret_token: секрет для проверки запросов от Telegram
+    :return: None
+    """
+    dispatcher = UpdateDispatcher(bot)
+    dispatcher.start()
+    metrics.collect('webhook', lambda: {'depth': dispatcher.depth()})
+    server = ThreadingHTTPServer((host, port), make_handler(dispatcher, secret_token))
+    if url:
+        bot.remove_webhook()
+        bot.set_webhook(url=url.rstrip('/') + WEBHOOK_PATH, secret_token=secret_token,
+                        max_connections=len(dispatcher.queues))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        dispatcher.stop()
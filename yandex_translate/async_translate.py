@@ -0,0 +1,146 @@
+import asyncio
+
+import aiohttp
+import requests
+
+from db import async_db
+from http_client import async_http_client
+from http_client.http_client import RETRY_STATUSES
+from metrics import metrics
+from yandex_translate.cache import translation_cache, normalize
+from yandex_translate.yandex_translate import FOLDER_ID, YANDEX_TOKEN, YANDEX_TRANSLATE_URL, detect_local, _count_detect
+
+# Асинхронный перевод для бота на asyncio: тот же кэш переводов в памяти и в БД, что в yandex_translate.cache
+
+# Ошибки запроса: сетевые, разомкнутый предохранитель (CircuitOpenError из http_client) и неверный JSON
+_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, requests.RequestException, ValueError)
+
+
+def _headers():
+    return {
+        "Content-Type": "application/json",
+        "Authorization": "Api-Key {0}".format(YANDEX_TOKEN),
+    }
+
+
+@metrics.timed(metrics.external_seconds)
+async def detect(word):
+    """
+    Функция определяет на каком языке введено слово
+    :param word: слово, язык которого надо определить
+    :return: str код языка для яндекс словаря ('en' или 'ru'), False если язык не определен
+    или None если сервис недоступен
+    """
+    body = {
+        "text": word,
+        "folderId": FOLDER_ID,
+    }
+    try:
+        response = await async_http_client.post(
+            YANDEX_TRANSLATE_URL + '/detect',
+            'yandex_translate',
+            json=body,
+            headers=_headers(),
+        )
+        if response.status in RETRY_STATUSES:
+            return None
+        resp = await response.json(content_type=None)
+    except _REQUEST_ERRORS:
+        return None
+    return resp.get('languageCode', False)
+
+
+async def detect_lang(word):
+    """
+    Функция определяет язык слова: по алфавиту, а если он не понятен - через Яндекс
+    :param word: слово, язык которого надо определить
+    :return: str код языка, False или None (как detect)
+    """
+    word_lang = detect_local(word)
+    if word_lang:
+        _count_detect('local')
+        return word_lang
+    _count_detect('remote')
+    return await detect(word)
+
+
+@metrics.timed(metrics.external_seconds)
+async def translate(word, word_lang=None):
+    """
+    Функция осуществляет перевод слова или фразы посредством API Яндекс переводчика
+    :param word: слово или фраза, которые нужно перевести
+    :param word_lang: язык слова, если он уже известен
+    :return: словарь с переводом в формате yandex_translate.translate, False или None
+    """
+    if word_lang is None:
+        word_lang = await detect_lang(word)
+    if not word_lang:
+        return word_lang
+    if word_lang == 'ru':
+        target_language = 'en'
+    elif word_lang == 'en':
+        target_language = 'ru'
+    else:
+        return False
+    body = {
+        "targetLanguageCode": target_language,
+        "texts": word,
+        "folderId": FOLDER_ID,
+    }
+    try:
+        response = await async_http_client.post(
+            YANDEX_TRANSLATE_URL + '/translate',
+            'yandex_translate',
+            json=body,
+            headers=_headers(),
+        )
+        if response.status in RETRY_STATUSES:
+            return None
+        resp = await response.json(content_type=None)
+    except _REQUEST_ERRORS:
+        return None
+    if 'translations' not in resp:
+        return False
+    return resp
+
+
+async def translate_cached(word):
+    """
+    Функция переводит слово через общий кэш переводов. При промахе кэша в памяти
+    поиск в БД и определение языка выполняются одновременно
+    :param word: слово или фраза, которые нужно перевести
+    :return: словарь с переводом в формате yandex_translate.translate, False или None
+    """
+    text = normalize(word)
+    cached = translation_cache.get(text)
+    if cached is not None:
+        translation_cache._count('memory_hits')
+        return cached[0]
+    result = translation_cache.offline(text)
+    if result is not None:
+        return result
+
+    lang_task = asyncio.create_task(detect_lang(text))
+    try:
+        async with async_db.get_connection() as conn:
+            row = await async_db.find_translation(conn, text, translation_cache.ttl, translation_cache.negative_ttl)
+    except BaseException:
+        lang_task.cancel()
+        raise
+    if row is not None:
+        # Язык уже не нужен: запрос к Яндексу, если он начался, отменяем
+        lang_task.cancel()
+        translation_cache._count('db_hits')
+        result = row[0] or False
+        translation_cache.put(text, result)
+        return result
+
+    translation_cache._count('misses')
+    word_lang = await lang_task
+    # Язык не удалось определить из-за недоступности сервиса: translate() снова вызвал бы detect
+    result = await translate(text, word_lang) if word_lang is not None else None
+    if result is not None:
+        translation_cache.put(text, result)
+        async with async_db.get_connection() as conn:
+            await async_db.save_translation(conn, text, result or None)
+    return result
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import threading
+import time
+
+from config import TRANSLATE_CACHE_SIZE, TRANSLATE_CACHE_TTL, TRANSLATE_NEGATIVE_TTL
+from db.db import get_connection, find_translation, save_translation, find_translations, save_translations
+from dictionary.dictionary import lookup
+from metrics import metrics
+from yandex_translate import yandex_translate
+
+
+class TranslationCache:
+    """
+    Двухуровневый кэш переводов: LRU в памяти с ограниченным временем жизни записей,
+    за ним таблица translations в БД. Ответ Яндекса без перевода тоже кэшируется, но на короткое время,
+    а результат None (сервис недоступен) не кэшируется совсем
+    """
+
+    def __init__(self, size=TRANSLATE_CACHE_SIZE, ttl=TRANSLATE_CACHE_TTL, negative_ttl=TRANSLATE_NEGATIVE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # нормализованный текст -> (перевод или False, время истечения)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'dictionary_hits': 0, 'db_hits': 0, 'misses': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get(self, text):
+        """
+        Функция ищет перевод в памяти
+        :param text: нормализованный текст
+        :return: кортеж (перевод или False) или None если записи нет
+        """
+        with self._lock:
+            item = self._items.get(text)
+            if item is None:
+                return None
+            if item[1] < time.monotonic():
+                del self._items[text]
+                return None
+            self._items.move_to_end(text)
+            return (item[0],)
+
+    def put(self, text, result):
+        """
+        Функция сохраняет перевод в памяти, вытесняя самые старые записи
+        :param text: нормализованный текст
+        :param result: перевод или False
+        :return: None
+        """
+        if result is None:
+            return
+        ttl = self.ttl if result else self.negative_ttl
+        with self._lock:
+            self._items[text] = (result, time.monotonic() + ttl)
+            self._items.move_to_end(text)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def offline(self, text):
+        """
+        Функция ищет перевод в офлайн словаре
+        :param text: нормализованный текст
+        :return: словарь с переводом в формате yandex_translate.translate или None если слова в словаре нет
+        """
+        # Язык нужен в ответе, поэтому слова со смешанным алфавитом в словаре не ищем
+        lang = yandex_translate.detect_local(text)
+        if lang is None:
+            return None
+        translated = lookup(text)
+        if translated is None:
+            return None
+        self._count('dictionary_hits')
+        return {'translations': [{'text': translated, 'detectedLanguageCode': lang}]}
+
+    def translate(self, word):
+        """
+        Функция переводит слово через кэш и офлайн словарь, обращаясь к Яндекс переводчику только при промахе
+        :param word: слово или фраза, которые нужно перевести
+        :return: словарь с переводом в формате yandex_translate.translate, False или None
+        """
+        text = normalize(word)
+        cached = self.get(text)
+        if cached is not None:
+            self._count('memory_hits')
+            return cached[0]
+        result = self.offline(text)
+        if result is not None:
+            return result
+
+        with get_connection() as conn:
+            row = find_translation(conn, text, self.ttl, self.negative_ttl)
+        if row is not None:
+            self._count('db_hits')
+            result = row[0] or False
+            self.put(text, result)
+            return result
+
+        self._count('misses')
+        result = yandex_translate.translate(text)
+        if result is not None:
+            self.put(text, result)
+            with get_connection() as conn:
+                save_translation(conn, text, result or None)
+        return result
+
+    def translate_many(self, words):
+        """
+        Функция переводит список слов через кэш. Промахи ищутся в БД одним запросом,
+        оставшиеся слова переводятся пачками
+        :param words: list из слов или фраз
+        :return: list результатов в том же порядке, каждый в формате yandex_translate.translate, False или None
+        """
+        texts = [normalize(word) for word in words]
+        found = {}
+        for text in set(texts):
+            cached = self.get(text)
+            if cached is not None:
+                self._count('memory_hits')
+                found[text] = cached[0]
+
+        for text in set(texts) - set(found):
+            result = self.offline(text)
+            if result is not None:
+                found[text] = result
+
+        missing = [text for text in set(texts) if text not in found]
+        if missing:
+            with get_connection() as conn:
+                rows = find_translations(conn, missing, self.ttl, self.negative_ttl)
+            for text, result in rows.items():
+                self._count('db_hits')
+                found[text] = result or False
+                self.put(text, found[text])
+
+        missing = [text for text in missing if text not in found]
+        if missing:
+            for text, result in zip(missing, yandex_translate.translate_many(missing)):
+                self._count('misses')
+                found[text] = result
+                self.put(text, result)
+            answered = [(text, found[text] or None) for text in missing if found[text] is not None]
+            if answered:
+                with get_connection() as conn:
+                    save_translations(conn, answered)
+
+        return [found[text] for text in texts]
+
+
+def normalize(word):
+    """
+    Функция приводит текст к виду ключа кэша: нижний регистр, одиночные пробелы
+    :param word: исходный текст
+    :return: str нормализованный текст
+    """
+    return ' '.join(word.lower().split())
+
+
+translation_cache = TranslationCache()
+metrics.collect('translation_cache', lambda: dict(translation_cache.stats))
+
+
+def translate(word):
+    """
+    Функция переводит слово с использованием общего кэша переводов
+    :param word: слово или фраза, которые нужно перевести
+    :return: словарь с переводом в формате yandex_translate.translate, False если перевода нет
+    или None если переводчик недоступен
+    """
+    return translation_cache.translate(word)
+
+
+def translate_many(words):
+    """
+    Функция переводит список слов с использованием общего кэша переводов
+    :param words: list из слов или фраз
+    :return: list результатов в том же порядке, каждый в формате yandex_translate.translate, False или None
+    """
+    return translation_cache.translate_many(words)
@@ -1,18 +1,28 @@
 from dotenv import load_dotenv
 import os
+import threading
 import requests
 
+from config import TRANSLATE_BATCH_CHARS
+from http_client import http_client
+from http_client.http_client import RETRY_STATUSES
+from metrics import metrics
+
 load_dotenv()
 YANDEX_TOKEN = os.environ.get('YANDEX_TOKEN')
 FOLDER_ID = os.environ.get('FOLDER_ID')
+# Адрес API переводчика, можно заменить локальной заглушкой (benchmarks/load_test.py)
+YANDEX_TRANSLATE_URL = os.environ.get('YANDEX_TRANSLATE_URL') or 'https://translate.api.cloud.yandex.net/translate/v2'
 
 # from config import YANDEX_TOKEN, FOLDER_ID
 
+@metrics.timed(metrics.external_seconds)
 def detect(word):
     """
     Функция определяет на каком языке введено слово
     :param word: слово, язык которого надо определить
-    :return: str код языка для яндекс словаря ('en' или 'ru')
+    :return: str код языка для яндекс словаря ('en' или 'ru'), False если язык не определен
+    или None если сервис недоступен
     """
     body = {
         "text": word,
@@ -24,17 +34,56 @@ def detect(word):
         "Authorization": "Api-Key {0}".format(YANDEX_TOKEN),
     }
 
-    response = requests.post(
-        "https://translate.api.cloud.yandex.net/translate/v2/detect",
-        json=body,
-        headers=headers,
-    )
-    resp = response.json()
+    try:
+        response = http_client.post(
+            YANDEX_TRANSLATE_URL + '/detect',
+            'yandex_translate',
+            json=body,
+            headers=headers,
+        )
+        if response.status_code in RETRY_STATUSES:
+            return None
+        resp = response.json()
+    except (requests.RequestException, ValueError):
+        return None
     if 'languageCode' in resp:
         return resp['languageCode']
     else:
         return False
 
+# Сколько раз язык определен локально по алфавиту и сколько раз пришлось обращаться к Яндексу
+detect_stats = {'local': 0, 'remote': 0}
+metrics.collect('detect', lambda: dict(detect_stats))
+_detect_stats_lock = threading.Lock()
+
+
+def detect_local(word):
+    """
+    Функция определяет язык слова по алфавиту: только кириллица - 'ru', только латиница - 'en'
+    :param word: слово, язык которого надо определить
+    :return: str код языка ('en' или 'ru') или None если алфавиты смешаны или буквы других алфавитов
+    """
+    cyrillic = latin = False
+    for char in word:
+        if not char.isalpha():
+            continue
+        if '\u0400' <= char <= '\u04ff':
+            cyrillic = True
+        elif char.isascii():
+            latin = True
+        else:
+            return None
+    if cyrillic == latin:
+        return None
+    return 'ru' if cyrillic else 'en'
+
+
+def _count_detect(key):
+    with _detect_stats_lock:
+        detect_stats[key] += 1
+
+
+@metrics.timed(metrics.external_seconds)
 def translate(word):
     """
     Функция осуществляет перевод слова или фразы посредством API Яндекс переводчика
@@ -42,11 +91,18 @@ def translate(word):
     :return: словарь с переводом и определенным языком. Например:
     translate('silo')
     {'translations': [{'text': 'бункер', 'detectedLanguageCode': 'en'}]}
+    False если перевода нет, None если сервис недоступен (такой результат нельзя кэшировать)
     """
 
-    word_lang = detect(word)
+    # К Яндексу за определением языка обращаемся, только если по алфавиту язык не понятен
+    word_lang = detect_local(word)
+    if word_lang:
+        _count_detect('local')
+    else:
+        _count_detect('remote')
+        word_lang = detect(word)
     if not word_lang:
-        return False
+        return word_lang
 
     if word_lang == 'ru':
         target_language = 'en'
@@ -65,12 +121,99 @@ def translate(word):
         "Authorization": "Api-Key {0}".format(YANDEX_TOKEN),
     }
 
-    response = requests.post(
-        "https://translate.api.cloud.yandex.net/translate/v2/translate",
-        json=body,
-        headers=headers,
-    )
-    return response.json()
+    try:
+        response = http_client.post(
+            YANDEX_TRANSLATE_URL + '/translate',
+            'yandex_translate',
+            json=body,
+            headers=headers,
+        )
+        if response.status_code in RETRY_STATUSES:
+            return None
+        resp = response.json()
+    except (requests.RequestException, ValueError):
+        return None
+    if 'translations' not in resp:
+        return False
+    return resp
+
+def _batches(texts, max_chars=TRANSLATE_BATCH_CHARS):
+    """
+    Функция делит список текстов на пачки, суммарная длина каждой не больше max_chars
+    :param texts: list из пар (индекс, текст)
+    :param max_chars: максимальное суммарное количество символов в пачке
+    :return: генератор списков пар (индекс, текст)
+    """
+    batch = []
+    chars = 0
+    for item in texts:
+        if batch and chars + len(item[1]) > max_chars:
+            yield batch
+            batch = []
+            chars = 0
+        batch.append(item)
+        chars += len(item[1])
+    if batch:
+        yield batch
+
+
+@metrics.timed(metrics.external_seconds)
+def translate_many(words):
+    """
+    Функция переводит список слов пачками: один запрос к API на пачку слов одного языка
+    :param words: list из слов или фраз
+    :return: list результатов в том же порядке, каждый в формате translate(): словарь, False или None
+    """
+    results = [False] * len(words)
+    by_lang = {'ru': [], 'en': []}
+    for index, word in enumerate(words):
+        word_lang = detect_local(word)
+        if word_lang:
+            _count_detect('local')
+        else:
+            _count_detect('remote')
+            word_lang = detect(word)
+        if word_lang in by_lang:
+            by_lang[word_lang].append((index, word))
+        elif word_lang is None:
+            results[index] = None
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Api-Key {0}".format(YANDEX_TOKEN),
+    }
+    for word_lang, texts in by_lang.items():
+        target_language = 'en' if word_lang == 'ru' else 'ru'
+        for batch in _batches(texts):
+            body = {
+                "sourceLanguageCode": word_lang,
+                "targetLanguageCode": target_language,
+                "texts": [text for _, text in batch],
+                "folderId": FOLDER_ID,
+            }
+            try:
+                response = http_client.post(
+                    YANDEX_TRANSLATE_URL + '/translate',
+                    'yandex_translate',
+                    json=body,
+                    headers=headers,
+                )
+                if response.status_code in RETRY_STATUSES:
+                    raise requests.HTTPError(response=response)
+                translations = response.json().get('translations', [])
+            except (requests.RequestException, ValueError):
+                # Сервис недоступен: слова пачки не переведены, но и отсутствующими не считаются
+                for index, _ in batch:
+                    results[index] = None
+                continue
+            # Если API вернуло не все переводы, слова пачки считаем непереведенными
+            if len(translations) != len(batch):
+                continue
+            for (index, _), translation in zip(batch, translations):
+                results[index] = {'translations': [{'text': translation['text'],
+                                                    'detectedLanguageCode': word_lang}]}
+    return results
+
 
 if __name__ == "__main__":
     # print(detect('lf;k;dlfkg;ldfk d;f;lgk d;lkg;dfg d;fg kd;fgkl d;fgd f;lgk d;flgd fgdf;lgk d;flgk d;fg '))